@@ -2,4 +2,5 @@ __author__ = 'Guillermo Avendano-Franco'
 
 from _analysis import StructureAnalysis
 from _entry import EntryAnalysis
-from _changer import StructureChanger
\ No newline at end of file
+from _changer import StructureChanger
+from _fingerprint import CompressedFingerprint
\ No newline at end of file
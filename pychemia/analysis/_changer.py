@@ -4,7 +4,9 @@ import random
 import itertools
 import numpy as np
 
+from pychemia import Structure
 from pychemia.utils.mathematics import unit_vector
+from pychemia.utils.periodic import covalent_radius
 
 
 class StructureChanger():
@@ -109,3 +111,98 @@ class StructureChanger():
             self.random_permutator()
         else:
             self.random_move_one_atom(epsilon=epsilon)
+
+    def random_changes(self, ncandidates, epsilon, overlap_factor=0.5):
+        """
+        Creates 'ncandidates' new structures from the original one in a single call.
+        Each candidate receives one random operation chosen with the same probabilities
+        used by 'random_change': a cell deformation, a displacement of all the atoms,
+        a permutation of two atoms of different species or the displacement of one atom.
+        The operations are applied simultaneously to all the candidates using arrays.
+        Candidates with two atoms closer than 'overlap_factor' times the sum of their
+        covalent radii are discarded, so the number of structures returned could be
+        lower than 'ncandidates'
+
+        :param ncandidates: (int) Number of candidates to generate
+        :param epsilon: (float) Maximal strain for cell deformations and length of atomic displacements
+        :param overlap_factor: (float) Factor for the sum of covalent radii to consider two atoms overlapping
+        :return: (list) New pychemia Structures that pass the overlap check
+        """
+        natom = self.old_structure.natom
+        cells = np.tile(self.old_structure.cell, (ncandidates, 1, 1))
+        reduced = np.tile(self.old_structure.reduced, (ncandidates, 1, 1))
+        species = np.array([self.old_structure.species.index(x) for x in self.old_structure.symbols])
+        symbols = np.tile(species, (ncandidates, 1))
+
+        rnd = np.random.random(ncandidates)
+        if self.old_structure.nspecies < 2:
+            rnd[np.bitwise_and(rnd >= 0.5, rnd < 0.75)] = 0.75
+        deform = rnd < 0.25
+        move_many = np.bitwise_and(rnd >= 0.25, rnd < 0.5)
+        permute = np.bitwise_and(rnd >= 0.5, rnd < 0.75)
+        move_one = rnd >= 0.75
+
+        # Cell deformations, the symmetric strain tensor is built from 6 random numbers
+        ndeform = np.sum(deform)
+        stress_eps = np.random.random((ndeform, 6)) * 2 * epsilon - epsilon
+        stress = np.tile(np.eye(3), (ndeform, 1, 1))
+        stress[:, [0, 1, 2], [0, 1, 2]] += stress_eps[:, :3]
+        stress[:, [0, 0, 1], [1, 2, 2]] += stress_eps[:, 3:]
+        stress[:, [1, 2, 2], [0, 0, 1]] += stress_eps[:, 3:]
+        cells[deform] = np.einsum('kij,kjl->kil', stress, cells[deform])
+
+        # Atomic displacements along random directions with length epsilon
+        displacements = np.random.normal(size=(ncandidates, natom, 3))
+        displacements *= epsilon / np.linalg.norm(displacements, axis=2)[:, :, np.newaxis]
+        mask = np.zeros((ncandidates, natom), dtype=bool)
+        mask[move_many] = True
+        mask[move_one, np.random.randint(natom, size=np.sum(move_one))] = True
+        displacements[np.logical_not(mask)] = 0.0
+        reduced += np.einsum('kni,kij->knj', displacements, np.linalg.inv(cells))
+
+        # Permutations between two atoms of different species
+        for k in np.where(permute)[0]:
+            while True:
+                index0, index1 = np.random.randint(natom, size=2)
+                if symbols[k, index0] != symbols[k, index1]:
+                    break
+            symbols[k, [index0, index1]] = symbols[k, [index1, index0]]
+
+        valid = np.logical_not(self._overlaps(cells, reduced, symbols, overlap_factor))
+        ret = []
+        for k in np.where(valid)[0]:
+            ret.append(Structure(cell=cells[k], reduced=reduced[k] % 1.0,
+                                 symbols=[self.old_structure.species[x] for x in symbols[k]],
+                                 periodicity=self.old_structure.periodicity))
+        return ret
+
+    def _overlaps(self, cells, reduced, symbols, overlap_factor, chunk_size=1000000):
+        """
+        Vectorized test of overlapping atoms for a set of candidates sharing the
+        number of atoms. Distances are computed with the minimum image and its
+        26 neighbors, so close contacts through the boundaries are also detected.
+        The candidates are processed in blocks of about 'chunk_size' pairs of atoms and
+        the images one at a time, so the memory used does not grow with 27 times
+        the number of pairs
+
+        :return: (numpy.ndarray) Boolean array, True for the candidates with overlapping atoms
+        """
+        ncandidates, natom = reduced.shape[:2]
+        radii = np.array(covalent_radius(self.old_structure.species))[symbols]
+        images = np.array(list(itertools.product([-1, 0, 1], repeat=3)), dtype=float)
+        block = max(1, chunk_size // max(1, natom * natom))
+        ret = np.zeros(ncandidates, dtype=bool)
+        for start in range(0, ncandidates, block):
+            end = min(start + block, ncandidates)
+            min_distances = overlap_factor * (radii[start:end, :, np.newaxis] + radii[start:end, np.newaxis, :])
+            diffs = reduced[start:end, np.newaxis, :, :] - reduced[start:end, :, np.newaxis, :]
+            diffs -= np.round(diffs)
+            distances = np.full((end - start, natom, natom), np.inf)
+            for m, image in enumerate(images):
+                image_distances = np.linalg.norm(np.einsum('kabi,kij->kabj', diffs + image, cells[start:end]), axis=3)
+                if m == 13:
+                    # Exclude the distance of each atom with itself in the same cell
+                    image_distances[:, np.arange(natom), np.arange(natom)] = np.inf
+                np.minimum(distances, image_distances, out=distances)
+            ret[start:end] = np.any(distances < min_distances, axis=(1, 2))
+        return ret
@@ -0,0 +1,209 @@
+__author__ = 'Guillermo Avendano-Franco'
+
+import numpy as np
+
+from pychemia.serializer import pack_array, unpack_array
+
+# Unit roundoff for float32 storage
+_EPS32 = 2.0 ** -24
+
+
+class CompressedFingerprint():
+    """
+    Compressed fixed-length representation of the fingerprints computed by
+    StructureAnalysis.fp_oganov
+
+    Each curve is reduced by averaging blocks of 'factor' consecutive bins
+    and the result is stored as float32. For the default fp_oganov parameters
+    (radius=50, delta=0.01) and factor=10 that means 500 float32 values
+    instead of 5000 float64 values for each pair of species.
+
+    Averaging over blocks is an orthogonal projection P, for each curve the relative residual
+    e = |u - Pu| / |u| is computed at compression time and kept with the
+    reduced values. For two fingerprints u and v the cosine distance
+    d = 0.5 * (1 - cos(u, v)) computed from the compressed curves satisfies
+
+        |d_compressed - d_exact| <= 0.5 * ((s - 1) + s*eu*ev) + 2*eps32
+
+    with s = 1/sqrt((1-eu^2)(1-ev^2)) and where eps32 = 2^-24 accounts for the float32 rounding.
+    The bound is second
+    order on the residuals, for curves smooth at the scale of 'factor' bins
+    the error on the distance is much smaller than the residuals themselves.
+    The bound for each pair of fingerprints is returned by 'error_bound'.
+    """
+
+    def __init__(self, fingerprint, factor=10):
+        """
+        Creates a compressed fingerprint from a dictionary of curves,
+        the dictionary is usually the second value returned by fp_oganov
+
+        :param fingerprint: (dict) Curves for each pair of species
+        :param factor: (int) Number of consecutive bins averaged on each reduced bin
+        """
+        assert (factor >= 1)
+        self.factor = factor
+        self.nbins = {}
+        self.values = {}
+        self.residuals = {}
+        for key in fingerprint:
+            curve = np.array(fingerprint[key], dtype=float)
+            self.nbins[key] = len(curve)
+            self.values[key], self.residuals[key] = self._compress(curve)
+
+    def _compress(self, curve):
+        # Each reduced bin is the block sum divided by the square root of the
+        # block size, so that dot products between reduced curves are exactly the
+        # dot products between the projected curves, even for a shorter last block
+        starts = np.arange(0, len(curve), self.factor)
+        sizes = np.minimum(self.factor, len(curve) - starts)
+        reduced = np.add.reduceat(curve, starts) / np.sqrt(sizes)
+        norm = np.linalg.norm(curve)
+        if norm > 0:
+            residual = np.linalg.norm(curve - np.repeat(reduced / np.sqrt(sizes), sizes)) / norm
+        else:
+            residual = 0.0
+        return np.float32(reduced), float(residual)
+
+    def distance(self, other):
+        """
+        Cosine distance averaged over all the pairs of species, the same
+        metric used by StructurePopulation.distance on the full fingerprints
+
+        :param other: (CompressedFingerprint)
+        :return: (float)
+        """
+        assert (self.factor == other.factor)
+        assert (len(self.values) == len(other.values))
+        dij = []
+        for key in self.values:
+            uvect1 = np.array(self.values[key], dtype=float)
+            uvect2 = np.array(other.values[key], dtype=float)
+            dij.append(_cosine_distance(np.dot(uvect1, uvect2), np.linalg.norm(uvect1), np.linalg.norm(uvect2)))
+        return float(np.mean(dij))
+
+    def distances(self, others):
+        """
+        Distances from this fingerprint to many others at once, the curves of the
+        others are stacked on matrices and the dot products computed with one
+        matrix-vector product for each pair of species
+
+        :param others: (list) CompressedFingerprint objects or the result of 'stack'
+        :return: (numpy.ndarray) Distance to each fingerprint, same metric as 'distance'
+        """
+        if not isinstance(others, dict):
+            others = CompressedFingerprint.stack(others)
+        assert (len(self.values) == len(others))
+        ret = None
+        for key in self.values:
+            matrix, norms = others[key]
+            uvect = np.array(self.values[key], dtype=float)
+            dij = _cosine_distance(np.dot(matrix, uvect), np.linalg.norm(uvect), norms)
+            if ret is None:
+                ret = dij
+            else:
+                ret += dij
+        return ret / len(self.values)
+
+    @staticmethod
+    def stack(fingerprints):
+        """
+        Curves of many fingerprints stacked as one float64 matrix for each pair of species,
+        computed once and reused by 'distances' when the same set is compared many times
+
+        :param fingerprints: (list) CompressedFingerprint objects with the same factor
+        :return: (dict) Tuples (matrix, norms) for each pair of species
+        """
+        ret = {}
+        for key in fingerprints[0].values:
+            matrix = np.array([x.values[key] for x in fingerprints], dtype=float)
+            ret[key] = (matrix, np.linalg.norm(matrix, axis=1))
+        return ret
+
+    def error_bound(self, other):
+        """
+        Upper bound for the difference between the distance computed
+        with the compressed fingerprints and the distance computed with the
+        original ones. Curves with all the weight off the block averages have residual 1,
+        for those pairs the trivial bound 1 is used, as the distances are between 0 and 1
+
+        :param other: (CompressedFingerprint)
+        :return: (float)
+        """
+        bounds = []
+        for key in self.values:
+            eu = self.residuals[key]
+            ev = other.residuals[key]
+            if eu >= 1.0 or ev >= 1.0:
+                bounds.append(1.0)
+                continue
+            scale = 1.0 / np.sqrt((1.0 - eu ** 2) * (1.0 - ev ** 2))
+            bounds.append(min(1.0, 0.5 * ((scale - 1.0) + scale * eu * ev) + 2 * _EPS32))
+        return float(np.mean(bounds))
+
+    def to_dict(self, compress=True):
+        """
+        Serialize the compressed fingerprint, each curve is stored as a packed
+        binary float32 array. The keys of the curves are converted to strings
+        with the indices of the species joined by '_'
+
+        :param compress: (bool) If True the binary arrays are also compressed with zlib
+        :return: (dict)
+        """
+        ret = {'factor': self.factor, 'curves': {}}
+        for key in self.values:
+            ret['curves']['_'.join([str(x) for x in key])] = {'nbins': self.nbins[key],
+                                                              'residual': self.residuals[key],
+                                                              'values': pack_array(self.values[key],
+                                                                                   compress=compress)}
+        return ret
+
+    @staticmethod
+    def from_dict(fpdict):
+        ret = CompressedFingerprint({}, factor=fpdict['factor'])
+        for skey in fpdict['curves']:
+            key = tuple([int(x) for x in skey.split('_')])
+            curve = fpdict['curves'][skey]
+            ret.nbins[key] = curve['nbins']
+            ret.residuals[key] = curve['residual']
+            ret.values[key] = unpack_array(curve['values'])
+        return ret
+
+    @staticmethod
+    def pack_full(fingerprint, compress=True):
+        """
+        Lossless packed binary storage of the original fingerprint curves
+
+        :param fingerprint: (dict) Curves for each pair of species
+        :param compress: (bool) If True the binary arrays are also compressed with zlib
+        :return: (dict)
+        """
+        ret = {}
+        for key in fingerprint:
+            ret['_'.join([str(x) for x in key])] = pack_array(fingerprint[key], dtype='float64', compress=compress)
+        return ret
+
+    @staticmethod
+    def unpack_full(packed):
+        ret = {}
+        for skey in packed:
+            ret[tuple([int(x) for x in skey.split('_')])] = unpack_array(packed[skey])
+        return ret
+
+    def __len__(self):
+        return len(self.values)
+
+
+def _cosine_distance(dot, norm1, norm2):
+    """
+    Cosine distance 0.5 * (1 - cos) from a dot product and the norms of the vectors.
+    Two null curves are at distance 0 and a null curve is at distance 0.5 of any other curve.
+    The arguments can be numbers or numpy arrays
+    """
+    norm = np.asarray(norm1 * norm2, dtype=float)
+    null1 = np.asarray(norm1) == 0
+    null2 = np.asarray(norm2) == 0
+    cosine = np.where(norm > 0, dot / np.where(norm > 0, norm, 1.0), np.where(null1 & null2, 1.0, 0.0))
+    ret = 0.5 * (1.0 - cosine)
+    if ret.ndim == 0:
+        return float(ret)
+    return ret
@@ -927,9 +927,7 @@ Empty structure
 
 
 def load_structure_json(filename):
-    ret = Structure()
-    ret.load_json(filename)
-    return ret
+    return Structure.load_json(filename)
 
 
 class SiteSet():
@@ -3,12 +3,20 @@ Routines related to Metadata info and Repositories
 """
 
 from _repo import StructureEntry, ExecutionRepository, PropertiesEntry
+from _archive import RepositoryArchive, pack_repository, unpack_archive
 try:
-    from _db import PyChemiaDB, get_database, object_id
+    from _db import PyChemiaDB, LeaseHeartbeat, get_database, object_id, prepare_fields, max_abs, lock_owner
+    from _arrays import PackedArray, encode_array
+    from _client import configure_clients, close_clients
+    from _notify import ChangeWatcher
+    from _compat import USE_PYMONGO
+    # PyChemiaDB is available, MongoDB servers also require pymongo (USE_PYMONGO),
+    # otherwise only the sqlite backend can be used
     USE_MONGO = True
 except ImportError:
-    print 'Could no import pymongo, mongo database functionality disabled'
+    print 'Could no import the database modules, database functionality disabled'
     USE_MONGO = False
+    USE_PYMONGO = False
 
 
 # __all__ = filter(lambda s: not s.startswith('_'), dir())
@@ -0,0 +1,278 @@
+"""
+Packed archive of a StructureRepository on a single file
+
+The archive replaces the directory of each entry by sections of one file:
+
+    header           'PCMARCH1', offset and length of the table of contents
+    documents        One JSON document per entry with the structure (without arrays),
+                     the metadata and the properties
+    originals        Contents of the original files, as stored on the repository
+    cells            float64 array (nentries, 3, 3)
+    reduced          float64 array (natoms, 3) with the reduced coordinates of all the entries
+    positions        float64 array (natoms, 3) with the cartesian positions of all the entries
+    table            int64 array (nentries, 4) with offset and length of the document,
+                     first atom and number of atoms for each entry
+    contents         JSON with the identifiers, formulas, tags, location of the sections
+                     and of the original files
+
+Archives are read with RepositoryArchive, which maps the file on memory in read-only mode.
+Arrays are returned as views of the mapped file without copying them and the same archive
+can be opened by many processes at once.
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import json
+import mmap
+import os
+import struct
+import tempfile
+import shutil
+import zlib
+import numpy as np
+
+from pychemia.core.structure import Structure
+from pychemia.utils.computing import unicode2string
+from _repo import StructureRepository, StructureEntry
+
+_MAGIC = 'PCMARCH1'
+_HEADER = struct.Struct('<8sQQ')
+_ARRAYS = ['cell', 'reduced', 'positions']
+
+
+class RepositoryArchive():
+    """
+    Read-only access to a packed archive created with 'pack_repository'
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: (str) Path to the archive
+        """
+        self.filename = os.path.abspath(filename)
+        rf = open(self.filename, 'rb')
+        self._mmap = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+        rf.close()
+        magic, offset, length = _HEADER.unpack(self._mmap[:_HEADER.size])
+        if magic != _MAGIC:
+            raise ValueError('Not a PyChemia repository archive: %s' % filename)
+        self.contents = unicode2string(json.loads(self._mmap[offset:offset + length]))
+        self.identifiers = self.contents['identifiers']
+        self.tags = self.contents['tags']
+        self._rows = dict([(x, i) for i, x in enumerate(self.identifiers)])
+        self.table = self._array('table', '<i8', (len(self.identifiers), 4))
+        self.cells = self._array('cell', '<f8', (len(self.identifiers), 3, 3))
+        self.reduced = self._array('reduced', '<f8', (self.contents['natoms'], 3))
+        self.positions = self._array('positions', '<f8', (self.contents['natoms'], 3))
+
+    def _array(self, name, dtype, shape):
+        count = int(np.prod(shape))
+        return np.frombuffer(self._mmap, dtype=dtype, count=count, offset=self.contents['sections'][name]).reshape(shape)
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def __contains__(self, identifier):
+        return identifier in self._rows
+
+    @property
+    def get_all_entries(self):
+        return list(self.identifiers)
+
+    def get_formulas(self):
+        """
+        :return: (dict) Identifiers of the entries for each formula
+        """
+        ret = {}
+        for identifier, formula in zip(self.identifiers, self.contents['formulas']):
+            ret.setdefault(formula, []).append(identifier)
+        return ret
+
+    def find(self, formula=None, tag=None):
+        """
+        Identifiers of the entries with the given formula and tag
+
+        :param formula: (str) Chemical formula
+        :param tag: (str) Tag of the entries
+        :return: (list)
+        """
+        ret = self.identifiers
+        if formula is not None:
+            ret = [x for x, y in zip(ret, self.contents['formulas']) if y == formula]
+        if tag is not None:
+            tagged = set(self.tags.get(tag, []))
+            ret = [x for x in ret if x in tagged]
+        return list(ret)
+
+    def _document(self, identifier):
+        offset, length = [int(x) for x in self.table[self._rows[identifier]][:2]]
+        return unicode2string(json.loads(self._mmap[offset:offset + length]))
+
+    def get_arrays(self, identifier):
+        """
+        Cell, reduced coordinates and positions of one entry as read-only views of the archive
+
+        :param identifier: (str) Identifier of the entry
+        :return: (tuple) Three numpy arrays
+        """
+        row = self._rows[identifier]
+        start, natom = [int(x) for x in self.table[row][2:]]
+        return self.cells[row], self.reduced[start:start + natom], self.positions[start:start + natom]
+
+    def get_structure(self, identifier):
+        """
+        :param identifier: (str) Identifier of the entry
+        :return: (Structure)
+        """
+        structure_dict = self._document(identifier)['structure']
+        for name, array in zip(_ARRAYS, self.get_arrays(identifier)):
+            structure_dict[name] = np.array(array)
+        return Structure.from_dict(structure_dict)
+
+    def get_metadata(self, identifier):
+        """
+        :param identifier: (str) Identifier of the entry
+        :return: (dict) Tags, parents, children and originals of the entry
+        """
+        return self._document(identifier)['metadata']
+
+    def get_properties(self, identifier):
+        """
+        :param identifier: (str) Identifier of the entry
+        :return: (dict) The properties or None if the entry has no properties
+        """
+        return self._document(identifier)['properties']
+
+    def get_original(self, filehash):
+        """
+        Contents of an original file
+
+        :param filehash: (str) Hash of the file, see StructureEntry.originals
+        :return: (str)
+        """
+        offset, length, compressed = self.contents['originals'][filehash]
+        data = self._mmap[offset:offset + length]
+        if compressed:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+    def close(self):
+        """
+        Close the archive, the arrays returned before must not be used after closing it
+        """
+        self.table = self.cells = self.reduced = self.positions = None
+        self._mmap.close()
+
+
+def pack_repository(repository, filename):
+    """
+    Create a packed archive with all the entries of a repository, the entries are
+    read one by one and the archive is written on a temporary file renamed at the end
+
+    :param repository: (StructureRepository) The repository
+    :param filename: (str) Path to the archive
+    :return: (int) Number of entries on the archive
+    """
+    identifiers = repository.get_all_entries
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(filename)))
+    arrays = dict([(name, open(tmpdir + os.sep + name, 'wb')) for name in _ARRAYS])
+    wf = open(filename + '.tmp', 'wb')
+    wf.write(_HEADER.pack(_MAGIC, 0, 0))
+
+    table = np.zeros((len(identifiers), 4), dtype='<i8')
+    formulas = []
+    hashes = set()
+    natoms = 0
+    for i, ident in enumerate(identifiers):
+        entry = StructureEntry(repository=repository, identifier=ident)
+        structure_dict = entry.structure.to_dict()
+        arrays['cell'].write(np.asarray(entry.structure.cell, dtype='<f8').tobytes())
+        arrays['reduced'].write(np.asarray(entry.structure.reduced, dtype='<f8').reshape(-1, 3).tobytes())
+        arrays['positions'].write(np.asarray(entry.structure.positions, dtype='<f8').reshape(-1, 3).tobytes())
+        for name in _ARRAYS:
+            structure_dict.pop(name)
+        document = json.dumps({'structure': structure_dict, 'metadata': entry.metadatatodict(),
+                               'properties': entry.properties})
+        table[i] = [wf.tell(), len(document), natoms, entry.structure.natom]
+        wf.write(document)
+        natoms += entry.structure.natom
+        formulas.append(entry.structure.formula)
+        hashes.update([x['hash'] for x in entry.originals])
+
+    originals = {}
+    for filehash in sorted(hashes):
+        blob = repository.blobs.blob_path(filehash)
+        if blob is None:
+            continue
+        rf = open(blob, 'rb')
+        data = rf.read()
+        rf.close()
+        originals[filehash] = [wf.tell(), len(data), blob.endswith('.gz')]
+        wf.write(data)
+
+    sections = {}
+    for name in _ARRAYS:
+        arrays[name].close()
+        sections[name] = _align(wf)
+        rf = open(tmpdir + os.sep + name, 'rb')
+        shutil.copyfileobj(rf, wf)
+        rf.close()
+    shutil.rmtree(tmpdir)
+    sections['table'] = _align(wf)
+    wf.write(table.tobytes())
+
+    contents = json.dumps({'identifiers': identifiers, 'formulas': formulas, 'tags': repository.tags,
+                           'natoms': natoms, 'sections': sections, 'originals': originals})
+    offset = wf.tell()
+    wf.write(contents)
+    wf.seek(0)
+    wf.write(_HEADER.pack(_MAGIC, offset, len(contents)))
+    wf.flush()
+    os.fsync(wf.fileno())
+    wf.close()
+    os.rename(filename + '.tmp', filename)
+    return len(identifiers)
+
+
+def unpack_archive(filename, path, compress_originals=False):
+    """
+    Create a StructureRepository with all the entries of a packed archive,
+    the entries keep their identifiers
+
+    :param filename: (str) Path to the archive
+    :param path: (str) Directory for the new repository, it must not contain entries
+    :param compress_originals: (bool) Compress the original files on the repository
+    :return: (StructureRepository) The new repository
+    """
+    archive = RepositoryArchive(filename)
+    repository = StructureRepository(path, compress_originals=compress_originals)
+    if len(repository) > 0:
+        raise ValueError('The repository on %s already contains entries' % path)
+    with repository.batch():
+        for ident in archive.identifiers:
+            metadata = archive.get_metadata(ident)
+            entry = StructureEntry(structure=archive.get_structure(ident))
+            entry.identifier = ident
+            entry.tags = metadata['tags']
+            entry.parents = metadata['parents']
+            entry.children = metadata['children']
+            entry.properties = archive.get_properties(ident)
+            for iorig in metadata.get('originals', []):
+                if iorig['hash'] in repository.blobs:
+                    repository.blobs.ref(iorig['hash'])
+                else:
+                    repository.blobs.add_data(archive.get_original(iorig['hash']), iorig['hash'])
+            entry.originals = metadata.get('originals', [])
+            repository.add_entry(entry)
+    archive.close()
+    return repository
+
+
+def _align(wf, size=8):
+    """
+    Pad the file with zeros to a multiple of 'size' and return the new position
+    """
+    position = wf.tell()
+    if position % size != 0:
+        wf.write('\0' * (size - position % size))
+    return wf.tell()
@@ -0,0 +1,165 @@
+"""
+Binary storage of numeric arrays on the properties of PyChemiaDB entries
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import numpy as np
+
+from pychemia.serializer import pack_array, unpack_array
+from _compat import Binary
+
+# Properties always stored as binary arrays, any other property is stored as
+# binary array only when its value is a numpy array
+ARRAY_PROPERTIES = ['forces', 'stress', 'fingerprint']
+
+# Arrays with more bytes than this are compressed with zlib
+COMPRESS_THRESHOLD = 512
+
+
+def is_packed(value):
+    """
+    True if 'value' is a dictionary created by pychemia.serializer.pack_array
+
+    :param value: Any value
+    :return: (bool)
+    """
+    return isinstance(value, dict) and 'dtype' in value and 'shape' in value and 'data' in value
+
+
+def encode_array(value, dtype=None, compress=None):
+    """
+    Document stored on the database for a numeric array, a dictionary with
+    the dtype, the shape and the raw bytes as BSON binary data
+
+    :param value: (numpy.ndarray, list, PackedArray) The array, None is returned unchanged
+    :param dtype: (str) Convert the array to this dtype, by default numpy arrays keep their
+                  dtype and lists are converted to 'float64'
+    :param compress: (bool) Compress the bytes with zlib, by default only arrays larger than
+                     COMPRESS_THRESHOLD bytes are compressed
+    :return: (dict)
+    """
+    if value is None:
+        return None
+    if isinstance(value, PackedArray):
+        if dtype is None and compress is None:
+            return value.packed
+        value = value.array
+    elif is_packed(value):
+        if dtype is None and compress is None:
+            ret = dict(value)
+            ret['data'] = Binary(bytes(value['data']))
+            return ret
+        value = unpack_array(value)
+    if dtype is None and not isinstance(value, np.ndarray):
+        dtype = 'float64'
+    array = np.asarray(value, dtype=dtype)
+    if compress is None:
+        compress = array.nbytes > COMPRESS_THRESHOLD
+    ret = pack_array(array, compress=compress)
+    ret['data'] = Binary(ret['data'])
+    return ret
+
+
+def encode_properties(properties):
+    """
+    Returns a copy of 'properties' with the values of ARRAY_PROPERTIES and the numpy arrays
+    encoded as binary arrays
+
+    :param properties: (dict) Properties of an entry
+    :return: (dict)
+    """
+    ret = dict(properties)
+    for name in ret:
+        if is_array_property(name, ret[name]):
+            ret[name] = encode_array(ret[name])
+    return ret
+
+
+def is_array_property(name, value):
+    """
+    True if the property 'name' with 'value' must be stored as a binary array
+
+    :param name: (str) Name of the property
+    :param value: Value of the property
+    :return: (bool)
+    """
+    if value is None or isinstance(value, (basestring, int, float)):
+        return False
+    return name in ARRAY_PROPERTIES or isinstance(value, (np.ndarray, PackedArray))
+
+
+def decode_arrays(value):
+    """
+    Replace the binary arrays found on a document by PackedArray objects, the bytes are
+    only decoded when the array is used
+
+    :param value: (dict) A document from the database, it is modified in place
+    :return: (dict) The same document
+    """
+    if isinstance(value, dict):
+        for key in value:
+            if is_packed(value[key]):
+                value[key] = PackedArray(value[key])
+            elif isinstance(value[key], dict):
+                decode_arrays(value[key])
+    return value
+
+
+class PackedArray():
+    """
+    Numeric array read from the database. The numpy array is decoded on the first access
+    and kept afterwards. PackedArray objects can be used directly on numpy functions
+    and stored again on the database without decoding them.
+    """
+
+    def __init__(self, packed):
+        """
+        :param packed: (dict) Dictionary created by pychemia.serializer.pack_array
+        """
+        self.packed = packed
+        self._array = None
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = unpack_array(self.packed)
+        return self._array
+
+    @property
+    def shape(self):
+        return tuple(self.packed['shape'])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.packed['dtype'])
+
+    def max_abs(self):
+        """
+        Maximal absolute value of the array, None for empty arrays
+
+        :return: (float)
+        """
+        if self.array.size == 0:
+            return None
+        return float(np.max(np.abs(self.array)))
+
+    def tolist(self):
+        return self.array.tolist()
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self.array
+        return self.array.astype(dtype)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, item):
+        return self.array[item]
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __repr__(self):
+        return 'PackedArray(shape=%s, dtype=%s)' % (str(self.shape), self.dtype.str)
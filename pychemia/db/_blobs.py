@@ -0,0 +1,216 @@
+"""
+Content-addressed store for the original files of the entries of a StructureRepository
+
+Each file is stored once on 'blobs/<hh>/<hash>' where 'hash' is the SHA224 digest of its contents,
+compressed files use the extension '.gz'. The number of entries referencing each file is
+kept on the index of the repository and the file is removed when no entry references it.
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import gzip
+import hashlib
+import os
+import shutil
+
+
+def hash_file(filename, blocksize=1048576):
+    """
+    SHA224 digest of the contents of a file, read in blocks of 'blocksize' bytes
+
+    :param filename: (str) Path to the file
+    :param blocksize: (int) Number of bytes read at once
+    :return: (str) Hexadecimal digest
+    """
+    sha = hashlib.sha224()
+    rf = open(filename, 'rb')
+    while True:
+        data = rf.read(blocksize)
+        if not data:
+            break
+        sha.update(data)
+    rf.close()
+    return sha.hexdigest()
+
+
+class BlobStore():
+    """
+    Store of files identified by the hash of their contents with reference counts
+    """
+
+    def __init__(self, path, index, compress=False):
+        """
+        :param path: (str) Directory for the files, it is created if it does not exist
+        :param index: (RepositoryIndex) Index where the reference counts are kept
+        :param compress: (bool) Compress with gzip the new files
+        """
+        self.path = os.path.abspath(path)
+        self.index = index
+        self.compress = compress
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+
+    def blob_path(self, filehash):
+        """
+        Path to the file stored for 'filehash'
+
+        :param filehash: (str) Hash of the contents
+        :return: (str) None if the file is not stored
+        """
+        basename = self.path + os.sep + filehash[:2] + os.sep + filehash
+        if os.path.isfile(basename):
+            return basename
+        elif os.path.isfile(basename + '.gz'):
+            return basename + '.gz'
+        return None
+
+    def __contains__(self, filehash):
+        return self.blob_path(filehash) is not None
+
+    def contains_path(self, filename):
+        """
+        True if 'filename' is a file inside the store
+        """
+        return os.path.abspath(filename).startswith(self.path + os.sep)
+
+    def add(self, filename, filehash=None):
+        """
+        Store a file if its contents are not already stored and add one reference to it
+
+        :param filename: (str) Path to the file
+        :param filehash: (str) Hash of the file if it is already known
+        :return: (str) Hash of the contents
+        """
+        if filehash is None:
+            filehash = hash_file(filename)
+        if filehash not in self:
+            dirname = self.path + os.sep + filehash[:2]
+            if not os.path.isdir(dirname):
+                os.mkdir(dirname)
+            target = dirname + os.sep + filehash
+            if self.compress:
+                target += '.gz'
+                rf = open(filename, 'rb')
+                wf = gzip.open(target + '.tmp', 'wb')
+                shutil.copyfileobj(rf, wf)
+                wf.close()
+                rf.close()
+            else:
+                shutil.copyfile(filename, target + '.tmp')
+            os.rename(target + '.tmp', target)
+        self.ref(filehash)
+        return filehash
+
+    def add_data(self, data, filehash=None):
+        """
+        Store the contents of a file given as a string if they are not already stored
+        and add one reference to them
+
+        :param data: (str) Contents of the file
+        :param filehash: (str) Hash of the contents if it is already known
+        :return: (str) Hash of the contents
+        """
+        if filehash is None:
+            filehash = hashlib.sha224(data).hexdigest()
+        if filehash not in self:
+            dirname = self.path + os.sep + filehash[:2]
+            if not os.path.isdir(dirname):
+                os.mkdir(dirname)
+            target = dirname + os.sep + filehash
+            if self.compress:
+                target += '.gz'
+                wf = gzip.open(target + '.tmp', 'wb')
+            else:
+                wf = open(target + '.tmp', 'wb')
+            wf.write(data)
+            wf.close()
+            os.rename(target + '.tmp', target)
+        self.ref(filehash)
+        return filehash
+
+    def add_link(self, filename, filehash):
+        """
+        Store a file from other BlobStore, the file is hard linked if possible
+        and keeps its compression, one reference is added
+
+        :param filename: (str) Path to the file on the other store
+        :param filehash: (str) Hash of the contents
+        :return: (str) Hash of the contents
+        """
+        if filehash not in self:
+            dirname = self.path + os.sep + filehash[:2]
+            if not os.path.isdir(dirname):
+                os.mkdir(dirname)
+            target = dirname + os.sep + os.path.basename(filename)
+            try:
+                os.link(filename, target)
+            except OSError:
+                shutil.copy2(filename, target + '.tmp')
+                os.rename(target + '.tmp', target)
+        self.ref(filehash)
+        return filehash
+
+    def ref(self, filehash):
+        """
+        Add one reference to a stored file
+
+        :param filehash: (str) Hash of the contents
+        :return: (int) Number of references
+        """
+        return self.index.blob_ref(filehash, 1)
+
+    def release(self, filehash):
+        """
+        Remove one reference to a stored file, the file is deleted when it has no references
+
+        :param filehash: (str) Hash of the contents
+        :return: (int) Number of references left
+        """
+        ret = self.index.blob_ref(filehash, -1)
+        if ret <= 0:
+            filename = self.blob_path(filehash)
+            if filename is not None:
+                os.remove(filename)
+        return ret
+
+    def open(self, filehash):
+        """
+        Open a stored file for reading, the contents are decompressed if needed
+
+        :param filehash: (str) Hash of the contents
+        :return: (file)
+        """
+        filename = self.blob_path(filehash)
+        if filename is None:
+            raise ValueError('File not found on the store: %s' % filehash)
+        if filename.endswith('.gz'):
+            return gzip.open(filename, 'rb')
+        return open(filename, 'rb')
+
+    def read(self, filehash):
+        rf = self.open(filehash)
+        ret = rf.read()
+        rf.close()
+        return ret
+
+    def hashes(self):
+        """
+        :return: (list) Hashes of all the files on the store
+        """
+        ret = []
+        for dirname in os.listdir(self.path):
+            if os.path.isdir(self.path + os.sep + dirname):
+                ret += [x.replace('.gz', '') for x in os.listdir(self.path + os.sep + dirname)
+                        if not x.endswith('.tmp')]
+        return ret
+
+    def rebuild(self, counts):
+        """
+        Set the reference counts and remove the files without references
+
+        :param counts: (dict) Number of references for each hash
+        """
+        self.index.set_blob_counts(counts)
+        for filehash in self.hashes():
+            if counts.get(filehash, 0) <= 0:
+                os.remove(self.blob_path(filehash))
@@ -0,0 +1,108 @@
+"""
+Registry of MongoDB clients shared by all the databases opened on a process
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import os
+from threading import Lock
+from _compat import MongoClient
+
+# Default options for new clients, the keys are the names accepted on 'db_settings'
+# and the values are passed to MongoClient with the names on _CLIENT_ARGUMENTS
+CLIENT_OPTIONS = {'max_pool_size': 100,
+                  'min_pool_size': 0,
+                  'connect_timeout_ms': 20000,
+                  'server_selection_timeout_ms': 30000,
+                  'socket_timeout_ms': None,
+                  'wait_queue_timeout_ms': None}
+
+_CLIENT_ARGUMENTS = {'max_pool_size': 'maxPoolSize',
+                     'min_pool_size': 'minPoolSize',
+                     'connect_timeout_ms': 'connectTimeoutMS',
+                     'server_selection_timeout_ms': 'serverSelectionTimeoutMS',
+                     'socket_timeout_ms': 'socketTimeoutMS',
+                     'wait_queue_timeout_ms': 'waitQueueTimeoutMS'}
+
+_clients = {}
+_clients_pid = None
+_lock = Lock()
+
+
+def configure_clients(**options):
+    """
+    Change the default options for the clients created from now on,
+    for example: configure_clients(max_pool_size=16, socket_timeout_ms=60000)
+
+    :param options: Options with the names on CLIENT_OPTIONS
+    """
+    for key in options:
+        if key not in CLIENT_OPTIONS:
+            raise ValueError('Unknown client option: %s' % key)
+    CLIENT_OPTIONS.update(options)
+
+
+def client_options(db_settings):
+    """
+    Options for the client from a dictionary of database settings,
+    options not present on 'db_settings' take the default value from CLIENT_OPTIONS
+
+    :param db_settings: (dict) Database settings
+    :return: (dict)
+    """
+    ret = dict(CLIENT_OPTIONS)
+    for key in CLIENT_OPTIONS:
+        if key in db_settings:
+            ret[key] = db_settings[key]
+    return ret
+
+
+def get_client(uri, options=None):
+    """
+    Return the MongoClient for 'uri' and 'options' of the current process,
+    the client is created the first time it is requested and shared by all the
+    databases opened later with the same arguments. Each client keeps its own
+    pool of connections to the server.
+
+    Clients are not shared between processes, after a fork the child process
+    forgets the clients inherited from its parent and creates new ones.
+    Clients are created without connecting, so a process can create a client and
+    fork before using it
+
+    :param uri: (str) MongoDB URI
+    :param options: (dict) Options with the names on CLIENT_OPTIONS
+    :return: (MongoClient)
+    """
+    global _clients, _clients_pid, _lock
+
+    if MongoClient is None:
+        raise RuntimeError('pymongo is required to connect with MongoDB servers, use the sqlite backend')
+    if options is None:
+        options = dict(CLIENT_OPTIONS)
+    key = (uri, tuple(sorted(options.items())))
+    if _clients_pid != os.getpid():
+        # The sockets of the clients created by the parent process must not be used here,
+        # the lock is also replaced as it could have been held by another thread during the fork
+        _lock = Lock()
+        _clients = {}
+        _clients_pid = os.getpid()
+    with _lock:
+        if key not in _clients:
+            kwargs = {}
+            for name in options:
+                if options[name] is not None:
+                    kwargs[_CLIENT_ARGUMENTS[name]] = options[name]
+            _clients[key] = MongoClient(uri, connect=False, **kwargs)
+        return _clients[key]
+
+
+def close_clients():
+    """
+    Close all the clients created by the current process
+    """
+    global _clients
+    with _lock:
+        if _clients_pid == os.getpid():
+            for key in _clients:
+                _clients[key].close()
+        _clients = {}
@@ -0,0 +1,102 @@
+"""
+Names of pymongo and bson used by PyChemiaDB. When pymongo is not installed only the
+SQLite backend can be used, the minimal replacements defined here cover what that backend
+needs: identifiers for new documents, binary data and the errors raised on writes
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import os
+import time
+import struct
+import random
+import binascii
+from threading import Lock
+
+try:
+    from bson.objectid import ObjectId
+    from bson.binary import Binary
+    from pymongo import MongoClient, IndexModel
+    from pymongo.errors import PyMongoError, OperationFailure, BulkWriteError, DuplicateKeyError
+    USE_PYMONGO = True
+except ImportError:
+    USE_PYMONGO = False
+    MongoClient = None
+    IndexModel = None
+
+    class PyMongoError(Exception):
+        pass
+
+    # Only raised by MongoDB servers, kept for the 'except' clauses
+    OperationFailure = PyMongoError
+
+    class DuplicateKeyError(PyMongoError):
+        pass
+
+    class BulkWriteError(PyMongoError):
+
+        def __init__(self, results):
+            PyMongoError.__init__(self, 'batch op errors occurred')
+            self.details = results
+
+    class Binary(str):
+        """
+        Binary data with a subtype as bson.binary.Binary
+        """
+
+        def __new__(cls, data, subtype=0):
+            self = str.__new__(cls, data)
+            self.subtype = subtype
+            return self
+
+    class ObjectId(object):
+        """
+        Identifier of 12 bytes with the format of bson.objectid.ObjectId: seconds since
+        the epoch (4 bytes), random value for the process (5 bytes) and counter (3 bytes)
+        """
+        _lock = Lock()
+        _counter = random.randint(0, 0xFFFFFF)
+        _pid = None
+        _random = None
+
+        def __init__(self, oid=None):
+            if oid is None:
+                self.binary = struct.pack('>I', int(time.time())) + self._next()
+            elif isinstance(oid, ObjectId):
+                self.binary = oid.binary
+            else:
+                try:
+                    self.binary = binascii.unhexlify(oid)
+                except TypeError:
+                    self.binary = None
+                if self.binary is None or len(self.binary) != 12:
+                    raise ValueError('%s is not a valid ObjectId' % str(oid))
+
+        @classmethod
+        def _next(cls):
+            with cls._lock:
+                if cls._pid != os.getpid():
+                    # Processes forked from the same parent must not generate the same identifiers
+                    cls._pid = os.getpid()
+                    cls._random = os.urandom(5)
+                cls._counter = (cls._counter + 1) % 0xFFFFFF
+                return cls._random + struct.pack('>I', cls._counter)[1:]
+
+        def __str__(self):
+            return binascii.hexlify(self.binary)
+
+        def __repr__(self):
+            return "ObjectId('%s')" % str(self)
+
+        def __eq__(self, other):
+            return isinstance(other, ObjectId) and self.binary == other.binary
+
+        def __ne__(self, other):
+            return not self == other
+
+        def __lt__(self, other):
+            # Lists of identifiers are sorted by the bytes, as the time of creation goes first
+            return self.binary < other.binary
+
+        def __hash__(self):
+            return hash(self.binary)
@@ -1,42 +1,126 @@
 __author__ = 'Guillermo Avendano Franco'
 
-from pymongo import MongoClient
-from bson.objectid import ObjectId
-import numpy as np
+import os
 import socket
+import time
+import uuid
+import numpy as np
+from fractions import gcd as _gcd
+from threading import Thread, Event
 
 from pychemia.utils.periodic import atomic_symbols
-from pychemia import Structure
+from pychemia import Structure, log
+from _compat import ObjectId
+from _client import get_client, client_options
+from _sqlite import get_sqlite_client
+from _notify import ChangeWatcher, modified_sections, revision_fields
+from _arrays import PackedArray, is_packed, encode_array, encode_properties, decode_arrays, is_array_property
+from _indexes import INDEXES, QUERIES, ensure_indexes, explain_query, check_queries, tag_index
+
+# Version of the fields stored with each entry, databases with an older version are
+# updated when they are opened, see PyChemiaDB.migrate
+SCHEMA_VERSION = 2
 
 
 class PyChemiaDB():
 
-    def __init__(self, name='pychemiadb', host='localhost', port=27017, user=None, password=None):
+    def __init__(self, name='pychemiadb', host='localhost', port=27017, user=None, password=None, options=None,
+                 backend='mongodb', path=None):
         """
-        Creates a MongoDB client to 'host' with 'port' and connect it to the database 'name'.
-        Authentication can be used with 'user' and 'password'
+        Connects to the database 'name' on the MongoDB server at 'host' with 'port'.
+        Authentication can be used with 'user' and 'password'.
+        The client is shared with the other databases opened by the same process
+        with the same server and options, see pychemia.db._client.get_client.
+        With backend='sqlite' the database is stored on the SQLite file 'path' without
+        any server, see pychemia.db._sqlite. Both backends support the same methods.
+        The indexes declared in pychemia.db._indexes.INDEXES are created if they do not exist
+        and the entries created by older versions are completed, see 'migrate'
 
         :param name: (str) The name of the database
         :param host: (str) The host as name or IP
         :param port: (int) The number of port to connect with the server (Default is 27017)
         :param user: (str) The user with read or write permissions to the database
         :param password: (str/int) Password to authenticate the user into the server
+        :param options: (dict) Options for the client such as pool size and timeouts,
+                        see pychemia.db._client.CLIENT_OPTIONS
+        :param backend: (str) Storage backend, 'mongodb' or 'sqlite'
+        :param path: (str) SQLite file for the 'sqlite' backend, by default '<name>.sqlite'
 
         :return:
         """
         self.name = name
-        uri = 'mongodb://'
-        if user is not None:
-            uri += user
-            if password is not None:
-                uri += ':'+str(password)
-            uri += '@'
-        uri += host + ':' + str(port)
-        if user is not None:
-            uri += '/' + name
-        self._client = MongoClient(uri)
+        self.backend = backend
+        if backend == 'mongodb':
+            uri = 'mongodb://'
+            if user is not None:
+                uri += user
+                if password is not None:
+                    uri += ':'+str(password)
+                uri += '@'
+            uri += host + ':' + str(port)
+            if user is not None:
+                uri += '/' + name
+            self._client = get_client(uri, options)
+        elif backend == 'sqlite':
+            if path is None:
+                path = name + '.sqlite'
+            self._client = get_sqlite_client(path)
+        else:
+            raise ValueError('Unknown backend: %s' % backend)
         self.db = self._client[name]
         self.entries = self.db.pychemia_entries
+        self.ensure_indexes()
+        self.migrate()
+
+    def ensure_indexes(self, patterns=None):
+        """
+        Create the indexes declared for the given access patterns, the operation is
+        idempotent and indexes already present are not rebuilt
+
+        :param patterns: (list) Names of access patterns on INDEXES, by default all of them
+        :return: (list) Names of the indexes
+        """
+        if patterns is None:
+            patterns = sorted(INDEXES)
+        indexes = []
+        for pattern in patterns:
+            indexes += INDEXES[pattern]
+        return ensure_indexes(self.entries, indexes)
+
+    def ensure_tag_index(self, tag):
+        """
+        Create the index for the queries on 'status.<tag>'
+
+        :param tag: (str) The tag used to mark the entries
+        :return: (list) Name of the index
+        """
+        return ensure_indexes(self.entries, [tag_index(tag)])
+
+    def explain(self, query, projection=None, sort=None):
+        """
+        Summary of the execution plan of a query on the entries,
+        see pychemia.db._indexes.explain_query
+
+        :param query: (dict) The query
+        :param projection: (dict) The projection
+        :param sort: (list) The sort as a list of (key, direction) pairs
+        :return: (dict)
+        """
+        return explain_query(self.entries, query, projection, sort)
+
+    def check_queries(self, queries=None, ratio=10, millis=100):
+        """
+        Explain the queries and report the slow ones on the log, by default the sample
+        queries declared for each access pattern are checked
+
+        :param queries: (dict) Queries identified by a name
+        :param ratio: (int) Maximal number of documents examined for each document returned
+        :param millis: (int) Maximal execution time in milliseconds
+        :return: (dict) Summary of the plan for each slow query
+        """
+        if queries is None:
+            queries = QUERIES
+        return check_queries(self.entries, queries, ratio=ratio, millis=millis)
 
     def insert(self, structure, properties=None, status=None):
         """
@@ -47,34 +131,180 @@ class PyChemiaDB():
         :param status: (dict) Dictionary of status
         :return:
         """
-        entry = {'structure': structure.to_dict(), 'properties': properties, 'status': status}
+        if properties is None:
+            properties = {}
+        if status is None:
+            status = {}
+        entry = prepare_fields({'structure': structure, 'properties': properties, 'status': status})
+        entry['created'] = self._reserve_revisions(1)
+        entry['revision'] = entry['created']
+        entry['revisions'] = {}
         entry_id = self.entries.insert(entry)
         return entry_id
 
+    def insert_many(self, structures, properties=None, statuses=None, ordered=True):
+        """
+        Insert several structures with their properties and status
+        using batched writes
+
+        :param structures: (list) List of pychemia Structures or their dictionaries
+        :param properties: (list) List of dictionaries of properties, one for each structure
+        :param statuses: (list) List of dictionaries of status, one for each structure
+        :param ordered: (bool) If True the documents are inserted serially and the insertion stops
+                        at the first error, otherwise the server can insert them in any order
+                        and continues after errors
+        :return: (list) The identifiers of the new entries
+        """
+        if properties is None:
+            properties = [{} for i in structures]
+        if statuses is None:
+            statuses = [{} for i in structures]
+        assert (len(properties) == len(structures))
+        assert (len(statuses) == len(structures))
+        if len(structures) == 0:
+            return []
+
+        bulk = self._bulk(ordered)
+        ret = []
+        revision = self._reserve_revisions(len(structures))
+        for structure, iproperties, istatus in zip(structures, properties, statuses):
+            entry_id = ObjectId()
+            if iproperties is None:
+                iproperties = {}
+            if istatus is None:
+                istatus = {}
+            entry = prepare_fields({'structure': structure, 'properties': iproperties, 'status': istatus})
+            entry['_id'] = entry_id
+            entry['created'] = revision
+            entry['revision'] = revision
+            entry['revisions'] = {}
+            revision += 1
+            bulk.insert(entry)
+            ret.append(entry_id)
+        bulk.execute()
+        return ret
+
+    def bulk_update(self, changes, ordered=True):
+        """
+        Apply partial changes to several entries using batched writes.
+        Each change is a tuple (entry_id, fields) where 'fields' is a dictionary
+        with the fields to set, for example {'status': status} or {'status.relaxation': 'succeed'}.
+        Structures given as pychemia Structures are converted into dictionaries
+
+        :param changes: (list) List of tuples (entry_id, fields)
+        :param ordered: (bool) If True the updates are applied serially and stop at the first error,
+                        otherwise the server can apply them in any order and continues after errors
+        :return: (dict) The result of the bulk operation
+        """
+        if len(changes) == 0:
+            return None
+        bulk = self._bulk(ordered)
+        revision = self._reserve_revisions(len([x for x in changes if len(modified_sections(x[1])) > 0]))
+        for entry_id, fields in changes:
+            fields = prepare_fields(fields)
+            sections = modified_sections(fields)
+            if len(sections) > 0:
+                fields.update(revision_fields(revision, sections))
+                revision += 1
+            bulk.find({'_id': object_id(entry_id)}).update_one({'$set': fields})
+        return bulk.execute()
+
+    def _reserve_revisions(self, number):
+        """
+        Increase the modification counter of the entries by 'number' and return the
+        first of the reserved values. Each write stamps the entries with its revision, see ChangeWatcher
+        """
+        if number == 0:
+            return None
+        counter = self.db.counters.find_and_modify(query={'_id': 'pychemia_entries'},
+                                                   update={'$inc': {'value': number}}, upsert=True, new=True)
+        return counter['value'] - number + 1
+
+    @property
+    def revision(self):
+        """
+        Current value of the modification counter of the entries
+        """
+        counter = self.db.counters.find_one({'_id': 'pychemia_entries'})
+        if counter is None:
+            return 0
+        return counter['value']
+
+    def watch(self, events=None, query=None, **kwargs):
+        """
+        Return a ChangeWatcher that delivers the changes on the entries from now on,
+        for example to wait until some entry receives new properties:
+
+        watcher = db.watch(events=['properties'])
+        events = watcher.wait(timeout=60)
+
+        :param events: (list) Types of events: 'insert', 'structure', 'properties' and 'status'
+        :param query: (dict) Only changes on entries matching the query are delivered
+        :param kwargs: Other arguments for ChangeWatcher
+        :return: (ChangeWatcher)
+        """
+        return ChangeWatcher(self, events=events, query=query, **kwargs)
+
+    def _bulk(self, ordered):
+        if ordered:
+            return self.entries.initialize_ordered_bulk_op()
+        else:
+            return self.entries.initialize_unordered_bulk_op()
+
     def clean(self):
         self._client.drop_database(self.name)
         self.db = self._client[self.name]
+        self.entries = self.db.pychemia_entries
+        self.ensure_indexes()
 
     def update(self, entry_id, structure=None, properties=None, status=None):
+        """
+        Replace the structure, properties and/or status of an entry.
+        Only the arguments different from None are sent to the database
 
-        entry_id = object_id(entry_id)
-
-        assert (self.entries.find_one({'_id': entry_id}) is not None)
-        entry = self.entries.find_one({'_id': entry_id})
+        :param entry_id: The database identifier of the entry
+        :param structure: (pychemia.Structure, dict) The new structure
+        :param properties: (dict) The new dictionary of properties
+        :param status: (dict) The new dictionary of status
+        """
+        fields = {}
         if structure is not None:
-            if isinstance(structure, Structure):
-                entry['structure'] = structure.to_dict()
-            elif isinstance(structure, dict):
-                entry['structure'] = structure
-            else:
-                print 'ERROR: Could not process the structure'
-                print type(structure)
+            fields['structure'] = _structure_dict(structure)
         if properties is not None:
-            entry['properties'] = properties
+            fields['properties'] = properties
         if status is not None:
-            entry['status'] = status
+            fields['status'] = status
+        self.update_fields(entry_id, fields)
 
-        self.entries.update({'_id': entry_id}, entry)
+    def update_fields(self, entry_id, fields=None, unset=None):
+        """
+        Partial update of one entry, only the given fields are changed on the server.
+        The composition and the maximal forces and stress are updated together with
+        the structure, forces and stress. Fields can be nested using the dot notation, for example:
+
+        db.update_fields(entry_id, fields={'status.relaxation': 'succeed'}, unset=['status.lock'])
+
+        :param entry_id: The database identifier of the entry
+        :param fields: (dict) Fields and values to set
+        :param unset: (list) Fields to remove
+        :return: (bool) True if the entry exists
+        """
+        entry_id = object_id(entry_id)
+        if fields is not None:
+            fields = prepare_fields(fields)
+        sections = modified_sections(list(fields or []) + list(unset or []))
+        if len(sections) > 0:
+            fields = dict(fields or {})
+            fields.update(revision_fields(self._reserve_revisions(1), sections))
+        operation = {}
+        if fields is not None and len(fields) > 0:
+            operation['$set'] = fields
+        if unset is not None and len(unset) > 0:
+            operation['$unset'] = {x: '' for x in unset}
+        if len(operation) == 0:
+            return self.entries.find_one({'_id': entry_id}, {'_id': 1}) is not None
+        ret = self.entries.update({'_id': entry_id}, operation)
+        return ret['n'] > 0
 
     def find_AnBm(self, specie_a=None, specie_b=None, n=1, m=1):
         """
@@ -100,18 +330,13 @@ class PyChemiaDB():
             number_unfixed = n
             assert (specie_b in atomic_symbols)
 
-        ret = []
-        for entry in self.entries.find({'nspecies': 2, 'formula': {'$regex': atom_fixed}}):
-            comp = Structure.from_dict(entry['structure']).get_composition()
-            if atom_fixed in comp.composition and comp.composition[atom_fixed] % number_fixed == 0:
-                species = comp.species
-                species.remove(atom_fixed)
-                other_specie = species[0]
-                # See if the fraction n/m is correct for A and B
-                if number_unfixed * float(comp.composition[atom_fixed]) == number_fixed * float(
-                        comp.composition[other_specie]):
-                    ret.append(entry['_id'])
-        return ret
+        # Reduced numbers for the fixed and unfixed species
+        common = _gcd(number_fixed, number_unfixed)
+        query = {'composition.nspecies': 2,
+                 'composition.elements': '%s:%d' % (atom_fixed, number_fixed / common),
+                 'composition.reduced_counts': sorted([number_fixed / common, number_unfixed / common]),
+                 'composition.gcd': {'$mod': [common, 0]}}
+        return [entry['_id'] for entry in self.entries.find(query, {'_id': 1})]
 
     def find_composition(self, composition):
         """
@@ -122,92 +347,535 @@ class PyChemiaDB():
         :return: (list) List of ids for all the structures that fulfill
                  the conditions
         """
-        ret = []
-        for entry in self.entries.find({'nspecies': len(composition)}):
-            comp = Structure.from_dict(entry['structure']).get_composition()
-            valid = True
-            if sum(comp.composition.values()) % sum(composition.values()) != 0:
-                valid = False
-            vect1 = np.float64(np.sort(comp.composition.values()))
-            vect2 = np.float64(np.sort(composition.values()))
-            v12 = vect1 / vect2
-            if not np.all(v12 == v12[0]):
-                valid = False
-            for ispecie in composition:
-                if ispecie in atomic_symbols and ispecie not in comp.species:
-                    valid = False
-
-            if valid:
-                print comp.composition
-                ret.append(entry['_id'])
+        common = reduce(_gcd, composition.values())
+        query = {'composition.nspecies': len(composition),
+                 'composition.reduced_counts': sorted([x / common for x in composition.values()]),
+                 'composition.gcd': {'$mod': [common, 0]}}
+        species = [x for x in composition if x in atomic_symbols]
+        if len(species) > 0:
+            query['composition.species'] = {'$all': species}
+        return [entry['_id'] for entry in self.entries.find(query, {'_id': 1})]
+
+    def migrate(self):
+        """
+        Compute the fields introduced by newer versions of PyChemia (composition, maximal
+        forces and stress) for the entries of a database created by an older version.
+        The version of the schema is stored on the database, so the entries are checked
+        only the first time the database is opened by this version
+
+        :return: (int) Number of entries updated
+        """
+        schema = self.db.counters.find_one({'_id': 'pychemia_schema'})
+        if schema is not None and schema.get('value', 0) >= SCHEMA_VERSION:
+            return 0
+        ret = self.update_compositions() + self.update_max_force_stress()
+        if ret > 0:
+            log.info('Database %s updated to schema version %d: %d entries' % (self.name, SCHEMA_VERSION, ret))
+        self.db.counters.update({'_id': 'pychemia_schema'}, {'$set': {'value': SCHEMA_VERSION}}, upsert=True)
+        return ret
+
+    def update_compositions(self, force=False):
+        """
+        Compute and store the composition fields for entries created
+        before those fields were introduced
+
+        :param force: (bool) If True the fields are recomputed for all the entries
+        :return: (int) Number of entries updated
+        """
+        if force:
+            query = {}
+        else:
+            query = {'composition': {'$exists': False}}
+        changes = []
+        ret = 0
+        for entry in self.entries.find(query, {'structure.symbols': 1}):
+            changes.append((entry['_id'], {'composition': composition_fields(entry['structure'])}))
+            ret += 1
+            if len(changes) == 1000:
+                self.bulk_update(changes, ordered=False)
+                changes = []
+        self.bulk_update(changes, ordered=False)
+        return ret
+
+    def update_max_force_stress(self, force=False):
+        """
+        Compute and store 'properties.max_force' and 'properties.max_stress' for
+        entries created before those fields were introduced
+
+        :param force: (bool) If True the fields are recomputed for all the entries
+        :return: (int) Number of entries updated
+        """
+        if force:
+            query = {}
+        else:
+            query = {'$or': [{'properties.max_force': {'$exists': False}},
+                             {'properties.max_stress': {'$exists': False}}]}
+        changes = []
+        ret = 0
+        for entry in self.entries.find(query, {'properties.forces': 1, 'properties.stress': 1}):
+            properties = entry.get('properties')
+            if properties is None:
+                # Entries without properties receive a new dictionary
+                changes.append((entry['_id'], {'properties': {'max_force': None, 'max_stress': None}}))
+            else:
+                changes.append((entry['_id'], {'properties.max_force': max_abs(properties.get('forces')),
+                                               'properties.max_stress': max_abs(properties.get('stress'))}))
+            ret += 1
+            if len(changes) == 1000:
+                self.bulk_update(changes, ordered=False)
+                changes = []
+        self.bulk_update(changes, ordered=False)
+        return ret
+
+    def find_evaluated(self, target_forces, query=None):
+        """
+        Identifiers of the entries with maximal forces and stress
+        lower than 'target_forces' using the precomputed maximal values
+
+        :param target_forces: (float) Threshold for forces and stress
+        :param query: (dict) Additional conditions for the entries
+        :return: (list) List of identifiers
+        """
+        return [entry['_id'] for entry in self.entries.find(self._evaluated_query(target_forces, query), {'_id': 1})]
+
+    def count_evaluated(self, target_forces, query=None):
+        """
+        Number of entries with maximal forces and stress lower than 'target_forces'
+
+        :param target_forces: (float) Threshold for forces and stress
+        :param query: (dict) Additional conditions for the entries
+        :return: (int)
+        """
+        return self.entries.find(self._evaluated_query(target_forces, query), {'_id': 1}).count()
+
+    @staticmethod
+    def _evaluated_query(target_forces, query):
+        ret = {'properties.max_force': {'$lt': target_forces},
+               'properties.max_stress': {'$lt': target_forces}}
+        if query is not None:
+            ret.update(query)
         return ret
 
     def get_structure(self, entry_id):
         entry_id = object_id(entry_id)
-        entry = self.entries.find_one({'_id': entry_id})
+        entry = self.entries.find_one({'_id': entry_id}, {'structure': 1})
         return Structure.from_dict(entry['structure'])
 
-    def get_dicts(self, entry_id):
+    def get_entry(self, entry_id, fields=None):
+        """
+        Return the document of one entry, if 'fields' is given only those fields
+        are transferred from the server
+
+        :param entry_id: The database identifier of the entry
+        :param fields: (list) Fields to retrieve, the dot notation can be used for nested fields
+        :return: (dict) The entry or None if the entry does not exist
+        """
         entry_id = object_id(entry_id)
-        entry = self.entries.find_one({'_id': entry_id})
-        structure_dict = entry['structure']
-        if 'properties' in entry:
-            properties = entry['properties']
+        if fields is None:
+            return decode_arrays(self.entries.find_one({'_id': entry_id}))
         else:
-            properties = None
-        if 'status' in entry:
-            status = entry['status']
+            return decode_arrays(self.entries.find_one({'_id': entry_id}, list(fields)))
+
+    def get_entries(self, entry_ids, fields=None):
+        """
+        Return the documents of several entries with a single query
+
+        :param entry_ids: (list) The database identifiers of the entries
+        :param fields: (list) Fields to retrieve, the dot notation can be used for nested fields
+        :return: (list) The entries found, in no particular order
+        """
+        query = {'_id': {'$in': [object_id(x) for x in entry_ids]}}
+        if fields is None:
+            return [decode_arrays(x) for x in self.entries.find(query)]
         else:
-            status = None
+            return [decode_arrays(x) for x in self.entries.find(query, list(fields))]
 
+    def get_properties(self, entry_id, fields=None):
+        """
+        Return the properties of an entry.
+        If 'fields' is given only those properties are transferred from the server,
+        for example: db.get_properties(entry_id, fields=['energy'])
+
+        :param entry_id: The database identifier of the entry
+        :param fields: (list) Names of the properties to retrieve
+        :return: (dict) The properties or None if the entry has no properties
+        """
+        return self._get_subdocument(entry_id, 'properties', fields)
+
+    def get_status(self, entry_id, fields=None):
+        """
+        Return the status of an entry.
+        If 'fields' is given only those keys are transferred from the server
+
+        :param entry_id: The database identifier of the entry
+        :param fields: (list) Names of the status keys to retrieve
+        :return: (dict) The status or None if the entry has no status
+        """
+        return self._get_subdocument(entry_id, 'status', fields)
+
+    def _get_subdocument(self, entry_id, name, fields):
+        if fields is None:
+            projection = [name]
+        else:
+            projection = [name + '.' + x for x in fields]
+        entry = self.get_entry(entry_id, projection)
+        if entry is None:
+            return None
+        return entry.get(name)
+
+    def get_dicts(self, entry_id, fields=None):
+        """
+        Return the structure, properties and status of an entry as dictionaries
+
+        :param entry_id: The database identifier of the entry
+        :param fields: (list) Fields to retrieve, by default 'structure', 'properties' and 'status'
+        :return: (tuple) structure, properties and status, None for fields not present or not requested
+        """
+        if fields is None:
+            fields = ['structure', 'properties', 'status']
+        entry = self.get_entry(entry_id, fields)
+        structure_dict = entry.get('structure')
+        properties = entry.get('properties')
+        status = entry.get('status')
         return structure_dict, properties, status
 
-    def is_locked(self, entry_id):
+    def set_fingerprint(self, entry_id, fingerprint):
+        """
+        Store the fingerprint for a given entry in the 'fingerprints' collection
+        Arrays packed with pychemia.serializer.pack_array are stored as BSON binary data
+
+        :param entry_id: The database identifier of the entry
+        :param fingerprint: (dict) The fingerprint, usually from CompressedFingerprint
+        """
+        entry_id = object_id(entry_id)
+        fingerprint = _binary_arrays(fingerprint)
+        fingerprint['_id'] = entry_id
+        self.db.fingerprints.update({'_id': entry_id}, fingerprint, upsert=True)
 
+    def get_fingerprint(self, entry_id):
         entry_id = object_id(entry_id)
-        entry = self.entries.find_one({'_id': entry_id})
+        return self.db.fingerprints.find_one({'_id': entry_id})
 
-        if 'status' in entry and 'lock' in entry['status']:
-            return True
+    def is_locked(self, entry_id):
+        """
+        True if the entry is locked and the lease of the lock has not expired.
+        Locks created without lease never expire
+
+        :param entry_id: The database identifier of the entry
+        :return: (bool)
+        """
+        status = self.get_status(entry_id, ['lock', 'lease'])
+        if status is not None and 'lock' in status:
+            return 'lease' not in status or status['lease'] > time.time()
         else:
             return False
 
-    def lock(self, entry_id):
-        entry_id = object_id(entry_id)
-        structure, properties, status = self.get_dicts(entry_id)
-        status['lock'] = socket.gethostname()
-        self.update(entry_id, status=status)
+    def lock(self, entry_id, name=None, lease=None):
+        """
+        Atomically lock an entry, see 'claim'
+
+        :return: (bool) True if the lock was acquired
+        """
+        return self.claim(entry_id, name=name, lease=lease)
 
     def unlock(self, entry_id, name=None):
-        entry_id = object_id(entry_id)
-        structure, properties, status = self.get_dicts(entry_id)
-        lockedby = None
-        if 'lock' in status:
-            if name is None:
-                lockedby = status.pop('lock')
-            elif status['lock'] == name:
-                lockedby = status.pop('lock')
-        self.update(entry_id, status=status)
-        return lockedby
+        """
+        Atomically remove the lock of an entry. If 'name' is given the
+        lock is only removed if it is owned by 'name'
+
+        :param entry_id: The database identifier of the entry
+        :param name: (str) Owner of the lock
+        :return: (str) The owner of the removed lock or None if no lock was removed
+        """
+        query = {'_id': object_id(entry_id)}
+        if name is None:
+            query['status.lock'] = {'$exists': True}
+        else:
+            query['status.lock'] = name
+        entry = self.entries.find_and_modify(query=query, update={'$unset': {'status.lock': '', 'status.lease': ''}},
+                                             fields={'status.lock': 1})
+        if entry is None:
+            return None
+        return entry['status']['lock']
+
+    def unlock_all(self, name=None):
+        """
+        Remove the locks of all the entries, if 'name' is given only the locks
+        owned by 'name' are removed
+
+        :param name: (str) Owner of the locks
+        :return: (int) Number of entries unlocked
+        """
+        if name is None:
+            query = {'status.lock': {'$exists': True}}
+        else:
+            query = {'status.lock': name}
+        ret = self.entries.update(query, {'$unset': {'status.lock': '', 'status.lease': ''}}, multi=True)
+        return ret['n']
+
+    def claim(self, entry_id, name=None, lease=None):
+        """
+        Atomically lock an entry if it is not locked or if the lease of its lock has expired.
+        The test and the lock happen in a single find-and-modify operation on the server,
+        so two clients cannot claim the same entry
+
+        :param entry_id: The database identifier of the entry
+        :param name: (str) Owner of the lock, by default 'lock_owner()'
+        :param lease: (float) Seconds before the lock expires if it is not renewed,
+                      if None the lock never expires
+        :return: (bool) True if the entry was claimed
+        """
+        query = {'_id': object_id(entry_id)}
+        query.update(_claimable())
+        return self.entries.find_and_modify(query=query, update=_lock_update(name, lease),
+                                            fields={'_id': 1}) is not None
+
+    def claim_next(self, number=1, query=None, name=None, lease=None, sort=None):
+        """
+        Atomically claim up to 'number' entries that match 'query' and are not locked.
+        Many clients can call this method concurrently and each entry is
+        returned to only one of them
+
+        :param number: (int) Maximal number of entries to claim
+        :param query: (dict) Additional conditions for the entries
+        :param name: (str) Owner of the locks, by default 'lock_owner()'
+        :param lease: (float) Seconds before the locks expire if they are not renewed
+        :param sort: (list) Order of preference as a list of (key, direction) pairs
+        :return: (list) Identifiers of the entries claimed
+        """
+        if query is None:
+            query = {}
+        full_query = {'$and': [query, _claimable()]}
+        ret = []
+        for i in range(number):
+            entry = self.entries.find_and_modify(query=full_query, update=_lock_update(name, lease),
+                                                 fields={'_id': 1}, sort=sort)
+            if entry is None:
+                break
+            ret.append(entry['_id'])
+        return ret
+
+    def renew(self, entry_id, name=None, lease=3600):
+        """
+        Extend the lease of a lock owned by 'name'
+
+        :param entry_id: The database identifier of the entry
+        :param name: (str) Owner of the lock, by default 'lock_owner()'
+        :param lease: (float) New duration of the lease in seconds counted from now
+        :return: (bool) True if the lock is still owned by 'name' and was renewed
+        """
+        if name is None:
+            name = lock_owner()
+        ret = self.entries.update({'_id': object_id(entry_id), 'status.lock': name},
+                                  {'$set': {'status.lease': time.time() + lease}})
+        return ret['n'] > 0
+
+
+class LeaseHeartbeat(Thread):
+    """
+    Background thread that renews periodically the lease of a lock
+    while a long task is running on the locked entry
+    """
+
+    def __init__(self, db, entry_id, name=None, lease=3600, interval=None):
+        """
+        :param db: (PyChemiaDB) The database
+        :param entry_id: The database identifier of the locked entry
+        :param name: (str) Owner of the lock, by default 'lock_owner()'
+        :param lease: (float) Duration of the lease in seconds
+        :param interval: (float) Seconds between renewals, by default a third of the lease
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.db = db
+        self.entry_id = entry_id
+        self.owner = name
+        self.lease = lease
+        if interval is None:
+            interval = lease / 3.0
+        self.interval = interval
+        self._stop_event = Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            if not self.db.renew(self.entry_id, name=self.owner, lease=self.lease):
+                log.error('Lock lost for entry %s' % str(self.entry_id))
+                break
+
+    def stop(self):
+        self._stop_event.set()
 
 
 def get_database(db_settings):
+    """
+    Open a database from a dictionary of settings, the keys are 'name', 'host', 'port',
+    'user' and 'password' and optionally the options of the client such as
+    'max_pool_size' or 'socket_timeout_ms' (see pychemia.db._client.CLIENT_OPTIONS).
+    Databases opened on the same process share a single pooled client.
+    For a local database without server use the keys 'name', 'backend' with value 'sqlite'
+    and optionally 'path'
+
+    :param db_settings: (dict) Database settings
+    :return: (PyChemiaDB)
+    """
+    if db_settings.get('backend', 'mongodb') == 'sqlite':
+        return PyChemiaDB(name=db_settings['name'], backend='sqlite', path=db_settings.get('path'))
 
     if 'host' not in db_settings:
         db_settings['host'] = 'localhost'
     if 'port' not in db_settings:
         db_settings['port'] = 27017
 
+    options = client_options(db_settings)
     if 'user' not in db_settings:
-        db = PyChemiaDB(name=db_settings['name'], host=db_settings['host'], port=db_settings['port'])
+        db = PyChemiaDB(name=db_settings['name'], host=db_settings['host'], port=db_settings['port'],
+                        options=options)
     else:
         db = PyChemiaDB(name=db_settings['name'], host=db_settings['host'], port=db_settings['port'],
-                        user=db_settings['user'], password=db_settings['password'])
+                        user=db_settings['user'], password=db_settings['password'], options=options)
     return db
 
 
+def composition_fields(structure_dict):
+    """
+    Normalized composition of a structure stored with each entry to allow
+    indexed composition queries on the server:
+
+    species: Sorted list of atomic symbols
+    counts: Number of atoms for each specie
+    gcd: Greatest common divisor of the counts
+    reduced_counts: Counts divided by gcd, sorted in increasing order
+    elements: List of strings 'symbol:reduced_count'
+    nspecies: Number of species
+    natom: Number of atoms
+
+    :param structure_dict: (dict) A structure as dictionary
+    :return: (dict)
+    """
+    counts = {}
+    for symbol in structure_dict['symbols']:
+        counts[symbol] = counts.get(symbol, 0) + 1
+    species = sorted(counts)
+    if len(species) > 0:
+        common = reduce(_gcd, counts.values())
+    else:
+        common = 1
+    return {'species': species,
+            'counts': [counts[x] for x in species],
+            'gcd': common,
+            'reduced_counts': sorted([counts[x] / common for x in species]),
+            'elements': ['%s:%d' % (x, counts[x] / common) for x in species],
+            'nspecies': len(species),
+            'natom': sum(counts.values())}
+
+
+def max_abs(value):
+    """
+    Maximal absolute value of a list of numbers (possibly nested) or of a numeric array
+
+    :param value: (list, numpy.ndarray, PackedArray) Values, for example the forces or the stress
+    :return: (float) None if the value is None or empty
+    """
+    if value is None:
+        return None
+    if is_packed(value):
+        value = PackedArray(value)
+    if isinstance(value, PackedArray):
+        return value.max_abs()
+    array = np.abs(np.array(value, dtype=float).flatten())
+    if len(array) == 0:
+        return None
+    return float(np.max(array))
+
+
+# Precomputed scalars stored with the entries for fast queries on the evaluation status
+_MAX_FIELDS = {'forces': 'max_force', 'stress': 'max_stress'}
+
+
+def prepare_fields(fields):
+    """
+    Returns a copy of the fields to write on an entry, structures are converted into
+    dictionaries and the derived fields are added: the composition for the structure and
+    the maximal absolute values for the forces and stress on the properties.
+    Numeric arrays on the properties are encoded as binary arrays, see pychemia.db._arrays
+    """
+    ret = dict(fields)
+    if 'structure' in ret:
+        ret['structure'] = _structure_dict(ret['structure'])
+        ret['composition'] = composition_fields(ret['structure'])
+    if isinstance(ret.get('properties'), dict):
+        ret['properties'] = dict(ret['properties'])
+        for name in _MAX_FIELDS:
+            if name in ret['properties']:
+                ret['properties'][_MAX_FIELDS[name]] = max_abs(ret['properties'][name])
+        ret['properties'] = encode_properties(ret['properties'])
+    for name in _MAX_FIELDS:
+        if 'properties.' + name in ret:
+            ret['properties.' + _MAX_FIELDS[name]] = max_abs(ret['properties.' + name])
+    for key in ret:
+        if key.startswith('properties.') and is_array_property(key[len('properties.'):], ret[key]):
+            ret[key] = encode_array(ret[key])
+    return ret
+
+
+def _claimable():
+    """
+    Query for entries not locked or with an expired lease
+    """
+    return {'$or': [{'status.lock': {'$exists': False}}, {'status.lease': {'$lt': time.time()}}]}
+
+
+# Default owner of the locks for each process, see 'lock_owner'
+_owners = {}
+
+
+def lock_owner():
+    """
+    Default owner of the locks created by this process, 'hostname:pid:random'.
+    Each process has its own owner, also the processes on the same host and the
+    children forked from a process, so a worker cannot renew or remove the locks of another
+
+    :return: (str)
+    """
+    pid = os.getpid()
+    if pid not in _owners:
+        _owners[pid] = '%s:%d:%s' % (socket.gethostname(), pid, uuid.uuid4().hex[:8])
+    return _owners[pid]
+
+
+def _lock_update(name, lease):
+    if name is None:
+        name = lock_owner()
+    if lease is None:
+        return {'$set': {'status.lock': name}, '$unset': {'status.lease': ''}}
+    else:
+        return {'$set': {'status.lock': name, 'status.lease': time.time() + lease}}
+
+
+def _structure_dict(structure):
+    if isinstance(structure, Structure):
+        return structure.to_dict()
+    elif isinstance(structure, dict):
+        return structure
+    else:
+        raise ValueError('Could not process the structure: %s' % str(type(structure)))
+
+
 def object_id(entry_id):
     if isinstance(entry_id, basestring):
         return ObjectId(entry_id)
     elif isinstance(entry_id, ObjectId):
-        return entry_id
\ No newline at end of file
+        return entry_id
+
+
+def _binary_arrays(value):
+    """
+    Returns a copy of 'value' where the data of arrays packed with
+    pychemia.serializer.pack_array is wrapped as BSON binary
+    """
+    if isinstance(value, dict):
+        if is_packed(value):
+            return encode_array(value)
+        return {key: _binary_arrays(value[key]) for key in value}
+    else:
+        return value
@@ -0,0 +1,172 @@
+"""
+Declaration of the indexes required by the queries on PyChemiaDB entries
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+from pychemia import log
+from _compat import IndexModel, OperationFailure
+
+# Direction of the keys of the indexes, the value of pymongo.ASCENDING
+ASCENDING = 1
+
+# Indexes required for each access pattern on the 'pychemia_entries' collection
+# Each index is a list of (field, direction) pairs. Each clause of the '$or' used by the
+# evaluators to claim pending entries needs an index starting with its field, and
+# 'composition.natom' is the sort of those claims
+INDEXES = {'composition': [[('composition.species', ASCENDING)],
+                           [('composition.elements', ASCENDING)],
+                           [('composition.reduced_counts', ASCENDING)],
+                           [('composition.nspecies', ASCENDING)],
+                           [('composition.gcd', ASCENDING)]],
+           'locks': [[('status.lock', ASCENDING)],
+                     [('status.lease', ASCENDING)]],
+           'evaluation': [[('status.relaxation', ASCENDING)],
+                          [('properties.max_force', ASCENDING), ('properties.max_stress', ASCENDING)],
+                          [('properties.max_stress', ASCENDING)],
+                          [('composition.natom', ASCENDING)]],
+           'formula': [[('structure.formula', ASCENDING), ('structure.natom', ASCENDING)]],
+           'changes': [[('revision', ASCENDING)], [('created', ASCENDING)]]}
+
+# Sample queries for each access pattern, used by 'check_queries'
+QUERIES = {'composition': {'composition.nspecies': 2, 'composition.elements': 'H:1'},
+           'locks': {'status.lock': {'$exists': True}},
+           'evaluation': {'properties.max_force': {'$lt': 1E-3}, 'properties.max_stress': {'$lt': 1E-3}},
+           'pending': {'$or': [{'properties.max_force': {'$gte': 1E-3}}, {'properties.max_stress': {'$gte': 1E-3}},
+                               {'properties.max_force': None}, {'properties.max_stress': None}],
+                       'status.relaxation': {'$ne': 'failed'}},
+           'formula': {'structure.formula': 'H2', 'structure.natom': {'$gte': 2, '$lte': 8}},
+           'changes': {'revision': {'$gt': 0}}}
+
+
+def tag_index(tag):
+    """
+    Index for the queries on the boolean 'status.<tag>' used by populations
+    to mark their active members, the maximal forces and stress are included
+    for the queries on active members already evaluated
+
+    :param tag: (str) The tag of the population
+    :return: (list) The index as a list of (field, direction) pairs
+    """
+    return [('status.' + tag, ASCENDING), ('properties.max_force', ASCENDING), ('properties.max_stress', ASCENDING)]
+
+
+def ensure_indexes(collection, indexes):
+    """
+    Create the given indexes on a collection. The operation is idempotent,
+    indexes that already exist are not created again and all of them are sent to
+    the server on a single command
+
+    :param collection: (pymongo.Collection) The collection
+    :param indexes: (list) Indexes as lists of (field, direction) pairs
+    :return: (list) Names of the indexes
+    """
+    if len(indexes) == 0:
+        return []
+    if IndexModel is None:
+        # Without pymongo the collection is on the sqlite backend, the indexes are created one by one
+        return [collection.create_index(keys) for keys in indexes]
+    return collection.create_indexes([IndexModel(keys) for keys in indexes])
+
+
+def explain_query(collection, query, projection=None, sort=None):
+    """
+    Summary of the execution plan of a query as returned by explain()
+
+    :param collection: (pymongo.Collection) The collection
+    :param query: (dict) The query
+    :param projection: (dict) The projection
+    :param sort: (list) The sort as a list of (key, direction) pairs
+    :return: (dict) With the keys:
+             'index': Name of the index used or None if the whole collection is scanned
+             'returned': Number of documents returned
+             'docs_examined': Number of documents examined
+             'keys_examined': Number of index keys examined
+             'millis': Execution time in milliseconds
+    """
+    cursor = collection.find(query, projection)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    plan = cursor.explain()
+
+    if 'queryPlanner' in plan:
+        stats = plan.get('executionStats', {})
+        ret = {'index': _plan_index(plan['queryPlanner']['winningPlan']),
+               'returned': stats.get('nReturned'),
+               'docs_examined': stats.get('totalDocsExamined'),
+               'keys_examined': stats.get('totalKeysExamined'),
+               'millis': stats.get('executionTimeMillis')}
+    else:
+        # Format used by MongoDB servers before 3.0
+        if plan['cursor'].startswith('BtreeCursor'):
+            index = plan['cursor'].split()[1]
+        else:
+            index = None
+        ret = {'index': index,
+               'returned': plan.get('n'),
+               'docs_examined': plan.get('nscannedObjects'),
+               'keys_examined': plan.get('nscanned'),
+               'millis': plan.get('millis')}
+    return ret
+
+
+def is_slow(explanation, ratio=10, millis=100):
+    """
+    A query is considered slow if it scans the whole collection, if it examines more
+    than 'ratio' documents for each document returned or if it takes more than 'millis'
+
+    :param explanation: (dict) Summary of the plan as returned by 'explain_query'
+    :param ratio: (int) Maximal number of documents examined for each document returned
+    :param millis: (int) Maximal execution time in milliseconds
+    :return: (bool)
+    """
+    examined = explanation['docs_examined']
+    returned = explanation['returned']
+    if explanation['index'] is None and examined > 0:
+        return True
+    if examined is not None and returned is not None and examined > ratio * max(returned, 1):
+        return True
+    if explanation['millis'] is not None and explanation['millis'] > millis:
+        return True
+    return False
+
+
+def check_queries(collection, queries, ratio=10, millis=100):
+    """
+    Explain a set of queries and log a warning for the slow ones
+
+    :param collection: (pymongo.Collection) The collection
+    :param queries: (dict) Queries identified by a name
+    :param ratio: (int) See 'is_slow'
+    :param millis: (int) See 'is_slow'
+    :return: (dict) Summary of the plan for each slow query
+    """
+    ret = {}
+    for name in queries:
+        try:
+            explanation = explain_query(collection, queries[name])
+        except OperationFailure as exc:
+            log.error('Could not explain query %s: %s' % (name, str(exc)))
+            continue
+        if is_slow(explanation, ratio=ratio, millis=millis):
+            log.warning('Slow query %s on %s: %s' % (name, collection.full_name, str(explanation)))
+            ret[name] = explanation
+    return ret
+
+
+def _plan_index(stage):
+    """
+    Name of the first index found on a winning plan, None if there is no IXSCAN stage
+    """
+    if stage.get('stage') == 'IXSCAN':
+        return stage.get('indexName')
+    children = []
+    if 'inputStage' in stage:
+        children.append(stage['inputStage'])
+    if 'inputStages' in stage:
+        children += stage['inputStages']
+    for child in children:
+        index = _plan_index(child)
+        if index is not None:
+            return index
+    return None
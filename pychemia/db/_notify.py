@@ -0,0 +1,301 @@
+"""
+Notifications of changes on the entries of a PyChemiaDB
+
+The revisions that stamp the writes come from a single counter document on the database
+('pychemia_entries' on the 'counters' collection). Each write reserves its revisions with
+one find_and_modify on that document before writing the entries, so all the writers of a
+database are serialized on the counter for the duration of that operation. Batched writes
+(insert_many, bulk_update) reserve all the revisions of the batch at once and should be
+preferred when many entries are written
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import time
+from threading import Thread, Event
+
+from pychemia import log
+from _compat import OperationFailure, PyMongoError
+from _sqlite import match
+
+# Types of events, 'insert' for new entries and the name of the section changed for updates
+EVENTS = ['insert', 'structure', 'properties', 'status']
+
+# Fields of status changed by locks and leases, they do not produce events
+_LOCK_FIELDS = ['status.lock', 'status.lease']
+
+
+def modified_sections(fields):
+    """
+    Sections of an entry ('structure', 'properties' or 'status') changed by writing
+    the given fields, changes on locks and leases are ignored
+
+    :param fields: (list) Names of the fields written, the dot notation can be used for nested fields
+    :return: (list) Sorted list of sections
+    """
+    ret = set()
+    for field in fields:
+        if field in _LOCK_FIELDS:
+            continue
+        section = field.split('.')[0]
+        if section in EVENTS:
+            ret.add(section)
+    return sorted(ret)
+
+
+def revision_fields(revision, sections):
+    """
+    Fields that stamp a write with its revision, the last revision of the entry on 'revision'
+    and the last revision of each section changed on 'revisions.<section>'
+
+    :param revision: (int) The revision reserved for the write
+    :param sections: (list) Sections changed by the write, see 'modified_sections'
+    :return: (dict)
+    """
+    ret = {'revision': revision}
+    for section in sections:
+        ret['revisions.' + section] = revision
+    return ret
+
+
+class ChangeWatcher():
+    """
+    Delivers events for the entries inserted or changed on a PyChemiaDB.
+    Each event is a dictionary with keys 'event' (one of EVENTS), 'entry_id' and 'revision'
+
+    MongoDB change streams are used when the server supports them (replica sets),
+    otherwise the watcher polls the database for entries with a 'created' or 'revision'
+    larger than the last one seen. Every write made by PyChemiaDB stamps the entries with a
+    new value of a counter stored on the database ('created' for insertions, 'revision' for
+    updates and 'revisions.<section>' for each section changed), so each poll is an indexed
+    range query that only returns the entries changed since the previous one. Several updates
+    on the same entry between two polls are delivered as a single event for each section changed.
+
+    Revisions are reserved before the write, so a write could become visible after another
+    with a larger revision. The revisions skipped by a poll are gaps, the next polls look
+    back to the oldest gap to recover those changes, events already delivered are not repeated.
+    A gap is forgotten after 'gap_timeout' seconds or when it is more than 'lookback' revisions
+    behind the last one: the revision was overwritten by a later write on the same entry, the
+    write did not match any entry or the entry does not match the query of the watcher.
+    Without gaps each poll only reads the entries changed after the last revision seen
+    """
+
+    def __init__(self, db, events=None, query=None, poll_interval=1.0, lookback=1000, start=None,
+                 change_streams=True, gap_timeout=5.0):
+        """
+        :param db: (PyChemiaDB) The database
+        :param events: (list) Types of events to deliver, by default all of them
+        :param query: (dict) Only changes on entries matching the query are delivered
+        :param poll_interval: (float) Seconds between polls of the database
+        :param lookback: (int) Maximal number of revisions checked again to recover gaps
+        :param start: (int) Deliver the changes after this revision, by default only future changes
+        :param change_streams: (bool) Use MongoDB change streams when the server supports them
+        :param gap_timeout: (float) Seconds a revision skipped by a poll is checked again
+        """
+        if events is None:
+            events = list(EVENTS)
+        for event in events:
+            if event not in EVENTS:
+                raise ValueError('Unknown event: %s' % event)
+        self.db = db
+        self.events = events
+        self.query = query
+        self.poll_interval = poll_interval
+        self.lookback = lookback
+        self.gap_timeout = gap_timeout
+        if start is None:
+            start = db.revision
+        self.first = start
+        self.last = start
+        self._delivered = set()
+        # Revisions skipped by the polls and the time they were seen missing
+        self._gaps = {}
+        self._subscribers = []
+        self._thread = None
+        self._stop_event = Event()
+        self._stream = None
+        if change_streams and db.backend == 'mongodb':
+            self._stream = self._open_stream()
+
+    def _open_stream(self):
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        kwargs = {'max_await_time_ms': int(1000 * self.poll_interval)}
+        if self.query is not None:
+            kwargs['full_document'] = 'updateLookup'
+        try:
+            return self.db.entries.watch(pipeline, **kwargs)
+        except (AttributeError, OperationFailure, PyMongoError) as exc:
+            log.debug('Change streams not available, polling for changes: %s' % str(exc))
+            return None
+
+    @property
+    def uses_change_streams(self):
+        return self._stream is not None
+
+    def poll(self):
+        """
+        Events available now, this method does not block
+
+        :return: (list) List of events
+        """
+        if self._stream is not None:
+            return self._poll_stream()
+        return self._poll_revisions()
+
+    def _poll_revisions(self):
+        now = time.time()
+        self._gaps = dict([(x, self._gaps[x]) for x in self._gaps
+                           if now - self._gaps[x] < self.gap_timeout and x > self.last - self.lookback])
+        if len(self._gaps) > 0:
+            since = max(self.first, min(self._gaps) - 1)
+        else:
+            since = self.last
+        previous = self.last
+        seen = set()
+        query = {'$or': [{'created': {'$gt': since}}, {'revision': {'$gt': since}}]}
+        if self.query is not None:
+            query = {'$and': [query, self.query]}
+        ret = []
+        projection = {'created': 1, 'revision': 1, 'revisions': 1, 'modified': 1}
+        for entry in self.db.entries.find(query, projection).sort('revision', 1):
+            seen.add(entry['revision'])
+            changes = []
+            if entry.get('created', 0) > since:
+                changes.append((entry['created'], 'insert'))
+            if entry.get('revisions') is not None:
+                for section in sorted(entry['revisions']):
+                    changes.append((entry['revisions'][section], section))
+            elif entry['revision'] != entry.get('created'):
+                # Entries written before the revisions by section only keep the sections of the last write
+                for section in entry.get('modified', []):
+                    changes.append((entry['revision'], section))
+            for revision, event in changes:
+                seen.add(revision)
+                if revision <= since or (revision, event) in self._delivered:
+                    continue
+                self._delivered.add((revision, event))
+                self.last = max(self.last, revision)
+                if event in self.events:
+                    ret.append({'event': event, 'entry_id': entry['_id'], 'revision': revision})
+        for revision in range(max(previous, self.last - self.lookback) + 1, self.last + 1):
+            if revision not in seen and revision not in self._gaps:
+                self._gaps[revision] = now
+        for revision in seen:
+            self._gaps.pop(revision, None)
+        # Only the events after the oldest gap could be read again
+        if len(self._gaps) > 0:
+            oldest = min(self._gaps)
+        else:
+            oldest = self.last
+        self._delivered = set([x for x in self._delivered if x[0] > oldest])
+        return ret
+
+    def _poll_stream(self):
+        ret = []
+        while True:
+            try:
+                change = self._stream.try_next()
+            except (AttributeError, OperationFailure, PyMongoError) as exc:
+                # The stream is lost (or try_next is not supported by this pymongo), the changes
+                # after the last revision received are recovered by polling the revisions
+                log.debug('Change stream closed, polling for changes: %s' % str(exc))
+                try:
+                    self._stream.close()
+                except PyMongoError:
+                    pass
+                self._stream = None
+                return ret + self._poll_revisions()
+            if change is None:
+                break
+            if self.query is not None and (change.get('fullDocument') is None or
+                                           not match(change['fullDocument'], self.query)):
+                continue
+            if change['operationType'] == 'insert':
+                sections = ['insert']
+            elif change['operationType'] == 'replace':
+                sections = ['structure', 'properties', 'status']
+            else:
+                description = change['updateDescription']
+                sections = modified_sections(list(description['updatedFields']) + list(description['removedFields']))
+            revision = None
+            if change.get('fullDocument') is not None:
+                revision = change['fullDocument'].get('revision')
+            elif change['operationType'] == 'update':
+                revision = change['updateDescription']['updatedFields'].get('revision')
+            if revision is not None:
+                self.last = max(self.last, revision)
+                self._delivered = set([x for x in self._delivered if x[0] > self.last - self.lookback])
+            for event in sections:
+                if revision is not None:
+                    self._delivered.add((revision, event))
+                if event in self.events:
+                    ret.append({'event': event, 'entry_id': change['documentKey']['_id'], 'revision': revision})
+        return ret
+
+    def wait(self, timeout=None):
+        """
+        Block until there are events or 'timeout' seconds have passed
+
+        :param timeout: (float) Maximal time to wait in seconds, None to wait forever
+        :return: (list) List of events, empty if the timeout was reached
+        """
+        start = time.time()
+        while True:
+            events = self.poll()
+            if len(events) > 0:
+                return events
+            if timeout is not None and time.time() - start >= timeout:
+                return []
+            if self._stream is None:
+                if timeout is None:
+                    sleep = self.poll_interval
+                else:
+                    sleep = max(0.0, min(self.poll_interval, timeout - (time.time() - start)))
+                if self._stop_event.wait(sleep):
+                    return []
+
+    def subscribe(self, callback, events=None):
+        """
+        Register a function called for each event, callbacks are executed by the
+        thread created with 'start'
+
+        :param callback: (function) Function with a single argument, the event
+        :param events: (list) Types of events for this callback, by default all the events of the watcher
+        """
+        self._subscribers.append((callback, events))
+
+    def dispatch(self, timeout=None):
+        """
+        Wait for events and deliver them to the subscribers
+
+        :param timeout: (float) Maximal time to wait in seconds
+        :return: (int) Number of events received
+        """
+        events = self.wait(timeout)
+        for event in events:
+            for callback, callback_events in self._subscribers:
+                if callback_events is None or event['event'] in callback_events:
+                    callback(event)
+        return len(events)
+
+    def start(self):
+        """
+        Deliver the events to the subscribers from a background thread
+        """
+        def worker():
+            while not self._stop_event.is_set():
+                self.dispatch(timeout=self.poll_interval)
+
+        self._stop_event.clear()
+        self._thread = Thread(target=worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
@@ -10,15 +10,18 @@ the StructureEntry object
 Also each calculation has it own metadata accessible by ExecutionEntry
 object
 """
-import hashlib
 import json as _json
 import os
 import uuid as _uuid
 import shutil as _shutil
-import math
+from contextlib import contextmanager
+from threading import RLock
+from multiprocessing import Pool
 
 from pychemia.core.structure import load_structure_json
 from pychemia.utils.computing import unicode2string
+from _repo_index import RepositoryIndex, same_structure
+from _blobs import BlobStore, hash_file
 
 
 class StructureEntry():
@@ -39,6 +42,7 @@ class StructureEntry():
         tags: (string or list) Tags that will be associated to that structure
         """
         self.properties = None
+        self.originals = []
 
         if identifier is None:
             self.structure = structure
@@ -86,7 +90,8 @@ class StructureEntry():
     def metadatatodict(self):
         ret = {'tags': self.tags,
                'parents': self.parents,
-               'children': self.children}
+               'children': self.children,
+               'originals': self.originals}
         return ret
 
     def load(self):
@@ -112,30 +117,39 @@ class StructureEntry():
         self.load_originals()
 
     def load_originals(self):
+        """
+        Set 'original_file' with the paths to the original files, the files on the BlobStore
+        could be compressed, use repository.blobs.open(hash) to read them
+        """
         orig_dir = self.path + '/original'
         if os.path.isdir(orig_dir):
             self.original_file = [os.path.abspath(orig_dir + '/' + x) for x in os.listdir(orig_dir)]
         else:
             self.original_file = []
+        for iorig in self.originals:
+            filename = self.repository.blobs.blob_path(iorig['hash'])
+            if filename is not None:
+                self.original_file.append(filename)
 
     def save(self):
         if self.path is None:
             self.path = self.repository.path + '/' + self.identifier
-        wf = open(self.path + '/metadata.json', 'w')
-        _json.dump(self.metadatatodict(), wf, sort_keys=True, indent=4, separators=(',', ': '))
-        wf.close()
-        self.structure.save_json(self.path + '/structure.json')
+        # Files are replaced and never modified in place, they could be hard linked from other repository
+        _write_json(self.structure.to_dict(), self.path + '/structure.json')
         if self.properties is not None:
-            wf = open(self.path + '/properties.json', 'w')
-            _json.dump(self.properties, wf, sort_keys=True, indent=4, separators=(',', ': '))
-            wf.close()
+            _write_json(self.properties, self.path + '/properties.json')
         if self.original_file is not None:
             self.add_original_file(self.original_file)
+        # The metadata is written last, directories without it are not considered entries
+        _write_json(self.metadatatodict(), self.path + '/metadata.json')
+        if getattr(self, 'repository', None) is not None:
+            self.repository.index_entry(self)
 
     def metadatafromdict(self, entrydict):
         self.tags = entrydict['tags']
         self.parents = entrydict['parents']
         self.children = entrydict['children']
+        self.originals = entrydict.get('originals', [])
 
     def add_tags(self, tags):
         _add2list(tags, self.tags)
@@ -147,39 +161,45 @@ class StructureEntry():
         _add2list(children, self.children)
 
     def add_original_file(self, filep):
-        orig_dir = self.path + '/original'
-        if isinstance(filep, str):
+        """
+        Add original files (CIF, POSCAR, etc) to the entry. The files are stored once on the
+        BlobStore of the repository and the entry keeps the hash of their contents on its metadata,
+        so each new file is hashed once and files already referenced by the entry are ignored
+
+        :param filep: (str, list) Path or paths to the files
+        """
+        if isinstance(filep, basestring):
             filep = [filep]
-        self.load_originals()
-        hashs = {}
-        for iorig in self.original_file:
-            rf = open(iorig, 'r')
-            hashs[iorig] = hashlib.sha224(rf.read()).hexdigest()
-            rf.close()
+        blobs = self.repository.blobs
+        orig_dir = os.path.abspath(self.path + '/original')
+        hashes = [x['hash'] for x in self.originals]
 
         for ifile in filep:
             assert (os.path.isfile(ifile))
-            rf = open(ifile, 'r')
-            hash_ifile = hashlib.sha224(rf.read()).hexdigest()
-
-            if hash_ifile in hashs.values():
+            # Files already stored on the repository or on the 'original' directory of older entries
+            if blobs.contains_path(ifile) or os.path.dirname(os.path.abspath(ifile)) == orig_dir:
                 continue
+            hash_ifile = hash_file(ifile)
+            if hash_ifile in hashes:
+                continue
+            blobs.add(ifile, hash_ifile)
+            self.originals.append({'name': os.path.basename(ifile), 'hash': hash_ifile})
+            hashes.append(hash_ifile)
+        self.load_originals()
 
-            if ifile not in self.original_file:
-                if not os.path.isdir(orig_dir):
-                    os.mkdir(orig_dir)
+    def add_originals(self, originals):
+        """
+        Add references to original files already stored on the repository,
+        the files are not read
 
-                if not os.path.isfile(orig_dir + '/' + os.path.basename(ifile)):
-                    _shutil.copy2(ifile, orig_dir)
-                else:
-                    i = 0
-                    while True:
-                        newfile = ifile + '_' + str(i)
-                        if not os.path.isfile(orig_dir + '/' + os.path.basename(newfile)):
-                            _shutil.copy(ifile, orig_dir + '/' + os.path.basename(newfile))
-                            break
-                        else:
-                            i += 1
+        :param originals: (list) Dictionaries with keys 'name' and 'hash' as on StructureEntry.originals
+        """
+        hashes = [x['hash'] for x in self.originals]
+        for iorig in originals:
+            if iorig['hash'] not in hashes:
+                self.repository.blobs.ref(iorig['hash'])
+                self.originals.append(dict(iorig))
+                hashes.append(iorig['hash'])
         self.load_originals()
 
     def __str__(self):
@@ -256,9 +276,7 @@ class PropertiesEntry():
         """
         Save an existing repository information
         """
-        wf = open(self.entry.path + '/properties.json', 'w')
-        _json.dump(self.properties, wf, sort_keys=True, indent=4, separators=(',', ': '))
-        wf.close()
+        _write_json(self.properties, self.entry.path + '/properties.json')
 
     def load(self):
         """
@@ -276,14 +294,35 @@ class StructureRepository():
     and check those db
     """
 
-    def __init__(self, path):
+    # Minimal number of records on the journal of tags before it is merged into 'db.json',
+    # the journal is also allowed to grow up to the number of entries so the cost of
+    # merging it stays proportional to the number of entries added
+    journal_limit = 1000
+
+    # Number of entries kept in memory by 'batch' before writing them on the index
+    batch_size = 1000
+
+    def __init__(self, path, compress_originals=False):
         """
         Creates new db for calculations and structures
+        The entries are listed on the index 'index.sqlite' inside the repository,
+        the index is built from the entries on disk if it does not exist
+
+        The tags of new entries are appended to the journal 'tags.journal' instead of
+        rewriting 'db.json' for each entry, the journal is merged into 'db.json' by 'save'
+
+        The original files of the entries are stored once on the BlobStore 'blobs' inside the repository
 
         Args:
         path: (string) Directory path for the structure repository
+        compress_originals: (bool) Compress with gzip the original files added to the repository
         """
         self.path = os.path.abspath(path)
+        self._lock = RLock()
+        self._batch_depth = 0
+        self._pending = []
+        self._journal_file = None
+        self._journal_records = 0
 
         if os.path.isfile(self.path + '/db.json'):
             self.load()
@@ -297,6 +336,13 @@ class StructureRepository():
                 os.mkdir(self.path)
             self.save()
 
+        self.index = RepositoryIndex(self.path + '/index.sqlite')
+        self.blobs = BlobStore(self.path + '/blobs', self.index, compress=compress_originals)
+        if self.index.is_new and len(self._scan_entries()) > 0:
+            self.rebuild()
+        else:
+            self._recover_index()
+
     def todict(self):
         """
         Serialize the values of the db into a dictionary
@@ -311,14 +357,21 @@ class StructureRepository():
     def save(self):
         """
         Save an existing repository information
+        The file is replaced atomically and the journal of tags is emptied
         """
-        wf = open(self.path + '/db.json', 'w')
-        _json.dump(self.todict(), wf, sort_keys=True, indent=4, separators=(',', ': '))
-        wf.close()
+        with self._lock:
+            _write_json(self.todict(), self.path + '/db.json', fsync=True)
+            if self._journal_file is not None:
+                self._journal_file.close()
+                self._journal_file = None
+            if os.path.isfile(self.path + '/tags.journal'):
+                os.remove(self.path + '/tags.journal')
+            self._journal_records = 0
 
     def load(self):
         """
         Loads an existing db from its configuration file
+        and applies the changes recorded on the journal of tags
         """
         rf = open(self.path + '/db.json', 'r')
         try:
@@ -328,45 +381,195 @@ class StructureRepository():
             jsonload = {'tags': {}}
         self.fromdict(jsonload)
         rf.close()
+        self._journal_records = 0
+        for record in self._read_journal():
+            self._apply_record(record)
+            self._journal_records += 1
+
+    def _read_journal(self):
+        ret = []
+        if os.path.isfile(self.path + '/tags.journal'):
+            rf = open(self.path + '/tags.journal', 'r')
+            for line in rf:
+                try:
+                    ret.append(unicode2string(_json.loads(line)))
+                except ValueError:
+                    # A record partially written before a crash
+                    break
+            rf.close()
+        return ret
+
+    def _apply_record(self, record):
+        identifier = record['identifier']
+        if record.get('deleted', False):
+            for itag in self.tags:
+                if identifier in self.tags[itag]:
+                    self.tags[itag].remove(identifier)
+        else:
+            for itag in record['tags']:
+                if itag in self.tags:
+                    if identifier not in self.tags[itag]:
+                        self.tags[itag].append(identifier)
+                else:
+                    self.tags[itag] = [identifier]
+
+    def _journal(self, record):
+        """
+        Append a record to the journal of tags, the journal is merged into 'db.json'
+        when it has more records than 'journal_limit' and than entries on the repository
+        and no batch is active
+        """
+        with self._lock:
+            if self._journal_file is None:
+                self._journal_file = open(self.path + '/tags.journal', 'a')
+            self._journal_file.write(_json.dumps(record) + '\n')
+            self._journal_file.flush()
+            self._journal_records += 1
+            if self._batch_depth == 0:
+                if self._journal_records > max(self.journal_limit, self.index.count()):
+                    self.save()
+                else:
+                    os.fsync(self._journal_file.fileno())
+                    self._journal_file.close()
+                    self._journal_file = None
+
+    def _recover_index(self):
+        """
+        Add to the index the entries recorded on the journal but missing on the index,
+        they could be left by a batch interrupted before writing the index
+        """
+        missing = []
+        for record in self._read_journal():
+            identifier = record['identifier']
+            if not record.get('deleted', False) and identifier not in self.index and \
+                    os.path.isfile(self.path + '/' + identifier + '/metadata.json'):
+                missing.append(StructureEntry(identifier=identifier, repository=self))
+        if len(missing) > 0:
+            self.index.add(missing)
+
+    def index_entry(self, entry):
+        """
+        Write an entry on the index, inside a batch the entries are written
+        together every 'batch_size' entries and when the batch finishes
+
+        :param entry: (StructureEntry) The entry
+        """
+        with self._lock:
+            if self._batch_depth > 0:
+                self._pending.append(entry)
+                if len(self._pending) >= self.batch_size:
+                    self._flush_index()
+            else:
+                self.index.add([entry])
+
+    def _flush_index(self):
+        with self._lock:
+            if len(self._pending) > 0:
+                self.index.add(self._pending)
+                self._pending = []
+
+    @contextmanager
+    def batch(self):
+        """
+        Context for adding many entries, for example:
+
+            with repo.batch():
+                for structure in structures:
+                    repo.add_entry(StructureEntry(structure=structure))
+
+        Inside the batch the index is written every 'batch_size' entries and the tags are
+        only recorded on the journal. When the batch finishes, even with an exception, the
+        remaining entries are written on the index and the journal is merged into 'db.json'.
+        Entries of a batch interrupted by a crash are recovered from the journal the next
+        time the repository is opened. Batches can be nested.
+        """
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self._flush_index()
+                    self.save()
 
     def rebuild(self):
-        ids = self.get_all_entries
+        """
+        Regenerate the tags, the index and the references to the original files from the entries on disk,
+        original files not referenced by any entry are removed
+        """
+        ids = self._scan_entries()
         self.tags = {}
+        entries = []
+        counts = {}
         for ident in ids:
             struct_entry = StructureEntry(identifier=ident, repository=self)
+            entries.append(struct_entry)
+            for iorig in struct_entry.originals:
+                counts[iorig['hash']] = counts.get(iorig['hash'], 0) + 1
             for i in struct_entry.tags:
                 if i in self.tags:
                     self.tags[i].append(ident)
                 else:
                     self.tags[i] = [ident]
+        self.index.clear()
+        self.index.add(entries)
+        self.blobs.rebuild(counts)
         self.save()
 
+    def _scan_entries(self):
+        return [x for x in os.listdir(self.path) if os.path.isfile(self.path + '/' + x + '/metadata.json')]
+
     @property
     def get_all_entries(self):
-        return [x for x in os.listdir(self.path) if os.path.isfile(self.path + '/' + x + '/metadata.json')]
+        return self.index.identifiers()
 
     def __len__(self):
-        return len(self.get_all_entries)
+        return self.index.count()
 
     def get_formulas(self):
-        formulas = {}
-        for i in self.get_all_entries:
-            ientry = StructureEntry(repository=self, identifier=i)
-            formula = ientry.structure.formula
-            if formula in formulas:
-                formulas[formula].append(i)
-            else:
-                formulas[formula] = [i]
-        return formulas
+        return self.index.formulas()
 
-    def merge2entries(self, orig, dest):
-        assert (orig.structure == dest.structure)
+    def find(self, formula=None, tag=None, natom=None, nspecies=None):
+        """
+        Identifiers of the entries matching all the given conditions, the search
+        uses the index and does not read the entries
+
+        :param formula: (str) Chemical formula
+        :param tag: (str) Tag of the entries
+        :param natom: (int) Number of atoms
+        :param nspecies: (int) Number of species
+        :return: (list)
+        """
+        return self.index.find(formula=formula, tag=tag, natom=natom, nspecies=nspecies)
+
+    def merge2entries(self, orig, dest, tolerance=None):
+        """
+        Merge the entry 'orig' into 'dest', parents, children, tags and original files
+        of 'orig' are added to 'dest' and 'orig' is deleted
+
+        :param orig: (StructureEntry) Entry to remove
+        :param dest: (StructureEntry) Entry to keep
+        :param tolerance: (float) If given the structures must be equal within this
+                          tolerance (see same_structure), otherwise they must be identical
+        """
+        if tolerance is None:
+            assert (orig.structure == dest.structure)
+        else:
+            assert same_structure(orig.structure, dest.structure, tolerance)
         dest.add_parents(orig.parents)
         dest.add_children(orig.children)
         dest.add_tags(orig.tags)
-        if orig.original_file is not None and len(orig.original_file) > 0:
-            dest.add_original_file(orig.original_file)
+        dest.add_originals(orig.originals)
+        legacy = [x for x in orig.original_file if not self.blobs.contains_path(x)]
+        if len(legacy) > 0:
+            dest.add_original_file(legacy)
         dest.save()
+        with self._lock:
+            record = {'identifier': dest.identifier, 'tags': dest.tags}
+            self._apply_record(record)
+            self._journal(record)
         self.del_entry(orig)
 
     def clean(self):
@@ -377,39 +580,111 @@ class StructureRepository():
                     self.tags[i].remove(j)
         self.save()
 
-    def refine(self):
-        formulas = self.get_formulas()
-        for j in formulas:
-            print j
-            if len(formulas[j]) > 1:
-                for i in range(len(formulas[j]) - 1):
-                    stru1 = StructureEntry(repository=self, identifier=formulas[j][i])
-                    stru2 = StructureEntry(repository=self, identifier=formulas[j][i + 1])
-                    if stru1 == stru2:
-                        self.merge2entries(stru1, stru2)
-        self.save()
+    def refine(self, tolerance=1E-3, volume_window=0.01, nparal=1, report_file=None):
+        """
+        Find and merge duplicated entries on the whole repository.
+
+        The entries are grouped in buckets with the same formula and number of atoms taken from
+        the index. Inside each bucket the structures are sorted by volume per atom and each one
+        is compared with the representatives of the groups found before, the first entry of each
+        group, if their relative difference of volume is below 'volume_window'. Entries with the
+        same structure hash are duplicates without further comparison. Every member of a group is
+        equal to its representative within 'tolerance', duplicates are not chained through other
+        members. The buckets are processed by a pool of 'nparal' processes. The duplicates of each
+        group are merged into its representative with 'merge2entries' inside a single batch
+
+        :param tolerance: (float) Tolerance for cell vectors and atomic positions, see same_structure
+        :param volume_window: (float) Maximal relative difference of volume for the structures compared
+        :param nparal: (int) Number of processes
+        :param report_file: (str) JSON file for the report, by default 'refine.json' on the repository
+        :return: (dict) Report with the number of 'buckets' and 'comparisons' and the merged 'groups',
+                 each group is a dictionary with keys 'formula', 'kept' and 'merged'
+        """
+        buckets = {}
+        for ident, formula, natom, nspecies, shash in self.index.records():
+            buckets.setdefault((formula, natom), []).append((ident, shash))
+
+        tasks = [(self.path, buckets[key], tolerance, volume_window) for key in sorted(buckets)
+                 if len(buckets[key]) > 1]
+        if nparal == 1:
+            results = (_refine_bucket(x) for x in tasks)
+            pool = None
+        else:
+            pool = Pool(nparal)
+            results = pool.imap_unordered(_refine_bucket, tasks)
 
-    def merge(self, other):
+        report = {'tolerance': tolerance, 'volume_window': volume_window, 'buckets': len(tasks),
+                  'comparisons': 0, 'groups': []}
+        try:
+            with self.batch():
+                for groups, comparisons in results:
+                    report['comparisons'] += comparisons
+                    for group in groups:
+                        dest = StructureEntry(repository=self, identifier=group[0])
+                        for ident in group[1:]:
+                            orig = StructureEntry(repository=self, identifier=ident)
+                            self.merge2entries(orig, dest, tolerance=tolerance)
+                        report['groups'].append({'formula': dest.structure.formula, 'kept': group[0],
+                                                 'merged': group[1:]})
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if report_file is None:
+            report_file = self.path + '/refine.json'
+        _write_json(report, report_file)
+        return report
+
+    def merge(self, other, dry_run=False):
         """
         Add all the contents from other db into the
         calling object
 
+        Entries present on both repositories are compared with the structure hash on the index
+        and the hash of their metadata (tags, parents, children and original files), the entries
+        are not loaded. If there are conflicts, entries with the same identifier and different
+        contents, nothing is merged. The directories of the new entries and their original files
+        are hard linked when both repositories are on the same filesystem and copied otherwise,
+        the index is updated with a single transaction
+
         :param other: StructureRepository
+        :param dry_run: (bool) Only compare the repositories, nothing is merged
+        :return: (dict) Report with the identifiers 'added', 'identical' and with 'conflicts',
+                 'merged' is True if the entries were merged
         """
-        conflict_entries = []
-        for i in other.get_all_enties:
-            if i in self.get_all_entries:
-                other_structure = StructureEntry(repository=other, identifier=i)
-                this_structure = StructureEntry(repository=self, identifier=i)
-                if this_structure != other_structure:
-                    conflict_entries.append(i)
-        if len(conflict_entries) == 0:
-            for i in other.get_all_enties:
-                if i not in self.get_all_entries:
-                    _shutil.copytree(other.path + '/' + i, self.path + '/' + i)
-        else:
-            print('Conflict entries found, No merge done')
-            return conflict_entries
+        this_hashes = dict([(x[0], x[4]) for x in self.index.records()])
+        report = {'added': [], 'identical': [], 'conflicts': [], 'merged': False}
+        for ident, formula, natom, nspecies, shash in other.index.records():
+            if ident not in this_hashes:
+                report['added'].append(ident)
+            elif shash == this_hashes[ident] and \
+                    hash_file(self.path + '/' + ident + '/metadata.json') == \
+                    hash_file(other.path + '/' + ident + '/metadata.json'):
+                report['identical'].append(ident)
+            else:
+                report['conflicts'].append(ident)
+        if dry_run or len(report['conflicts']) > 0:
+            return report
+
+        with self.batch():
+            for ident in report['added']:
+                _link_tree(other.path + '/' + ident, self.path + '/' + ident)
+                rf = open(self.path + '/' + ident + '/metadata.json', 'r')
+                metadata = unicode2string(_json.load(rf))
+                rf.close()
+                for iorig in metadata.get('originals', []):
+                    if iorig['hash'] in self.blobs:
+                        self.blobs.ref(iorig['hash'])
+                    else:
+                        self.blobs.add_link(other.blobs.blob_path(iorig['hash']), iorig['hash'])
+                with self._lock:
+                    record = {'identifier': ident, 'tags': metadata['tags']}
+                    self._apply_record(record)
+                    self._journal(record)
+            self.index.copy_entries(other.index, report['added'])
+        report['merged'] = True
+        return report
 
     def add_entry(self, entry):
         """
@@ -420,51 +695,84 @@ class StructureRepository():
         if not os.path.isdir(entry.path):
             os.mkdir(entry.path)
         entry.save()
-        if entry.tags is not None:
-            for itag in entry.tags:
-                if itag in self.tags:
-                    if entry.identifier not in self.tags[itag]:
-                        self.tags[itag].append(entry.identifier)
-                else:
-                    self.tags[itag] = [entry.identifier]
-        self.save()
+        with self._lock:
+            record = {'identifier': entry.identifier, 'tags': entry.tags if entry.tags is not None else []}
+            self._apply_record(record)
+            self._journal(record)
 
-    def add_many_entries(self, list_of_entries, tag, number_threads=1):
+    def add_many_entries(self, list_of_entries, tag, nparal=1, primitive=True, chunksize=16, number_threads=None):
+        """
+        Add the structures from many CIF files and return the reports of all of them,
+        see 'iter_add_many_entries' to follow the progress while the files are processed
+
+        :param list_of_entries: (list) Paths to the CIF files
+        :param tag: (str) Tag for the new entries
+        :param nparal: (int) Number of processes
+        :param primitive: (bool) Store the primitive cell of the structures
+        :param chunksize: (int) Number of files sent to each process at once
+        :param number_threads: (int) Deprecated name of 'nparal'
+        :return: (list) Reports as returned by 'iter_add_many_entries'
+        """
+        if number_threads is not None:
+            nparal = number_threads
+        return list(self.iter_add_many_entries(list_of_entries, tag, nparal=nparal, primitive=primitive,
+                                               chunksize=chunksize))
 
-        from threading import Thread
-        from pychemia.external.pymatgen import cif2structure
+    def iter_add_many_entries(self, list_of_entries, tag, nparal=1, primitive=True, chunksize=16):
+        """
+        Add the structures from many CIF files. The files are parsed by a pool of 'nparal'
+        processes and the entries are written by the calling process inside a batch.
+        The method returns an iterator with one report for each file, yielded when its entry
+        is written, in the order they finish parsing. The files are processed while the
+        iterator is consumed, for example:
+
+            for report in repo.iter_add_many_entries(cifs, 'icsd', nparal=8):
+                if not report['succeed']:
+                    print report['filename'], report['error']
+
+        :param list_of_entries: (list) Paths to the CIF files
+        :param tag: (str) Tag for the new entries
+        :param nparal: (int) Number of processes
+        :param primitive: (bool) Store the primitive cell of the structures
+        :param chunksize: (int) Number of files sent to each process at once
+        :return: (generator) Dictionaries with keys 'filename', 'succeed', 'identifier' (None if failed)
+                 and 'error' (None if succeed)
+        """
+        from pychemia import Structure
 
-        def worker(cifs, tags, results):
-            results['succeed'] = []
-            results['failed'] = []
-            for icif in cifs:
-                try:
-                    struct = cif2structure(icif, primitive=True)
-                except ValueError:
-                    struct = None
-                    results['failed'].append(icif)
-                if struct is not None:
-                    structentry = StructureEntry(structure=struct, original_file=icif, tags=[tags])
-                    self.add_entry(structentry)
-                    results['succeed'].append(icif)
-
-        th = []
-        result_list = []
-        num = int(math.ceil(float(len(list_of_entries)) / number_threads))
-        for i in range(number_threads):
-            result_list.append({})
-            th.append(Thread(target=worker,
-                             args=(
-                                 list_of_entries[i * num:min((i + 1) * num, len(list_of_entries))], tag,
-                                 result_list[i])))
-        for i in th:
-            i.start()
-        return th, result_list
+        tasks = ((filename, primitive) for filename in list_of_entries)
+        if nparal == 1:
+            results = (_read_cif(x) for x in tasks)
+            pool = None
+        else:
+            pool = Pool(nparal)
+            results = pool.imap_unordered(_read_cif, tasks, chunksize)
+        try:
+            with self.batch():
+                for filename, structure_dict, error in results:
+                    report = {'filename': filename, 'succeed': False, 'identifier': None, 'error': error}
+                    if structure_dict is not None:
+                        tags = [tag] if tag is not None else None
+                        entry = StructureEntry(structure=Structure.from_dict(structure_dict), original_file=filename,
+                                               tags=tags)
+                        self.add_entry(entry)
+                        report['succeed'] = True
+                        report['identifier'] = entry.identifier
+                    yield report
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
     def del_entry(self, entry):
         print 'Deleting ', entry.identifier
         for i in entry.tags:
-            self.tags[i].remove(entry.identifier)
+            if entry.identifier in self.tags.get(i, []):
+                self.tags[i].remove(entry.identifier)
+        self.index.remove([entry.identifier])
+        self._journal({'identifier': entry.identifier, 'deleted': True})
+        for iorig in entry.originals:
+            self.blobs.release(iorig['hash'])
         _shutil.rmtree(entry.path)
 
     def __str__(self):
@@ -495,11 +803,109 @@ class ExecutionRepository():
         pass
 
 
+def _refine_bucket(args):
+    """
+    Worker for the process pool of 'refine', finds the duplicated entries on one bucket
+
+    :param args: (tuple) path of the repository, list of pairs (identifier, structure hash),
+                 tolerance and volume_window
+    :return: (tuple) groups of duplicates as lists of identifiers, the representative first and the
+             other members sorted, and number of comparisons
+    """
+    path, members, tolerance, volume_window = args
+    identifiers = [x[0] for x in members]
+    hashes = dict(members)
+    structures = dict([(x, load_structure_json(path + '/' + x + '/structure.json')) for x in identifiers])
+    volumes = dict([(x, structures[x].volume / structures[x].natom) for x in identifiers])
+    identifiers.sort(key=lambda x: (volumes[x], x))
+
+    # Groups with a representative inside the volume window of the current entry
+    active = []
+    groups = []
+    comparisons = 0
+    for ident in identifiers:
+        active = [x for x in active if volumes[ident] - volumes[x[0]] <= volume_window * volumes[x[0]]]
+        for group in active:
+            representative = group[0]
+            if hashes[representative] != hashes[ident]:
+                comparisons += 1
+                if not same_structure(structures[representative], structures[ident], tolerance):
+                    continue
+            group.append(ident)
+            break
+        else:
+            group = [ident]
+            active.append(group)
+            groups.append(group)
+    return [[x[0]] + sorted(x[1:]) for x in groups if len(x) > 1], comparisons
+
+
+def _read_cif(args):
+    """
+    Worker for the process pool of 'add_many_entries', reads the structure from one CIF file
+
+    :param args: (tuple) filename and primitive
+    :return: (tuple) filename, structure as dictionary (None if failed) and error message (None if succeed)
+    """
+    filename, primitive = args
+    try:
+        from pychemia.external.pymatgen import cif2structure
+        structure = cif2structure(filename, primitive=primitive)
+    except Exception as exc:
+        return filename, None, '%s: %s' % (type(exc).__name__, str(exc))
+    if structure is None:
+        return filename, None, 'No single ordered structure found'
+    return filename, structure.to_dict(), None
+
+
+def _write_json(value, filename, fsync=False):
+    """
+    Write 'value' as JSON on a temporary file and rename it to 'filename',
+    so 'filename' always contains a complete file even after a crash
+
+    :param value: (dict) Value to write
+    :param filename: (str) Path of the file
+    :param fsync: (bool) Force the file to the disk before the rename, only the commit
+                  points of the repository ('db.json') pay for it
+    """
+    tmpfile = filename + '.tmp'
+    wf = open(tmpfile, 'w')
+    _json.dump(value, wf, sort_keys=True, indent=4, separators=(',', ': '))
+    wf.flush()
+    if fsync:
+        os.fsync(wf.fileno())
+    wf.close()
+    os.rename(tmpfile, filename)
+
+
+def _link_tree(source, destination):
+    """
+    Create 'destination' with hard links to all the files inside 'source',
+    files are copied when they cannot be linked (i.e. on different filesystems)
+    """
+    for dirpath, dirnames, filenames in os.walk(source):
+        target = destination + dirpath[len(source):]
+        if not os.path.isdir(target):
+            os.mkdir(target)
+        for filename in filenames:
+            _link_or_copy(dirpath + os.sep + filename, target + os.sep + filename)
+
+
+def _link_or_copy(source, destination):
+    """
+    Hard link 'source' on 'destination', the file is copied if the link cannot be created
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        _shutil.copy2(source, destination)
+
+
 def _add2list(orig, dest):
     if isinstance(orig, str):
         if orig not in dest:
             dest.append(orig)
     elif isinstance(orig, list):
-        for iorig in dest:
+        for iorig in orig:
             if iorig not in dest:
                 dest.append(iorig)
@@ -0,0 +1,314 @@
+"""
+Index of the entries of a StructureRepository stored on a SQLite file inside the repository
+
+The index keeps for each entry the identifier, formula, number of atoms and species,
+tags, a hash of the structure and a summary of the scalar properties, so listing the
+entries and searching them by formula or tag do not need to read the directory of
+the repository or the JSON files of the entries.
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import hashlib
+import json
+import os
+import sqlite3
+import numpy as np
+from threading import RLock
+
+_SCHEMA = ['CREATE TABLE IF NOT EXISTS entries (identifier TEXT PRIMARY KEY, formula TEXT, natom INTEGER, '
+           'nspecies INTEGER, structure_hash TEXT, properties TEXT)',
+           'CREATE TABLE IF NOT EXISTS tags (tag TEXT, identifier TEXT, PRIMARY KEY (tag, identifier))',
+           'CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, refcount INTEGER)',
+           'CREATE INDEX IF NOT EXISTS entries_formula ON entries (formula)',
+           'CREATE INDEX IF NOT EXISTS entries_structure_hash ON entries (structure_hash)',
+           'CREATE INDEX IF NOT EXISTS tags_identifier ON tags (identifier)']
+
+
+def structure_hash(structure, decimals=6):
+    """
+    Hash of the symbols, cell and reduced coordinates of a structure,
+    the numbers are rounded to 'decimals' so small numerical noise gives the same hash
+
+    :param structure: (Structure) The structure
+    :param decimals: (int) Number of decimals kept for the cell and reduced coordinates
+    :return: (str) Hexadecimal SHA224 digest
+    """
+    fmt = '%.' + str(decimals) + 'f'
+    data = [list(structure.symbols),
+            [fmt % (x + 0.0) for x in structure.cell.round(decimals).flatten()],
+            [fmt % (x + 0.0) for x in structure.reduced.round(decimals).flatten()]]
+    return hashlib.sha224(json.dumps(data)).hexdigest()
+
+
+def same_structure(structure1, structure2, tolerance=1E-3):
+    """
+    True if two structures have the same atoms at the same positions within 'tolerance',
+    the atoms can be on a different order and, for crystals, the positions can be
+    translated and differ by lattice vectors. The cells must be equal within 'tolerance',
+    the same crystal described with different cells is not recognized
+
+    :param structure1: (Structure) First structure
+    :param structure2: (Structure) Second structure
+    :param tolerance: (float) Maximal difference on cell vectors and atomic positions (Angstrom)
+    :return: (bool)
+    """
+    if structure1.natom != structure2.natom or sorted(structure1.symbols) != sorted(structure2.symbols):
+        return False
+    crystal = structure1.is_crystal and structure2.is_crystal
+    if crystal and not np.allclose(structure1.cell, structure2.cell, rtol=0, atol=tolerance):
+        return False
+    symbols1 = np.array(structure1.symbols)
+    symbols2 = np.array(structure2.symbols)
+    other_specie = symbols1[:, np.newaxis] != symbols2[np.newaxis, :]
+    if crystal:
+        coordinates1 = structure1.reduced
+        coordinates2 = structure2.reduced
+        candidates = np.where(symbols2 == symbols1[0])[0]
+    else:
+        coordinates1 = structure1.positions
+        coordinates2 = structure2.positions
+        candidates = [None]
+    for j in candidates:
+        # Translation that brings the first atom of structure1 over the atom j of structure2
+        if j is None:
+            shift = 0.0
+        else:
+            shift = coordinates2[j] - coordinates1[0]
+        diff = coordinates2[np.newaxis, :, :] - (coordinates1 + shift)[:, np.newaxis, :]
+        if crystal:
+            diff -= np.round(diff)
+            diff = np.dot(diff, structure1.cell)
+        close = np.sqrt(np.sum(diff ** 2, axis=2)) < tolerance
+        close[other_specie] = False
+        if np.all(np.any(close, axis=1)) and np.all(np.any(close, axis=0)):
+            return True
+    return False
+
+
+def properties_summary(properties):
+    """
+    Scalar values (numbers, strings and booleans) from the properties of an entry
+
+    :param properties: (dict) The properties, can be None
+    :return: (dict)
+    """
+    if properties is None:
+        return {}
+    return dict([(key, properties[key]) for key in properties
+                 if isinstance(properties[key], (basestring, int, long, float, bool))])
+
+
+class RepositoryIndex():
+    """
+    SQLite index of the entries of a StructureRepository.
+    The same index can be used by several threads of the process.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: (str) Path to the SQLite file, it is created if it does not exist
+        """
+        self.path = path
+        self.is_new = not os.path.isfile(path)
+        self._lock = RLock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.text_factory = str
+        with self._lock:
+            for statement in _SCHEMA:
+                self._conn.execute(statement)
+            self._conn.commit()
+
+    def _execute(self, statement, args=()):
+        with self._lock:
+            return self._conn.execute(statement, args).fetchall()
+
+    def add(self, entries):
+        """
+        Add or replace entries on the index with a single transaction
+
+        :param entries: (list) StructureEntry objects
+        """
+        with self._lock:
+            for entry in entries:
+                self._store(entry)
+            self._conn.commit()
+
+    def _store(self, entry):
+        structure = entry.structure
+        self._conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                           (entry.identifier, structure.formula, structure.natom, structure.nspecies,
+                            structure_hash(structure), json.dumps(properties_summary(entry.properties))))
+        self._conn.execute('DELETE FROM tags WHERE identifier = ?', (entry.identifier,))
+        self._conn.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)',
+                               [(tag, entry.identifier) for tag in entry.tags])
+
+    def copy_entries(self, other, identifiers, chunk=500):
+        """
+        Copy the rows of some entries from other index with a single transaction
+
+        :param other: (RepositoryIndex) The index with the entries
+        :param identifiers: (list) Identifiers of the entries
+        :param chunk: (int) Number of entries read from 'other' at once
+        """
+        with self._lock:
+            for i in range(0, len(identifiers), chunk):
+                part = identifiers[i:i + chunk]
+                marks = ', '.join(['?'] * len(part))
+                rows = other._execute('SELECT identifier, formula, natom, nspecies, structure_hash, properties '
+                                      'FROM entries WHERE identifier IN (%s)' % marks, part)
+                self._conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self._conn.execute('DELETE FROM tags WHERE identifier IN (%s)' % marks, part)
+                rows = other._execute('SELECT tag, identifier FROM tags WHERE identifier IN (%s)' % marks, part)
+                self._conn.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)', rows)
+            self._conn.commit()
+
+    def set_properties(self, identifier, properties):
+        """
+        Update the summary of properties of one entry
+
+        :param identifier: (str) Identifier of the entry
+        :param properties: (dict) The properties of the entry
+        """
+        self.set_many_properties([(identifier, properties)])
+
+    def set_many_properties(self, changes):
+        """
+        Update the summary of properties of many entries with a single transaction
+
+        :param changes: (list) Tuples (identifier, properties)
+        """
+        with self._lock:
+            self._conn.executemany('UPDATE entries SET properties = ? WHERE identifier = ?',
+                                   [(json.dumps(properties_summary(x[1])), x[0]) for x in changes])
+            self._conn.commit()
+
+    def remove(self, identifiers):
+        """
+        Remove entries from the index
+
+        :param identifiers: (list) Identifiers of the entries
+        """
+        with self._lock:
+            for identifier in identifiers:
+                self._conn.execute('DELETE FROM entries WHERE identifier = ?', (identifier,))
+                self._conn.execute('DELETE FROM tags WHERE identifier = ?', (identifier,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM entries')
+            self._conn.execute('DELETE FROM tags')
+            self._conn.execute('DELETE FROM blobs')
+            self._conn.commit()
+
+    def blob_ref(self, filehash, delta):
+        """
+        Change the number of references to a file of the BlobStore
+
+        :param filehash: (str) Hash of the file
+        :param delta: (int) Change on the number of references
+        :return: (int) Number of references after the change, rows are removed when it reaches zero
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO blobs VALUES (?, 0)', (filehash,))
+            self._conn.execute('UPDATE blobs SET refcount = refcount + ? WHERE hash = ?', (delta, filehash))
+            ret = self._conn.execute('SELECT refcount FROM blobs WHERE hash = ?', (filehash,)).fetchone()[0]
+            if ret <= 0:
+                self._conn.execute('DELETE FROM blobs WHERE hash = ?', (filehash,))
+            self._conn.commit()
+        return ret
+
+    def blob_counts(self):
+        """
+        :return: (dict) Number of references for each file of the BlobStore
+        """
+        return dict(self._execute('SELECT hash, refcount FROM blobs'))
+
+    def set_blob_counts(self, counts):
+        with self._lock:
+            self._conn.execute('DELETE FROM blobs')
+            self._conn.executemany('INSERT INTO blobs VALUES (?, ?)', [(x, counts[x]) for x in counts if counts[x] > 0])
+            self._conn.commit()
+
+    def identifiers(self):
+        return [x[0] for x in self._execute('SELECT identifier FROM entries ORDER BY identifier')]
+
+    def records(self):
+        """
+        :return: (list) Tuples (identifier, formula, natom, nspecies, structure_hash) for all the entries
+        """
+        return self._execute('SELECT identifier, formula, natom, nspecies, structure_hash FROM entries '
+                             'ORDER BY identifier')
+
+    def count(self):
+        return self._execute('SELECT COUNT(*) FROM entries')[0][0]
+
+    def __contains__(self, identifier):
+        return len(self._execute('SELECT 1 FROM entries WHERE identifier = ?', (identifier,))) > 0
+
+    def formulas(self):
+        """
+        :return: (dict) Identifiers of the entries for each formula
+        """
+        ret = {}
+        for formula, identifier in self._execute('SELECT formula, identifier FROM entries ORDER BY identifier'):
+            ret.setdefault(formula, []).append(identifier)
+        return ret
+
+    def tags(self):
+        """
+        :return: (dict) Identifiers of the entries for each tag
+        """
+        ret = {}
+        for tag, identifier in self._execute('SELECT tag, identifier FROM tags ORDER BY identifier'):
+            ret.setdefault(tag, []).append(identifier)
+        return ret
+
+    def find(self, formula=None, tag=None, natom=None, nspecies=None, structure_hash=None):
+        """
+        Identifiers of the entries matching all the given conditions
+
+        :param formula: (str) Chemical formula
+        :param tag: (str) Tag of the entries
+        :param natom: (int) Number of atoms
+        :param nspecies: (int) Number of species
+        :param structure_hash: (str) Hash of the structure, see 'structure_hash'
+        :return: (list)
+        """
+        conditions = []
+        args = []
+        for name, value in [('formula', formula), ('natom', natom), ('nspecies', nspecies),
+                            ('structure_hash', structure_hash)]:
+            if value is not None:
+                conditions.append('entries.%s = ?' % name)
+                args.append(value)
+        statement = 'SELECT entries.identifier FROM entries'
+        if tag is not None:
+            statement += ' JOIN tags ON tags.identifier = entries.identifier'
+            conditions.append('tags.tag = ?')
+            args.append(tag)
+        if len(conditions) > 0:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        return [x[0] for x in self._execute(statement + ' ORDER BY entries.identifier', args)]
+
+    def get(self, identifier):
+        """
+        Indexed values for one entry
+
+        :param identifier: (str) Identifier of the entry
+        :return: (dict) With keys 'formula', 'natom', 'nspecies', 'structure_hash', 'properties'
+                 and 'tags', None if the entry is not on the index
+        """
+        rows = self._execute('SELECT formula, natom, nspecies, structure_hash, properties FROM entries '
+                             'WHERE identifier = ?', (identifier,))
+        if len(rows) == 0:
+            return None
+        formula, natom, nspecies, shash, properties = rows[0]
+        tags = [x[0] for x in self._execute('SELECT tag FROM tags WHERE identifier = ?', (identifier,))]
+        return {'formula': formula, 'natom': natom, 'nspecies': nspecies, 'structure_hash': shash,
+                'properties': json.loads(properties), 'tags': tags}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,991 @@
+"""
+Embedded backend for PyChemiaDB stored on a single SQLite file
+
+A backend for PyChemiaDB is a client object that returns databases with
+client[name] and removes them with client.drop_database(name). The collections
+of a database are accessed as attributes and implement the subset of the pymongo
+Collection API used by PyChemiaDB: find, find_one, insert, update, remove,
+find_and_modify, count, create_index(es) and bulk operations. Queries and
+updates use the same MongoDB syntax for both backends.
+
+Each collection is a table with the identifier and the document as JSON.
+Queries are translated to SQL on the JSON1 functions to select a superset of the
+matching documents, using the indexes created on the expressions of the fields
+declared by PyChemiaDB, the exact MongoDB semantics is then applied on the
+documents selected. Cursors without sort read the table in chunks of rows, so
+iterating over many documents does not load all of them in memory and writes are
+allowed during the iteration. Fields inside arrays of subdocuments cannot be used on
+queries. Every write operation, including the bulk operations, is a
+single transaction that takes the write lock of the file at the beginning
+(BEGIN IMMEDIATE), so find_and_modify is atomic between processes sharing the file.
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import os
+import re
+import json
+import time
+import base64
+import sqlite3
+import itertools
+from threading import RLock
+from contextlib import contextmanager
+import numpy as np
+from _compat import ObjectId, Binary, BulkWriteError, DuplicateKeyError
+
+_clients = {}
+
+
+def get_sqlite_client(path, timeout=30.0):
+    """
+    Return the client for the SQLite file 'path', one client is shared by all
+    the databases on the same file opened by a process
+
+    :param path: (str) Path to the SQLite file, ':memory:' for a private database in memory
+    :param timeout: (float) Seconds to wait for the lock of the file held by other processes
+    :return: (SQLiteClient)
+    """
+    if path != ':memory:':
+        path = os.path.abspath(path)
+    key = (path, timeout)
+    if key not in _clients:
+        _clients[key] = SQLiteClient(path, timeout)
+    return _clients[key]
+
+
+class SQLiteClient():
+    """
+    Connection to a SQLite file, each database is a set of tables
+    with the name of the database as prefix
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self._pid = None
+        self._conn = None
+        self._lock = RLock()
+        self._depth = 0
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # The connection opened by a parent process must not be used after a fork
+            self._lock = RLock()
+            self._depth = 0
+            self._conn = None
+            self._pid = os.getpid()
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                       check_same_thread=False)
+                try:
+                    conn.execute("SELECT json('{}')")
+                except sqlite3.OperationalError:
+                    raise RuntimeError('The SQLite library does not support JSON1, version: %s' %
+                                       sqlite3.sqlite_version)
+                if self.path != ':memory:':
+                    conn.execute('PRAGMA journal_mode=WAL')
+                self._conn = conn
+        return self._conn
+
+    def execute(self, sql, params=()):
+        """
+        Execute a SQL statement and return all the rows
+        """
+        conn = self._connection()
+        with self._lock:
+            return conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context for a write transaction, nested transactions are part of the outer one
+        """
+        conn = self._connection()
+        with self._lock:
+            if self._depth == 0:
+                conn.execute('BEGIN IMMEDIATE')
+            self._depth += 1
+            try:
+                yield conn
+            except:
+                self._depth -= 1
+                if self._depth == 0:
+                    conn.execute('ROLLBACK')
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                conn.execute('COMMIT')
+
+    def __getitem__(self, name):
+        return SQLiteDatabase(self, name)
+
+    def database_names(self):
+        names = set()
+        for row in self.execute("SELECT name FROM sqlite_master WHERE type='table'"):
+            names.add(row[0].split('.')[0])
+        return sorted(names)
+
+    def drop_database(self, name):
+        with self.transaction() as conn:
+            for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+                if row[0].startswith(name + '.'):
+                    conn.execute('DROP TABLE "%s"' % row[0])
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._pid = None
+
+
+class SQLiteDatabase():
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = SQLiteCollection(self, name)
+        return self._collections[name]
+
+    def collection_names(self):
+        return [row[0][len(self.name) + 1:] for row in
+                self.client.execute("SELECT name FROM sqlite_master WHERE type='table'")
+                if row[0].startswith(self.name + '.')]
+
+
+class SQLiteCollection():
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = database.name + '.' + name
+        self._client = database.client
+        self._client.execute('CREATE TABLE IF NOT EXISTS "%s" (id TEXT PRIMARY KEY, doc TEXT NOT NULL)' %
+                             self.full_name)
+
+    # Reading
+
+    def find(self, spec=None, projection=None):
+        return SQLiteCursor(self, spec, projection)
+
+    def find_one(self, spec_or_id=None, projection=None):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for doc in self.find(spec_or_id, projection).limit(1):
+            return doc
+        return None
+
+    def count(self):
+        return self._client.execute('SELECT COUNT(*) FROM "%s"' % self.full_name)[0][0]
+
+    def _select(self, conn, spec):
+        """
+        Documents matching 'spec', returns the number of documents read from the table
+        and the list of matching documents
+        """
+        if spec is None:
+            spec = {}
+        sql, params = _compile_query(spec)
+        statement = 'SELECT doc FROM "%s"' % self.full_name
+        if sql is not None:
+            statement += ' WHERE ' + sql
+        rows = conn.execute(statement, params).fetchall()
+        docs = [json.loads(row[0], object_hook=_decode) for row in rows]
+        return len(rows), [doc for doc in docs if match(doc, spec)]
+
+    def _select_first(self, conn, spec, sort=None):
+        """
+        First document matching 'spec' on the order 'sort', None if there is no match.
+        The rows are fetched lazily and the search stops at the first match, the order is
+        computed by SQLite unless the sort fields contain objects or arrays, then all the
+        matching documents are sorted as MongoDB does
+        """
+        if spec is None:
+            spec = {}
+        sql, params = _compile_query(spec)
+        where = ''
+        if sql is not None:
+            where = ' WHERE ' + sql
+        order = ''
+        if sort is not None:
+            order = _compile_sort(sort)
+            if order is None or self._composite_values(conn, where, params, sort):
+                nread, docs = self._select(conn, spec)
+                docs = sort_documents(docs, sort)
+                if len(docs) == 0:
+                    return None
+                return docs[0]
+        cursor = conn.execute('SELECT doc FROM "%s"%s%s' % (self.full_name, where, order), params)
+        try:
+            while True:
+                rows = cursor.fetchmany(100)
+                if len(rows) == 0:
+                    return None
+                for row in rows:
+                    doc = json.loads(row[0], object_hook=_decode)
+                    if match(doc, spec):
+                        return doc
+        finally:
+            cursor.close()
+
+    def _composite_values(self, conn, where, params, sort):
+        # True if any candidate has an object or array on the sort fields
+        condition = ' OR '.join(["%s IN ('object', 'array')" % _json_type(_json_path(field))
+                                 for field, direction in sort])
+        if where == '':
+            statement = 'SELECT 1 FROM "%s" WHERE %s LIMIT 1' % (self.full_name, condition)
+        else:
+            statement = 'SELECT 1 FROM "%s"%s AND (%s) LIMIT 1' % (self.full_name, where, condition)
+        return len(conn.execute(statement, params).fetchall()) > 0
+
+    def _scan(self, spec, chunk_size=1000):
+        """
+        Generator of the documents matching 'spec' in the order of insertion. Each chunk of
+        'chunk_size' rows is a separated query starting after the last row read, so the
+        lock of the client is not held while the documents are consumed
+        """
+        if spec is None:
+            spec = {}
+        sql, params = _compile_query(spec)
+        statement = 'SELECT rowid, doc FROM "%s" WHERE rowid > ?' % self.full_name
+        if sql is not None:
+            statement += ' AND (%s)' % sql
+        statement += ' ORDER BY rowid LIMIT %d' % chunk_size
+        last = 0
+        while True:
+            rows = self._client.execute(statement, [last] + list(params))
+            for row in rows:
+                doc = json.loads(row[1], object_hook=_decode)
+                if match(doc, spec):
+                    yield doc
+            if len(rows) < chunk_size:
+                break
+            last = rows[-1][0]
+
+    # Writing
+
+    def insert(self, doc_or_docs):
+        """
+        Insert one document or a list of documents in a single transaction
+
+        :return: The identifier or the list of identifiers of the new documents
+        """
+        if isinstance(doc_or_docs, dict):
+            return self._insert([doc_or_docs])[0]
+        return self._insert(doc_or_docs)
+
+    def _insert(self, docs):
+        ret = []
+        with self._client.transaction() as conn:
+            for doc in docs:
+                ret.append(self._insert_doc(conn, doc))
+        return ret
+
+    def _insert_doc(self, conn, doc):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        try:
+            conn.execute('INSERT INTO "%s" (id, doc) VALUES (?, ?)' % self.full_name,
+                         (_id_key(doc['_id']), _dumps(doc)))
+        except sqlite3.IntegrityError:
+            raise DuplicateKeyError('Duplicate key: %s' % str(doc['_id']))
+        return doc['_id']
+
+    def _write(self, conn, doc):
+        conn.execute('UPDATE "%s" SET doc = ? WHERE id = ?' % self.full_name, (_dumps(doc), _id_key(doc['_id'])))
+
+    def update(self, spec, document, upsert=False, multi=False):
+        with self._client.transaction() as conn:
+            return self._update(conn, spec, document, upsert, multi)
+
+    def _update(self, conn, spec, document, upsert, multi):
+        if multi:
+            nread, docs = self._select(conn, spec)
+        else:
+            docs = [x for x in [self._select_first(conn, spec)] if x is not None]
+        for doc in docs:
+            self._write(conn, apply_update(doc, document))
+        ret = {'n': len(docs), 'nModified': len(docs), 'updatedExisting': len(docs) > 0, 'ok': 1}
+        if len(docs) == 0 and upsert:
+            ret['upserted'] = self._insert_doc(conn, _upsert_doc(spec, document))
+            ret['n'] = 1
+        return ret
+
+    def remove(self, spec_or_id=None, multi=True):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        with self._client.transaction() as conn:
+            return self._remove(conn, spec_or_id, multi)
+
+    def _remove(self, conn, spec, multi):
+        if multi:
+            nread, docs = self._select(conn, spec)
+        else:
+            docs = [x for x in [self._select_first(conn, spec)] if x is not None]
+        for doc in docs:
+            conn.execute('DELETE FROM "%s" WHERE id = ?' % self.full_name, (_id_key(doc['_id']),))
+        return {'n': len(docs), 'ok': 1}
+
+    def find_and_modify(self, query=None, update=None, upsert=False, sort=None, fields=None, new=False,
+                        remove=False):
+        """
+        Atomically modify and return a single document, by default the document before the change
+        """
+        if query is None:
+            query = {}
+        with self._client.transaction() as conn:
+            doc = self._select_first(conn, query, sort)
+            if doc is None:
+                if upsert and not remove:
+                    doc = _upsert_doc(query, update)
+                    self._insert_doc(conn, doc)
+                    if new:
+                        return project(doc, fields)
+                return None
+            if remove:
+                conn.execute('DELETE FROM "%s" WHERE id = ?' % self.full_name, (_id_key(doc['_id']),))
+                return project(doc, fields)
+            old = json.loads(_dumps(doc), object_hook=_decode)
+            self._write(conn, apply_update(doc, update))
+            if new:
+                return project(doc, fields)
+            return project(old, fields)
+
+    def drop(self):
+        self._client.execute('DROP TABLE IF EXISTS "%s"' % self.full_name)
+
+    # Indexes
+
+    def create_index(self, key_or_list, **kwargs):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, 1)]
+        return self._create_index(key_or_list, kwargs.get('name'))
+
+    def create_indexes(self, indexes):
+        ret = []
+        with self._client.transaction():
+            for model in indexes:
+                ret.append(self._create_index(model.document['key'].items(), model.document['name']))
+        return ret
+
+    def _create_index(self, keys, name=None):
+        """
+        Index on the JSON values of the fields, an index on the type of each field is also
+        created as the translated queries also select documents where the field is an array
+        """
+        if name is None:
+            name = '_'.join(['%s_%s' % (field, direction) for field, direction in keys])
+        columns = []
+        for field, direction in keys:
+            if field == '_id':
+                continue
+            path = _json_path(field)
+            if path is None:
+                continue
+            columns.append(_extract(path))
+            self._client.execute('CREATE INDEX IF NOT EXISTS "%s.%s_type" ON "%s" (%s)' %
+                                 (self.full_name, field, self.full_name, _json_type(path)))
+        if len(columns) > 0:
+            self._client.execute('CREATE INDEX IF NOT EXISTS "%s.%s" ON "%s" (%s)' %
+                                 (self.full_name, name, self.full_name, ', '.join(columns)))
+        return name
+
+    def index_information(self):
+        ret = {'_id_': {'key': [('_id', 1)]}}
+        for row in self._client.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=?",
+                                        (self.full_name,)):
+            if row[0].startswith(self.full_name + '.') and not row[0].endswith('_type'):
+                ret[row[0][len(self.full_name) + 1:]] = {}
+        return ret
+
+    # Bulk operations
+
+    def initialize_ordered_bulk_op(self):
+        return SQLiteBulk(self, ordered=True)
+
+    def initialize_unordered_bulk_op(self):
+        return SQLiteBulk(self, ordered=False)
+
+
+class SQLiteCursor():
+
+    def __init__(self, collection, spec, projection):
+        self.collection = collection
+        self.spec = spec
+        self.projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._docs = None
+
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction)]
+        self._sort = list(key_or_list)
+        return self
+
+    def skip(self, number):
+        self._skip = number
+        return self
+
+    def limit(self, number):
+        self._limit = number
+        return self
+
+    def _select(self):
+        client = self.collection._client
+        conn = client._connection()
+        with client._lock:
+            nread, docs = self.collection._select(conn, self.spec)
+        if self._sort is not None:
+            docs = sort_documents(docs, self._sort)
+        return nread, docs
+
+    def _window(self, docs):
+        if self._limit > 0:
+            return itertools.islice(docs, self._skip, self._skip + self._limit)
+        return itertools.islice(docs, self._skip, None)
+
+    def _documents(self):
+        # Sorting requires all the matching documents, otherwise they are read lazily
+        if self._sort is not None:
+            nread, docs = self._select()
+        else:
+            docs = self.collection._scan(self.spec)
+        for doc in self._window(docs):
+            yield project(doc, self.projection)
+
+    def count(self, with_limit_and_skip=False):
+        docs = self.collection._scan(self.spec)
+        if with_limit_and_skip:
+            docs = self._window(docs)
+        return sum(1 for doc in docs)
+
+    def explain(self):
+        """
+        Execution plan in the format of MongoDB servers before 3.0, the cursor is 'BtreeCursor <index>'
+        if SQLite uses one of the indexes of the collection and 'BasicCursor' otherwise
+        """
+        sql, params = _compile_query(self.spec if self.spec is not None else {})
+        statement = 'SELECT doc FROM "%s"' % self.collection.full_name
+        if sql is not None:
+            statement += ' WHERE ' + sql
+        index = None
+        for row in self.collection._client.execute('EXPLAIN QUERY PLAN ' + statement, params):
+            if 'PRIMARY KEY' in row[-1] or 'sqlite_autoindex' in row[-1]:
+                index = '_id_'
+            else:
+                found = re.search(r'USING (?:COVERING )?INDEX (\S+)', row[-1])
+                if found is not None:
+                    index = found.group(1)[len(self.collection.full_name) + 1:]
+            if index is not None:
+                break
+        start = time.time()
+        nread, docs = self._select()
+        millis = int(1000 * (time.time() - start))
+        if index is None:
+            cursor = 'BasicCursor'
+        else:
+            cursor = 'BtreeCursor ' + index
+        return {'cursor': cursor, 'n': len(list(self._window(docs))), 'nscannedObjects': nread, 'nscanned': nread,
+                'millis': millis}
+
+    def __iter__(self):
+        if self._docs is None:
+            self._docs = self._documents()
+        return self
+
+    def next(self):
+        if self._docs is None:
+            self.__iter__()
+        return self._docs.next()
+
+
+class SQLiteBulk():
+    """
+    Bulk of operations executed on a single transaction.
+    Ordered bulks stop at the first error, unordered bulks apply all the other operations,
+    in both cases the operations applied are committed and BulkWriteError is raised
+    """
+
+    def __init__(self, collection, ordered=True):
+        self.collection = collection
+        self.ordered = ordered
+        self._operations = []
+
+    def insert(self, document):
+        self._operations.append(('insert', document))
+
+    def find(self, selector):
+        return _SQLiteBulkSelector(self, selector)
+
+    def execute(self):
+        result = {'nInserted': 0, 'nMatched': 0, 'nModified': 0, 'nUpserted': 0, 'nRemoved': 0,
+                  'upserted': [], 'writeErrors': [], 'writeConcernErrors': []}
+        collection = self.collection
+        with collection._client.transaction() as conn:
+            for index, operation in enumerate(self._operations):
+                try:
+                    if operation[0] == 'insert':
+                        collection._insert_doc(conn, operation[1])
+                        result['nInserted'] += 1
+                    elif operation[0] == 'update':
+                        selector, document, upsert, multi = operation[1:]
+                        ret = collection._update(conn, selector, document, upsert, multi)
+                        if 'upserted' in ret:
+                            result['nUpserted'] += 1
+                            result['upserted'].append({'index': index, '_id': ret['upserted']})
+                        else:
+                            result['nMatched'] += ret['n']
+                            result['nModified'] += ret['n']
+                    elif operation[0] == 'remove':
+                        selector, multi = operation[1:]
+                        result['nRemoved'] += collection._remove(conn, selector, multi)['n']
+                except DuplicateKeyError as exc:
+                    result['writeErrors'].append({'index': index, 'code': 11000, 'errmsg': str(exc),
+                                                  'op': operation[1]})
+                    if self.ordered:
+                        break
+        self._operations = []
+        if len(result['writeErrors']) > 0:
+            raise BulkWriteError(result)
+        return result
+
+
+class _SQLiteBulkSelector():
+
+    def __init__(self, bulk, selector):
+        self.bulk = bulk
+        self.selector = selector
+        self._upsert = False
+
+    def upsert(self):
+        self._upsert = True
+        return self
+
+    def update_one(self, update):
+        self.bulk._operations.append(('update', self.selector, update, self._upsert, False))
+
+    def update(self, update):
+        self.bulk._operations.append(('update', self.selector, update, self._upsert, True))
+
+    def replace_one(self, replacement):
+        self.bulk._operations.append(('update', self.selector, replacement, self._upsert, False))
+
+    def remove_one(self):
+        self.bulk._operations.append(('remove', self.selector, False))
+
+    def remove(self):
+        self.bulk._operations.append(('remove', self.selector, True))
+
+
+# Encoding of documents as JSON
+
+def _encode(value):
+    if isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    elif isinstance(value, Binary):
+        return {'$binary': base64.b64encode(value), '$type': value.subtype}
+    elif isinstance(value, dict):
+        return dict([(key, _encode(value[key])) for key in value])
+    elif isinstance(value, (list, tuple)):
+        return [_encode(x) for x in value]
+    elif isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _decode(value):
+    if len(value) == 1 and '$oid' in value:
+        return ObjectId(value['$oid'])
+    elif len(value) == 2 and '$binary' in value and '$type' in value:
+        return Binary(base64.b64decode(value['$binary']), value['$type'])
+    return value
+
+
+def _dumps(doc):
+    return json.dumps(_encode(doc), separators=(',', ':'))
+
+
+def _id_key(value):
+    return json.dumps(_encode(value), sort_keys=True, separators=(',', ':'))
+
+
+# Translation of queries to SQL
+
+_SQL_OPERATORS = {'$lt': '<', '$lte': '<=', '$gt': '>', '$gte': '>=', '$eq': '='}
+
+
+def _json_path(field):
+    segments = field.split('.')
+    for segment in segments:
+        if segment.isdigit() or '"' in segment or "'" in segment or segment.startswith('$'):
+            return None
+    return '$' + ''.join(['."%s"' % x for x in segments])
+
+
+def _extract(path):
+    return "json_extract(doc, '%s')" % path
+
+
+def _json_type(path):
+    return "json_type(doc, '%s')" % path
+
+
+def _sql_scalar(value):
+    return isinstance(value, (bool, int, long, float, basestring))
+
+
+def _sql_value(value):
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _compile_query(spec):
+    """
+    SQL condition that selects a superset of the documents matching 'spec'
+
+    :return: (tuple) The condition (None for no condition) and the list of parameters
+    """
+    conditions = []
+    params = []
+    for key in spec:
+        value = spec[key]
+        if key == '$and':
+            compiled = [_compile_query(x) for x in value]
+            for sql, iparams in compiled:
+                if sql is not None:
+                    conditions.append(sql)
+                    params += iparams
+        elif key == '$or':
+            compiled = [_compile_query(x) for x in value]
+            if len(compiled) > 0 and all([x[0] is not None for x in compiled]):
+                conditions.append('(' + ' OR '.join([x[0] for x in compiled]) + ')')
+                for x in compiled:
+                    params += x[1]
+        elif key.startswith('$'):
+            continue
+        elif key == '_id':
+            if isinstance(value, dict) and '$in' in value:
+                conditions.append('id IN (%s)' % ', '.join(['?' for x in value['$in']]))
+                params += [_id_key(x) for x in value['$in']]
+            elif not isinstance(value, dict):
+                conditions.append('id = ?')
+                params.append(_id_key(value))
+        else:
+            path = _json_path(key)
+            if path is None:
+                continue
+            sql, iparams = _compile_field(path, value)
+            if sql is not None:
+                conditions.append(sql)
+                params += iparams
+    if len(conditions) == 0:
+        return None, []
+    return ' AND '.join(conditions), params
+
+
+def _compile_sort(sort):
+    """
+    SQL ORDER BY for a list of (field, direction) pairs, None if a field cannot be sorted by SQLite.
+    The values are ordered first by type as MongoDB does: null or missing, numbers, strings and
+    booleans, the order of insertion is kept for equal values
+    """
+    keys = []
+    for field, direction in sort:
+        path = _json_path(field)
+        if field == '_id' or path is None:
+            return None
+        if direction < 0:
+            order = ' DESC'
+        else:
+            order = ''
+        keys.append("CASE %s WHEN 'integer' THEN 1 WHEN 'real' THEN 1 WHEN 'text' THEN 2 WHEN 'true' THEN 6 "
+                    "WHEN 'false' THEN 6 ELSE 0 END%s" % (_json_type(path), order))
+        keys.append(_extract(path) + order)
+    keys.append('rowid')
+    return ' ORDER BY ' + ', '.join(keys)
+
+
+def _compile_field(path, condition):
+    # Documents where the field is an array are always selected as MongoDB
+    # applies the conditions to each element of arrays
+    array = "%s = 'array'" % _json_type(path)
+    conditions = []
+    params = []
+    if isinstance(condition, dict) and len(condition) > 0 and all([x.startswith('$') for x in condition]):
+        for operator in condition:
+            value = condition[operator]
+            if operator in _SQL_OPERATORS and _sql_scalar(value):
+                conditions.append('(%s %s ? OR %s)' % (_extract(path), _SQL_OPERATORS[operator], array))
+                params.append(_sql_value(value))
+            elif operator == '$in' and len(value) > 0 and all([_sql_scalar(x) for x in value]):
+                conditions.append('(%s IN (%s) OR %s)' % (_extract(path), ', '.join(['?' for x in value]), array))
+                params += [_sql_value(x) for x in value]
+            elif operator == '$exists':
+                if value:
+                    # Written as a range on the text returned by json_type to use its index
+                    conditions.append("%s >= ''" % _json_type(path))
+                else:
+                    conditions.append('%s IS NULL' % _json_type(path))
+    elif _sql_scalar(condition):
+        conditions.append('(%s = ? OR %s)' % (_extract(path), array))
+        params.append(_sql_value(condition))
+    if len(conditions) == 0:
+        return None, []
+    return ' AND '.join(conditions), params
+
+
+# MongoDB semantics on documents
+
+def _values(doc, keys):
+    """
+    Values found on a document for a field given as a list of keys, arrays of
+    subdocuments are traversed as MongoDB does. Missing fields return an empty list
+    """
+    if len(keys) == 0:
+        return [doc]
+    key = keys[0]
+    if isinstance(doc, dict):
+        if key in doc:
+            return _values(doc[key], keys[1:])
+        return []
+    elif isinstance(doc, list):
+        ret = []
+        if key.isdigit() and int(key) < len(doc):
+            ret += _values(doc[int(key)], keys[1:])
+        for item in doc:
+            if isinstance(item, dict):
+                ret += _values(item, keys)
+        return ret
+    return []
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def _equal(stored, value):
+    if isinstance(stored, bool) != isinstance(value, bool):
+        return False
+    return stored == value
+
+
+def _comparable(stored, value):
+    if _is_number(stored) and _is_number(value):
+        return True
+    if isinstance(stored, basestring) and isinstance(value, basestring):
+        return True
+    return type(stored) == type(value) and not isinstance(stored, (dict, list))
+
+
+def _candidates(values):
+    """
+    Values and elements of array values, the conditions of MongoDB apply to both
+    """
+    ret = []
+    for value in values:
+        ret.append(value)
+        if isinstance(value, list):
+            ret += value
+    return ret
+
+
+def _match_operator(values, operator, value):
+    if operator == '$eq':
+        return any([_equal(x, value) for x in _candidates(values)]) or (value is None and len(values) == 0)
+    elif operator == '$ne':
+        return not _match_operator(values, '$eq', value)
+    elif operator in ['$lt', '$lte', '$gt', '$gte']:
+        for x in _candidates(values):
+            if x is None or not _comparable(x, value):
+                continue
+            if operator == '$lt' and x < value or operator == '$lte' and x <= value or \
+                    operator == '$gt' and x > value or operator == '$gte' and x >= value:
+                return True
+        return False
+    elif operator == '$in':
+        return any([_match_operator(values, '$eq', x) for x in value])
+    elif operator == '$nin':
+        return not _match_operator(values, '$in', value)
+    elif operator == '$exists':
+        return (len(values) > 0) == bool(value)
+    elif operator == '$all':
+        for x in values:
+            if isinstance(x, list) and all([any([_equal(y, z) for y in x]) for z in value]):
+                return True
+        return False
+    elif operator == '$mod':
+        return any([_is_number(x) and x % value[0] == value[1] for x in _candidates(values)])
+    elif operator == '$size':
+        return any([isinstance(x, list) and len(x) == value for x in values])
+    elif operator == '$not':
+        return not _match_condition(values, value)
+    else:
+        raise ValueError('Operator not supported: %s' % operator)
+
+
+def _match_condition(values, condition):
+    if isinstance(condition, dict) and len(condition) > 0 and all([x.startswith('$') for x in condition]):
+        return all([_match_operator(values, x, condition[x]) for x in condition])
+    return _match_operator(values, '$eq', condition)
+
+
+def match(doc, spec):
+    """
+    True if the document matches the query 'spec' with the semantics of MongoDB
+
+    :param doc: (dict) The document
+    :param spec: (dict) The query
+    :return: (bool)
+    """
+    for key in spec:
+        condition = spec[key]
+        if key == '$and':
+            if not all([match(doc, x) for x in condition]):
+                return False
+        elif key == '$or':
+            if not any([match(doc, x) for x in condition]):
+                return False
+        elif key == '$nor':
+            if any([match(doc, x) for x in condition]):
+                return False
+        elif not _match_condition(_values(doc, key.split('.')), condition):
+            return False
+    return True
+
+
+def _set_field(doc, field, value):
+    keys = field.split('.')
+    for key in keys[:-1]:
+        if not isinstance(doc.get(key), dict):
+            doc[key] = {}
+        doc = doc[key]
+    doc[keys[-1]] = value
+
+
+def _unset_field(doc, field):
+    keys = field.split('.')
+    for key in keys[:-1]:
+        if not isinstance(doc.get(key), dict):
+            return
+        doc = doc[key]
+    doc.pop(keys[-1], None)
+
+
+def apply_update(doc, update):
+    """
+    Apply a MongoDB update to a document, the update could be a replacement document
+    or use the operators $set, $unset and $inc
+
+    :param doc: (dict) The document, modified in place
+    :param update: (dict) The update
+    :return: (dict) The document
+    """
+    if not any([x.startswith('$') for x in update]):
+        entry_id = doc['_id']
+        doc.clear()
+        doc.update(json.loads(_dumps(update), object_hook=_decode))
+        doc['_id'] = entry_id
+        return doc
+    for operator in update:
+        fields = update[operator]
+        for field in fields:
+            if operator == '$set':
+                _set_field(doc, field, json.loads(_dumps(fields[field]), object_hook=_decode))
+            elif operator == '$unset':
+                _unset_field(doc, field)
+            elif operator == '$inc':
+                values = _values(doc, field.split('.'))
+                if len(values) > 0:
+                    _set_field(doc, field, values[0] + fields[field])
+                else:
+                    _set_field(doc, field, fields[field])
+            else:
+                raise ValueError('Update operator not supported: %s' % operator)
+    return doc
+
+
+def _upsert_doc(spec, update):
+    doc = {}
+    for key in spec:
+        if not key.startswith('$') and not isinstance(spec[key], dict):
+            _set_field(doc, key, spec[key])
+    if '_id' not in doc:
+        doc['_id'] = ObjectId()
+    return apply_update(doc, update)
+
+
+def project(doc, projection):
+    """
+    Fields of a document selected by a projection given as a list of fields
+    or as a dictionary with values 1 (include) or 0 (exclude)
+    """
+    if projection is None:
+        return doc
+    if isinstance(projection, dict):
+        include = [x for x in projection if projection[x]]
+        exclude = [x for x in projection if not projection[x]]
+    else:
+        include = list(projection)
+        exclude = []
+    if len(include) == 0:
+        ret = json.loads(_dumps(doc), object_hook=_decode)
+        for field in exclude:
+            _unset_field(ret, field)
+        return ret
+    ret = {}
+    if '_id' not in exclude:
+        ret['_id'] = doc['_id']
+    for field in include:
+        if field == '_id':
+            continue
+        values = _values(doc, field.split('.'))
+        if len(values) > 0:
+            _set_field(ret, field, values[0])
+    return ret
+
+
+def _sort_key(value):
+    # Order of types used by MongoDB: null, numbers, strings, objects, arrays, ObjectId, booleans
+    if value is None:
+        return 0, None
+    elif _is_number(value):
+        return 1, value
+    elif isinstance(value, basestring):
+        return 2, value
+    elif isinstance(value, dict):
+        return 3, sorted(value.items())
+    elif isinstance(value, list):
+        return 4, value
+    elif isinstance(value, ObjectId):
+        return 5, str(value)
+    elif isinstance(value, bool):
+        return 6, value
+    return 7, value
+
+
+def sort_documents(docs, sort):
+    """
+    Sort documents by a list of (field, direction) pairs
+    """
+    docs = list(docs)
+    for field, direction in reversed(list(sort)):
+        def key(doc):
+            values = _values(doc, field.split('.'))
+            if len(values) == 0:
+                return _sort_key(None)
+            return _sort_key(values[0])
+        docs.sort(key=key, reverse=(direction < 0))
+    return docs
@@ -11,7 +11,6 @@ from ase.constraints import FixAtoms, UnitCellFilter
 
 import pychemia
 import pychemia.external.ase
-from pychemia.serializer import generic_serializer
 
 
 class AseObjectiveFunction():
@@ -61,8 +60,8 @@ class AseEvaluator():
         energy = ase_structure.get_potential_energy()
         forces = ase_structure.get_forces()
         stress = ase_structure.get_stress()
-        new_properties = {'energy': float(energy), 'forces': generic_serializer(forces),
-                          'stress': generic_serializer(stress)}
+        # Forces and stress are stored as binary arrays by the database
+        new_properties = {'energy': float(energy), 'forces': forces, 'stress': stress}
 
         self.population.db.update(imember, structure=new_structure, properties=new_properties)
 
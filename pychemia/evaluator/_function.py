@@ -1,9 +1,9 @@
 __author__ = 'Guillermo Avendano-Franco'
 
 import os
-import time
 import numpy as np
-from threading import Thread
+from multiprocessing import Pool
+from threading import Thread, Event
 
 
 class FunctionObjectiveFunction():
@@ -26,10 +26,29 @@ class FunctionObjectiveFunction():
 
 
 class FunctionEvaluator():
-    def __init__(self):
+    def __init__(self, vectorized=False, nparal=1, chunksize=64, sleep_time=1):
+        """
+        Evaluates the objective function of the population ('population.function') for the
+        active members without value. Each pass of the evaluator gathers all those members
+        and writes their values back with a single call to 'population.set_values' when the
+        population supports it.
+
+        :param vectorized: (bool) The function takes a matrix with the coordinates of all the members
+                           on its rows and returns a vector of values, it is called once per pass
+        :param nparal: (int) Number of processes used to call a function that is not vectorized,
+                       the function must be defined at the top level of a module so it can be pickled
+        :param chunksize: (int) Number of members sent at once to each process
+        :param sleep_time: (float) Seconds to wait when there are no members to evaluate
+        """
         self.process = None
         self.thread = None
         self.population = None
+        self.vectorized = vectorized
+        self.nparal = nparal
+        self.chunksize = chunksize
+        self.sleep_time = sleep_time
+        self.pool = None
+        self._stop_event = Event()
 
     @property
     def is_running(self):
@@ -46,26 +65,75 @@ class FunctionEvaluator():
         y = self.population.function(x)
         if y is not None:
             self.population.set_value(i, y)
-            self.population.evaluated.append(i)
+
+    def evaluate_batch(self):
+        """
+        Evaluate all the active members without value
+
+        :return: (int) Number of members evaluated
+        """
+        population = self.population
+        if hasattr(population, 'actives_no_evaluated'):
+            selection = population.actives_no_evaluated
+        else:
+            selection = [i for i in population.actives if not population.is_evaluated(i)]
+        if len(selection) == 0:
+            return 0
+        if hasattr(population, 'coordinates'):
+            x = population.coordinates(selection)
+        else:
+            x = np.array([population.coordinate(i) for i in selection])
+
+        if self.vectorized:
+            # Members with NaN values are left without value
+            values = np.asarray(population.function(x), dtype=float)
+            valid = ~np.isnan(values)
+            selection = [i for i, ok in zip(selection, valid) if ok]
+            values = values[valid]
+        elif self.nparal > 1:
+            if self.pool is None:
+                self.pool = Pool(self.nparal)
+            values = self.pool.map(population.function, list(x), chunksize=self.chunksize)
+        else:
+            values = [population.function(xi) for xi in x]
+        if not self.vectorized:
+            # Members with None values are left without value
+            valid = [y is not None for y in values]
+            selection = [i for i, ok in zip(selection, valid) if ok]
+            values = [y for y, ok in zip(values, valid) if ok]
+
+        if len(selection) == 0:
+            return 0
+        if hasattr(population, 'set_values'):
+            population.set_values(selection, values)
+        else:
+            for i, y in zip(selection, values):
+                population.set_value(i, y)
+        return len(selection)
 
     def run(self):
 
-        def worker(evaluator, population):
-            while True:
-                for i in population.actives:
-                    if not population.is_evaluated(i):
-                        evaluator.evaluate(i)
-                time.sleep(1)
+        def worker(evaluator):
+            while not evaluator._stop_event.is_set():
+                if evaluator.evaluate_batch() == 0:
+                    evaluator._stop_event.wait(evaluator.sleep_time)
                 if os.path.exists('stop'):
                     os.remove('stop')
                     return
 
         # self.process = Process(target=worker, args=(self.population,))
         #self.process.start()
-        self.thread = Thread(target=worker, args=(self, self.population,))
+        self._stop_event.clear()
+        self.thread = Thread(target=worker, args=(self,))
         self.thread.daemon = True
         self.thread.start()
 
     def stop(self):
+        self._stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
         if self.process is not None and not self.process.is_alive():
             self.process.terminate()
@@ -6,20 +6,23 @@ __author__ = 'Guillermo Avendano-Franco'
 
 import uuid
 import json
+import copy
 import numpy as np
 
 from pychemia import Composition, Structure, log
 from pychemia.db import USE_MONGO
 
 if USE_MONGO:
-    from pychemia.db import PyChemiaDB, get_database
+    from pychemia.db import get_database, object_id, prepare_fields, max_abs
+    from pychemia.db._arrays import decode_arrays
+    from _stream import export_population, import_population, json_default
 from pychemia.analysis import StructureAnalysis, StructureChanger
 from pychemia.utils.mathematics import unit_vector
 
 
 class StructurePopulation():
     def __init__(self, name, composition, tag='global', delta=0.1, target_forces=1E-3, value_tol=1E-2,
-                 distance_tol=0.3, min_comp_mult=2, max_comp_mult=8):
+                 distance_tol=0.3, min_comp_mult=2, max_comp_mult=8, db_settings=None):
         """
         Defines a population of PyChemia Structures,
 
@@ -29,11 +32,19 @@ class StructurePopulation():
         factor for changers and mixers. In the case of populations supported on
         PyChemia databases the 'new' will erase the database
 
+        The entries read from the database are kept on a cache until 'clear_cache' is called,
+        usually at the beginning of each generation. Changes made through the methods of
+        the population are written to the database and to the cache, changes made by other
+        clients (such as evaluators) are only visible after clearing the cache
+
         :param name: The name of the population. ie the name of the database
         :param composition: The composition uniform for all the members
         :param tag: A tag to differentiate different instances running concurrently
         :param delta: The parameter to scale the changers and mixers
         :param new: If true the database will be erased
+        :param db_settings: (dict) Settings for get_database, by default a MongoDB database called 'name'
+                            on localhost. Use {'name': name, 'backend': 'sqlite', 'path': path}
+                            for a local database without server
         :return: A new StructurePopulation object
         """
         self.composition = Composition(composition)
@@ -45,35 +56,138 @@ class StructurePopulation():
         self.distance_tol = distance_tol
         self.min_comp_mult = min_comp_mult
         self.max_comp_mult = max_comp_mult
-        self.db = PyChemiaDB(name)
+        if db_settings is None:
+            db_settings = {'name': name}
+        self.db = get_database(db_settings)
+        self.db.ensure_tag_index(self.tag)
+        self._cache = {}
+        self._actives = None
+        self._members = None
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     @property
     def actives(self):
-        return [entry['_id'] for entry in self.db.entries.find({'status.' + self.tag: True}, {'_id': 1})]
+        if self._actives is None:
+            self._actives = [entry['_id'] for entry in self.db.entries.find({'status.' + self.tag: True}, {'_id': 1})]
+        return list(self._actives)
 
     @property
     def members(self):
-        return [x['_id'] for x in self.db.entries.find({}, {'_id': 1})]
+        if self._members is None:
+            self._members = [x['_id'] for x in self.db.entries.find({}, {'_id': 1})]
+        return list(self._members)
+
+    def watch(self, events=None):
+        """
+        Return a ChangeWatcher for the changes on the active members of the population,
+        see PyChemiaDB.watch
+
+        :param events: (list) Types of events: 'insert', 'structure', 'properties' and 'status'
+        :return: (ChangeWatcher)
+        """
+        return self.db.watch(events=events, query={'status.' + self.tag: True})
+
+    def clear_cache(self):
+        """
+        Forget the entries and lists of members kept in memory, the next
+        accesses will read them again from the database. The counters of hits
+        and misses are not reset
+        """
+        self._cache = {}
+        self._actives = None
+        self._members = None
+
+    def prefetch(self, selection):
+        """
+        Read with a single query all the entries in 'selection' that are not
+        already on the cache
+
+        :param selection: (list) List of identifiers
+        """
+        missing = [object_id(x) for x in selection if object_id(x) not in self._cache]
+        if len(missing) > 0:
+            for entry in self.db.get_entries(missing):
+                self._cache[entry['_id']] = entry
+            self.cache_misses += len(missing)
+
+    def _cached_entry(self, entry_id):
+        """
+        The entry from the cache, read from the database if needed.
+        The entry returned must not be modified
+        """
+        entry_id = object_id(entry_id)
+        if entry_id in self._cache:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            entry = self.db.get_entry(entry_id)
+            if entry is None:
+                return None
+            self._cache[entry_id] = entry
+        return self._cache[entry_id]
+
+    def _cache_update(self, entry_id, fields):
+        """
+        Apply to the cached entry the same changes sent to the database, arrays are
+        cached as PackedArray objects as the entries read from the database
+        """
+        entry_id = object_id(entry_id)
+        if entry_id in self._cache:
+            for key, value in decode_arrays(prepare_fields(fields)).items():
+                _set_field(self._cache[entry_id], key, value)
+
+    def _cache_insert(self, entry_id, structure, properties, status):
+        entry = decode_arrays(prepare_fields({'structure': structure, 'properties': properties, 'status': status}))
+        entry['_id'] = entry_id
+        self._cache[entry_id] = entry
+        if self._members is not None:
+            self._members.append(entry_id)
+        if self._actives is not None and status.get(self.tag):
+            self._actives.append(entry_id)
 
     @property
     def evaluated(self):
-        return [entry['_id'] for entry in self.db.entries.find() if self.is_evaluated(entry['_id'])]
+        return self.db.find_evaluated(self.target_forces)
 
-    def get_entry(self, entry_id, with_id=True):
+    def get_entry(self, entry_id, with_id=True, fields=None):
         """
         Return an entry identified by 'entry_id'
 
         :param entry_id: A database identifier
+        :param with_id: (bool) If False the identifier is removed from the entry
+        :param fields: (list) Fields to retrieve, by default the whole entry
         :return:
         """
-        entry = self.db.entries.find_one({'_id': entry_id})
-        if entry is not None and not with_id:
+        entry = self._cached_entry(entry_id)
+        if entry is None:
+            return None
+        if fields is None:
+            entry = copy.deepcopy(entry)
+        else:
+            entry = _project(entry, fields)
+        if not with_id:
             entry.pop('_id')
         return entry
 
     def get_structure(self, entry_id):
-        entry = self.get_entry(entry_id)
-        return Structure.from_dict(entry['structure'])
+        return Structure.from_dict(self._cached_entry(entry_id)['structure'])
+
+    def update(self, entry_id, structure=None, properties=None, status=None):
+        """
+        Replace the structure, properties and/or status of an entry,
+        see PyChemiaDB.update
+        """
+        fields = {}
+        if structure is not None:
+            fields['structure'] = structure
+        if properties is not None:
+            fields['properties'] = properties
+        if status is not None:
+            fields['status'] = status
+            self._actives = None
+        self.db.update(entry_id, structure=structure, properties=properties, status=status)
+        self._cache_update(entry_id, fields)
 
     @staticmethod
     def new_identifier():
@@ -82,25 +196,25 @@ class StructurePopulation():
     def new_entry(self, structure, active=True):
         properties = {'forces': None, 'stress': None, 'energy': None}
         status = {self.tag: active}
-        return self.db.insert(structure=structure, properties=properties, status=status)
+        entry_id = self.db.insert(structure=structure, properties=properties, status=status)
+        self._cache_insert(entry_id, structure, properties, status)
+        return entry_id
+
+    def _insert_many(self, structures, properties, statuses):
+        ret = self.db.insert_many(structures, properties, statuses)
+        for entry_id, structure, iproperties, istatus in zip(ret, structures, properties, statuses):
+            self._cache_insert(entry_id, structure, iproperties, istatus)
+        return ret
 
     def get_max_force_stress(self, imember):
-        entry = self.get_entry(imember)
-        if entry is not None and entry['properties'] is not None:
-            properties = entry['properties']
-            if 'forces' not in properties or 'stress' not in properties:
-                forces = None
-                stress = None
-            elif properties['forces'] is None or properties['stress'] is None:
-                forces = None
-                stress = None
-            else:
-                forces = np.max(np.abs(np.array(entry['properties']['forces'], dtype=float).flatten()))
-                stress = np.max(np.abs(np.array(entry['properties']['stress'], dtype=float).flatten()))
-        else:
-            forces = None
-            stress = None
-        return forces, stress
+        properties = self.db.get_properties(imember, ['max_force', 'max_stress'])
+        if properties is not None and 'max_force' in properties and 'max_stress' in properties:
+            return properties['max_force'], properties['max_stress']
+        # Entries created before the maximal values were stored with the properties
+        properties = self.db.get_properties(imember, ['forces', 'stress'])
+        if properties is None:
+            return None, None
+        return max_abs(properties.get('forces')), max_abs(properties.get('stress'))
 
     def is_evaluated(self, entry_id):
         max_force, max_stress = self.get_max_force_stress(entry_id)
@@ -115,13 +229,18 @@ class StructurePopulation():
         """
         Add one random structure to the population
         """
+        return self.new_entry(self.random_structure())
+
+    def random_structure(self):
+        """
+        Creates a random structure with the composition of the population
+        multiplied by a random factor between min_comp_mult and max_comp_mult
+        """
         factor = np.random.randint(self.min_comp_mult, self.max_comp_mult + 1)
         comp = self.composition.composition.copy()
         for i in comp:
             comp[i] *= factor
-
-        structure = Structure.random_cell(comp)
-        return self.new_entry(structure)
+        return Structure.random_cell(comp)
 
     def random_population(self, n):
         """
@@ -130,7 +249,10 @@ class StructurePopulation():
         :param n: (int) The number of new structures
         :return: (list) The identifiers for the new structures
         """
-        return [self.add_random() for i in range(n)]
+        structures = [self.random_structure() for i in range(n)]
+        properties = [{'forces': None, 'stress': None, 'energy': None} for i in range(n)]
+        statuses = [{self.tag: True} for i in range(n)]
+        return self._insert_many(structures, properties, statuses)
 
     def check_duplicates(self):
         ret = []
@@ -236,57 +358,116 @@ class StructurePopulation():
 
     def add_modified(self, entry_id):
 
-        structure = self.db.get_structure(entry_id)
+        structure = self.get_structure(entry_id)
         changer = StructureChanger(structure)
         changer.random_change(self.delta)
         new_structure = changer.new_structure
         return self.new_entry(new_structure)
 
+    def add_modified_batch(self, entry_id, n):
+        """
+        Add up to 'n' new members created by random changes from a single parent.
+        Candidates with overlapping atoms are discarded before their insertion
+
+        :param entry_id: The identifier of the parent
+        :param n: (int) The number of candidates to generate
+        :return: (list) The identifiers for the new structures
+        """
+        structure = self.get_structure(entry_id)
+        changer = StructureChanger(structure)
+        candidates = changer.random_changes(n, self.delta)
+        properties = [{'forces': None, 'stress': None, 'energy': None} for i in candidates]
+        statuses = [{self.tag: True} for i in candidates]
+        return self._insert_many(candidates, properties, statuses)
+
     def disable(self, entry_id):
-        entry = self.get_entry(entry_id)
-        status = None
-        if 'status' in entry:
-            status = entry['status']
-        if status is None:
-            status = {}
-        status[self.tag] = False
-        self.db.update(entry_id, status=status)
+        self.db.update_fields(entry_id, {'status.' + self.tag: False})
+        self._cache_update(entry_id, {'status.' + self.tag: False})
+        if self._actives is not None and object_id(entry_id) in self._actives:
+            self._actives.remove(object_id(entry_id))
 
     def enable(self, entry_id):
-        entry = self.get_entry(entry_id)
-        status = None
-        if 'status' in entry:
-            status = entry['status']
-        if status is None:
-            status = {}
-        status[self.tag] = True
-        self.db.update(entry_id, status=status)
+        self.db.update_fields(entry_id, {'status.' + self.tag: True})
+        self._cache_update(entry_id, {'status.' + self.tag: True})
+        self._actives = None
+
+    def _split_actives(self):
+        """
+        Active members read from the database with a single query, split into the evaluated
+        and not evaluated members with the same condition as PyChemiaDB.find_evaluated
+
+        :return: (tuple) Lists of identifiers evaluated and not evaluated
+        """
+        evaluated = []
+        no_evaluated = []
+        for entry in self.db.entries.find({'status.' + self.tag: True},
+                                          {'properties.max_force': 1, 'properties.max_stress': 1}):
+            properties = entry.get('properties')
+            if properties is None:
+                properties = {}
+            max_force = properties.get('max_force')
+            max_stress = properties.get('max_stress')
+            if max_force is not None and max_stress is not None and \
+                    max_force < self.target_forces and max_stress < self.target_forces:
+                evaluated.append(entry['_id'])
+            else:
+                no_evaluated.append(entry['_id'])
+        return evaluated, no_evaluated
 
     @property
     def fraction_evaluated(self):
-        ret = np.sum([1 for i in self.actives if self.is_evaluated(i)])
-        return float(ret) / len(self.actives)
+        evaluated, no_evaluated = self._split_actives()
+        if len(evaluated) + len(no_evaluated) == 0:
+            return 0.0
+        return float(len(evaluated)) / (len(evaluated) + len(no_evaluated))
 
     @property
     def actives_no_evaluated(self):
-        return [x for x in self.actives if not self.is_evaluated(x)]
+        return self._split_actives()[1]
 
     @property
     def actives_evaluated(self):
-        return [x for x in self.actives if self.is_evaluated(x)]
+        return self.db.find_evaluated(self.target_forces, {'status.' + self.tag: True})
 
     def save_json(self, filename):
         ret = []
         for entry_id in self.members:
             ret.append(self.get_entry(entry_id, with_id=False))
         filep = open(filename, 'w')
-        json.dump(ret, filep, sort_keys=True, indent=4, separators=(',', ': '))
+        json.dump(ret, filep, sort_keys=True, indent=4, separators=(',', ': '), default=json_default)
+        filep.close()
 
     def load_json(self, filename):
         filep = open(filename, 'r')
         data = json.load(filep)
-        for entry in data:
-            self.db.entries.insert(entry)
+        structures = [entry['structure'] for entry in data]
+        properties = [entry.get('properties') for entry in data]
+        statuses = [entry.get('status') for entry in data]
+        self.db.insert_many(structures, properties, statuses, ordered=False)
+        self.clear_cache()
+
+    def export_entries(self, basename, batch_size=1000):
+        """
+        Export all the members on '<basename>.jsonl' and '<basename>.arrays', the entries are read
+        in batches so populations larger than the memory can be exported.
+        See pychemia.population._stream for the format
+
+        :param basename: (str) Path of the files without extension
+        :param batch_size: (int) Number of entries read from the database at once
+        :return: (int) Number of entries exported
+        """
+        return export_population(self, basename, batch_size=batch_size)
+
+    def import_entries(self, basename, batch_size=1000):
+        """
+        Insert the entries exported with 'export_entries', they receive new identifiers
+        and the status of the exported tag is moved to the tag of this population
+
+        :param basename: (str) Path of the files without extension
+        :param batch_size: (int) Number of entries inserted at once
+        :return: (list) Identifiers of the new entries
+        """
+        return import_population(self, basename, batch_size=batch_size)
 
     def move(self, imember, jmember, in_place=False):
         """
@@ -315,7 +496,7 @@ class StructurePopulation():
         if not in_place:
             return self.new_entry(new_structure)
         else:
-            return self.db.update(imember, structure=new_structure)
+            return self.update(imember, structure=new_structure)
 
     def __str__(self):
         ret = ' Structure Population\n\n'
@@ -330,23 +511,23 @@ class StructurePopulation():
         return ret
 
     def unlock_all(self, name=None):
-        for i in self.members:
-            self.db.unlock(i, name=name)
+        self.db.unlock_all(name=name)
 
     def ids_sorted(self, selection):
+        self.prefetch(selection)
         values = np.array([self.value(i) for i in selection])
         argsort = np.argsort(values)
         return np.array(selection)[argsort]
 
     def get_values(self, selection):
+        self.prefetch(selection)
         ret = {}
         for i in selection:
             ret[i] = self.value(i)
         return ret
 
     def value(self, imember):
-        entry = self.get_entry(imember)
-        struct = self.get_structure(imember)
+        entry = self._cached_entry(imember)
         if 'properties' not in entry:
             log.debug('This entry has no properties %s' % str(entry['_id']))
             return None
@@ -355,5 +536,37 @@ class StructurePopulation():
         elif 'energy' not in entry['properties']:
             log.debug('This entry has no energy in properties %s' % str(entry['_id']))
             return None
+        elif entry['properties']['energy'] is None:
+            return None
+        elif 'composition' in entry:
+            return entry['properties']['energy'] / entry['composition']['gcd']
+        else:
+            return entry['properties']['energy'] / Structure.from_dict(entry['structure']).get_composition().gcd
+
+
+def _set_field(entry, key, value):
+    """
+    Set a field on a document, nested fields use the dot notation
+    """
+    keys = key.split('.')
+    for ikey in keys[:-1]:
+        if entry.get(ikey) is None:
+            entry[ikey] = {}
+        entry = entry[ikey]
+    entry[keys[-1]] = copy.deepcopy(value)
+
+
+def _project(entry, fields):
+    """
+    Copy of a document with only the given fields, nested fields use the dot notation
+    """
+    ret = {'_id': entry['_id']}
+    for key in fields:
+        value = entry
+        for ikey in key.split('.'):
+            if not isinstance(value, dict) or ikey not in value:
+                break
+            value = value[ikey]
         else:
-            return entry['properties']['energy'] / struct.get_composition().gcd
+            _set_field(ret, key, value)
+    return ret
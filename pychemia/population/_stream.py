@@ -0,0 +1,235 @@
+"""
+Streaming export and import of the entries of a population
+
+The entries are written on a file and a directory:
+
+    <basename>.jsonl   One JSON document per line, the first line is a header with the
+                       name, tag and composition of the population. Each entry keeps the
+                       structure, properties and status without their numeric arrays and
+                       'arrays' with the shape of each array removed
+    <basename>.arrays  Directory with one NPY file of a flat float64 array for each field with
+                       arrays ('structure.cell.npy', 'structure.reduced.npy', 'properties.forces.npy',
+                       ...), with the values of all the entries concatenated on the order of the lines
+
+Entries are read from the database in batches and the arrays are written on temporary files
+while the entries are exported. The NPY files are memory mapped when the entries are imported,
+so the memory used by both operations does not grow with the size of the population.
+Exports of version 1 stored the arrays on a single '<basename>.npz' file, they can still be imported
+"""
+
+__author__ = 'Guillermo Avendano-Franco'
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from pychemia.utils.computing import unicode2string
+from pychemia.db import USE_MONGO
+
+if USE_MONGO:
+    from pychemia.db import object_id, PackedArray
+    from pychemia.db._arrays import ARRAY_PROPERTIES, is_packed
+    from pychemia.db._compat import ObjectId
+    from pychemia.serializer import unpack_array
+
+FORMAT = 'pychemia.population'
+VERSION = 2
+
+# Arrays of the structure stored on the sidecar file
+_STRUCTURE_ARRAYS = ['cell', 'reduced', 'positions']
+
+# Fields of the status that are not exported
+_TRANSIENT_STATUS = ['lock', 'lease']
+
+
+def json_default(value):
+    """
+    Conversion of the values not supported by the json module, used as 'default' for json.dump
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    elif isinstance(value, PackedArray):
+        return value.tolist()
+    elif isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('Not JSON serializable: %s' % type(value))
+
+
+def _as_array(name, value):
+    """
+    Numeric array for the value of the field 'name', None if the value is not stored as array
+    """
+    if value is None:
+        return None
+    if is_packed(value):
+        return unpack_array(value)
+    if isinstance(value, (PackedArray, np.ndarray)):
+        return np.asarray(value)
+    if name in ARRAY_PROPERTIES and isinstance(value, (list, tuple)):
+        try:
+            return np.array(value, dtype=float)
+        except ValueError:
+            return None
+    return None
+
+
+def export_population(population, basename, batch_size=1000):
+    """
+    Export all the members of a population, see the module documentation for the format
+
+    :param population: (StructurePopulation) The population
+    :param basename: (str) Path of the files without extension
+    :param batch_size: (int) Number of entries read from the database at once
+    :return: (int) Number of entries exported
+    """
+    members = population.members
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(basename)))
+    arrays = {}
+    wf = None
+    try:
+        wf = open(basename + '.jsonl', 'w')
+        _export_entries(population, members, wf, tmpdir, arrays, batch_size)
+        wf.close()
+
+        if os.path.isdir(basename + '.arrays'):
+            shutil.rmtree(basename + '.arrays')
+        os.mkdir(basename + '.arrays')
+        for key in arrays:
+            arrays[key].close()
+            _write_npy(tmpdir + os.sep + key, basename + '.arrays' + os.sep + key + '.npy')
+    finally:
+        if wf is not None:
+            wf.close()
+        for key in arrays:
+            arrays[key].close()
+        shutil.rmtree(tmpdir)
+    return len(members)
+
+
+def _export_entries(population, members, wf, tmpdir, arrays, batch_size):
+    """
+    Write the header and the entries on the open file 'wf', the values of the arrays are
+    appended to the files on 'tmpdir', opened on the dictionary 'arrays'
+    """
+    header = {'format': FORMAT, 'version': VERSION, 'name': population.name, 'tag': population.tag,
+              'composition': population.composition.composition}
+    wf.write(json.dumps(header, default=json_default) + '\n')
+
+    def store(key, array):
+        if key not in arrays:
+            arrays[key] = open(tmpdir + os.sep + key, 'wb')
+        arrays[key].write(np.asarray(array, dtype='<f8').tobytes())
+        return list(np.shape(array))
+
+    for i in range(0, len(members), batch_size):
+        chunk = [object_id(x) for x in members[i:i + batch_size]]
+        entries = dict([(x['_id'], x) for x in population.db.entries.find({'_id': {'$in': chunk}},
+                                                                           ['structure', 'properties', 'status'])])
+        for entry_id in chunk:
+            if entry_id not in entries:
+                continue
+            entry = entries[entry_id]
+            shapes = {}
+            structure = dict(entry['structure'])
+            for name in _STRUCTURE_ARRAYS:
+                shapes['structure.' + name] = store('structure.' + name, structure.pop(name))
+            properties = entry.get('properties')
+            if properties is not None:
+                properties = dict(properties)
+                for name in list(properties):
+                    array = _as_array(name, properties[name])
+                    if array is not None:
+                        properties.pop(name)
+                        shapes['properties.' + name] = store('properties.' + name, array)
+            status = entry.get('status')
+            if status is not None:
+                status = dict([(x, status[x]) for x in status if x not in _TRANSIENT_STATUS])
+            line = {'_id': entry_id, 'structure': structure, 'properties': properties, 'status': status,
+                    'arrays': shapes}
+            wf.write(json.dumps(line, default=json_default) + '\n')
+
+
+def _write_npy(rawfile, filename):
+    """
+    Write the float64 values of the binary file 'rawfile' as a flat array on the NPY file 'filename',
+    the values are copied in blocks
+    """
+    size = os.path.getsize(rawfile) // 8
+    wf = open(filename, 'wb')
+    np.lib.format.write_array_header_1_0(wf, {'descr': '<f8', 'fortran_order': False, 'shape': (size,)})
+    rf = open(rawfile, 'rb')
+    shutil.copyfileobj(rf, wf)
+    rf.close()
+    wf.close()
+
+
+def import_population(population, basename, batch_size=1000):
+    """
+    Insert on a population the entries exported with 'export_population' using batched writes,
+    the entries receive new identifiers and the status of the tag of the exported population
+    is moved to the tag of 'population'. The arrays are memory mapped, only the values of
+    the entries on each batch are read
+
+    :param population: (StructurePopulation) The population
+    :param basename: (str) Path of the files without extension
+    :param batch_size: (int) Number of entries inserted on the database at once
+    :return: (list) Identifiers of the new entries
+    """
+    rf = open(basename + '.jsonl', 'r')
+    header = unicode2string(json.loads(rf.readline()))
+    if header.get('format') != FORMAT:
+        raise ValueError('Not a population export: %s' % basename)
+    if header.get('version', 1) == 1:
+        npz = np.load(basename + '.npz')
+    else:
+        npz = None
+    loaded = {}
+    offsets = {}
+    ret = []
+    structures, properties, statuses = [], [], []
+
+    def flush():
+        ret.extend(population.db.insert_many(structures, properties, statuses, ordered=False))
+        del structures[:], properties[:], statuses[:]
+
+    for line in rf:
+        entry = unicode2string(json.loads(line))
+        structure = entry['structure']
+        entry_properties = entry['properties']
+        for key, shape in entry['arrays'].items():
+            size = int(np.prod(shape))
+            start = offsets.get(key, 0)
+            if key not in loaded:
+                if npz is not None:
+                    loaded[key] = npz[key]
+                else:
+                    loaded[key] = np.load(basename + '.arrays' + os.sep + key + '.npy', mmap_mode='r')
+            array = loaded[key][start:start + size].reshape(shape)
+            offsets[key] = start + size
+            section, name = key.split('.', 1)
+            if section == 'structure':
+                structure[name] = array.tolist()
+            else:
+                if entry_properties is None:
+                    entry_properties = {}
+                entry_properties[name] = np.array(array)
+        status = entry['status']
+        if status is not None and header['tag'] != population.tag and header['tag'] in status:
+            status[population.tag] = status.pop(header['tag'])
+        structures.append(structure)
+        properties.append(entry_properties)
+        statuses.append(status)
+        if len(structures) == batch_size:
+            flush()
+    if len(structures) > 0:
+        flush()
+    rf.close()
+    if npz is not None:
+        npz.close()
+    loaded = None
+    population.clear_cache()
+    return ret
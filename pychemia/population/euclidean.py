@@ -1,12 +1,29 @@
 __author__ = 'Guillermo Avendano-Franco'
 
+import os
 import uuid
 import numpy as np
+from threading import RLock, Condition
 
 
 class EuclideanPopulation():
 
-    def __init__(self, function, ndim, limits, delta=0.1):
+    def __init__(self, function, ndim, limits, delta=0.1, capacity=1024):
+        """
+        Population of points on a box of 'ndim' dimensions evaluated with 'function'
+
+        The coordinates, values and the active and evaluated flags of all the members are
+        stored on numpy arrays with one row per member, so the distances, duplicate checks
+        and moves over many members are computed without loops over the members. The arrays
+        grow as needed, 'capacity' is only the initial number of rows
+
+        :param function: Objective function, takes a coordinate vector and returns a float
+        :param ndim: (int) Number of dimensions
+        :param limits: Lower and upper limits, as two numbers, two vectors of size 'ndim'
+                       or an array with shape (ndim, 2)
+        :param delta: (float) Scale of the changes made by 'add_modified' and 'move'
+        :param capacity: (int) Initial number of rows of the arrays
+        """
         self.function = function
         self.ndim = ndim
         self.delta = delta
@@ -16,118 +33,241 @@ class EuclideanPopulation():
             self.limits[:, 1] = limits[1]
         else:
             self.limits = np.array(limits)
-            assert (self.limits.shape == (2, ndim))
+            assert (self.limits.shape == (ndim, 2))
+
+        self._lock = RLock()
+        self._changed = Condition(self._lock)
+        self._revision = 0
+        self._x = np.zeros((capacity, ndim))
+        self._fx = np.zeros(capacity)
+        self._active = np.zeros(capacity, dtype=bool)
+        self._evaluated = np.zeros(capacity, dtype=bool)
+        # Revision of the last change of value of each member, see 'watch'
+        self._stamp = np.zeros(capacity, dtype=int)
+        self._ids = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _reserve(self, n):
+        """
+        Grow the arrays to store 'n' new members
+        """
+        size = len(self._ids) + n
+        capacity = len(self._fx)
+        if size <= capacity:
+            return
+        capacity = max(2 * capacity, size)
+        for name in ['_x', '_fx', '_active', '_evaluated', '_stamp']:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _add_rows(self, coordinates):
+        """
+        Add new active members not evaluated
+
+        :param coordinates: (numpy.ndarray) Coordinates with shape (n, ndim)
+        :return: (list) Identifiers of the new members
+        """
+        with self._lock:
+            self._reserve(len(coordinates))
+            start = len(self._ids)
+            end = start + len(coordinates)
+            self._x[start:end] = coordinates
+            self._active[start:end] = True
+            self._evaluated[start:end] = False
+            # Same identifiers as 'new_identifier', 12 random hexadecimal digits, generated at once
+            digits = os.urandom(6 * len(coordinates)).encode('hex')
+            ret = [digits[12 * i:12 * i + 12] for i in range(len(coordinates))]
+            for i, ident in enumerate(ret):
+                self._rows[ident] = start + i
+            self._ids += ret
+        return ret
+
+    def rows(self, selection):
+        """
+        :param selection: (list) Identifiers of members
+        :return: (numpy.ndarray) Row of each member on the arrays
+        """
+        return np.array([self._rows[i] for i in selection], dtype=int)
+
+    def _identifiers(self, mask):
+        return [self._ids[i] for i in np.nonzero(mask[:len(self._ids)])[0]]
 
-        self.members = []
-        self.actives = []
-        self.evaluated = []
-        self.db = {}
+    @property
+    def members(self):
+        return list(self._ids)
 
     @property
     def all_entries(self):
         return self.members
 
+    @property
+    def actives(self):
+        return self._identifiers(self._active)
+
+    @property
+    def evaluated(self):
+        return self._identifiers(self._evaluated)
+
+    @property
+    def actives_evaluated(self):
+        return self._identifiers(self._active & self._evaluated)
+
+    @property
+    def actives_no_evaluated(self):
+        return self._identifiers(self._active & ~self._evaluated)
+
+    def active_no_evaluated(self):
+        return self.actives_no_evaluated
+
     def is_evaluated(self, i):
-        if i in self.db and self.db[i]['fx'] is not None:
+        if i in self._rows and self._evaluated[self._rows[i]]:
             return True
         else:
             return False
 
     def coordinate(self, i):
-        return self.db[i]['x']
+        return self._x[self._rows[i]].copy()
+
+    def coordinates(self, selection):
+        """
+        :param selection: (list) Identifiers of members
+        :return: (numpy.ndarray) Coordinates with shape (len(selection), ndim)
+        """
+        return self._x[self.rows(selection)]
 
     def set_value(self, i, y):
-        self.db[i]['fx'] = y
+        self.set_values([i], [y])
+
+    def set_values(self, selection, values):
+        """
+        Store the values of several members at once
+
+        :param selection: (list) Identifiers of members
+        :param values: (list) Value of each member
+        """
+        with self._lock:
+            rows = self.rows(selection)
+            self._fx[rows] = values
+            self._evaluated[rows] = True
+            self._revision += 1
+            self._stamp[rows] = self._revision
+            self._changed.notify_all()
+
+    def watch(self, events=None):
+        """
+        Return a ValueWatcher that waits for new values on the active members,
+        searchers use it instead of sleeping while the members are evaluated
+
+        :param events: (list) Only 'properties' events exist on this population, kept for
+                       compatibility with StructurePopulation.watch
+        :return: (ValueWatcher)
+        """
+        return ValueWatcher(self)
 
     def random_population(self, n):
-        for i in range(n):
-            self.add_random()
+        x = np.random.rand(n, self.ndim)
+        return self._add_rows(x * (self.limits[:, 1] - self.limits[:, 0]) + self.limits[:, 0])
 
     def check_duplicates(self):
+        """
+        Among the active and evaluated members sorted by value, consecutive members with
+        values and coordinates closer than 1E-2 are duplicates, the one with the larger value
+        is returned
+
+        :return: (list) Identifiers of the duplicated members
+        """
+        rows = np.nonzero((self._active & self._evaluated)[:len(self._ids)])[0]
+        if len(rows) < 2:
+            return []
+        rows = rows[np.argsort(self._fx[rows], kind='mergesort')]
+        diffs = np.ediff1d(self._fx[rows])
+        distances = np.linalg.norm(self._x[rows[1:]] - self._x[rows[:-1]], axis=1)
+        duplicates = np.nonzero((diffs < 1E-2) & (distances < 1E-2))[0]
         ret = []
-        ids = self.actives
-        values = np.array([self.value(i) for i in self.actives if i in self.evaluated])
-        if len(values) == 0:
-            return ret
-        #else:
-        #    print 'Values', values
-        argsort = np.argsort(values)
-        diffs = np.ediff1d(values[argsort])
-        #print 'Values     ', values[argsort]
-        #print 'Differences', diffs
-        for i in range(len(values)-1):
-            idiff = diffs[i]
-            if idiff < 1E-2:
-                ident1 = ids[argsort[i]]
-                ident2 = ids[argsort[i+1]]
-                distance = self.distance(ident1, ident2)
-                if distance < 1E-2:
-                    #print x1, x2, "are too close"
-                    fx1 = self.value(ident1)
-                    fx2 = self.value(ident2)
-                    if fx2 < fx1:
-                        ret.append(ident1)
-                    else:
-                        ret.append(ident2)
+        for i in rows[duplicates + 1]:
+            if self._ids[i] not in ret:
+                ret.append(self._ids[i])
         return ret
 
     def distance(self, imember, jmember):
         # The trivial metric
-        x1 = self.db[imember]['x']
-        x2 = self.db[jmember]['x']
+        x1 = self._x[self._rows[imember]]
+        x2 = self._x[self._rows[jmember]]
         return np.linalg.norm(x2-x1)
 
+    def distance_matrix(self, selection):
+        """
+        Euclidean distances between all the pairs of members in 'selection'
+
+        :param selection: (list) Identifiers of members
+        :return: (numpy.ndarray) Matrix with shape (len(selection), len(selection))
+        """
+        x = self.coordinates(selection)
+        diff = x[:, np.newaxis, :] - x[np.newaxis, :, :]
+        return np.sqrt(np.sum(diff ** 2, axis=2))
+
     @staticmethod
     def new_identifier():
         return str(uuid.uuid4())[-12:]
 
     def add_random(self):
-        ident = self.new_identifier()
-        x = np.random.rand(self.ndim)
-        x = x*(self.limits[:, 1]-self.limits[:, 0])+self.limits[:, 0]
-        self.db[ident] = {'x': x, 'fx': None}
-        self.actives.append(ident)
-        self.members.append(ident)
-        return ident
+        return self.random_population(1)[0]
 
     def add_modified(self, ident):
-        new_ident = self.new_identifier()
-        while True:
-            x = self.db[ident]['x'].copy()
-            for i in range(self.ndim):
-                x[i] += 2*self.delta*np.random.rand() - self.delta
-            if self.limits[i, 0] < x[i] < self.limits[i, 1]:
-                break
-
-        self.db[new_ident] = {'x': x, 'fx': None}
-        self.actives.append(new_ident)
-        self.members.append(new_ident)
-        return new_ident
+        x = self.coordinate(ident)
+        new_x = x + 2 * self.delta * np.random.rand(self.ndim) - self.delta
+        outside = (new_x <= self.limits[:, 0]) | (new_x >= self.limits[:, 1])
+        # Components outside the box are changed again until they fall inside
+        while np.any(outside):
+            new_x[outside] = x[outside] + 2 * self.delta * np.random.rand(np.sum(outside)) - self.delta
+            outside = (new_x <= self.limits[:, 0]) | (new_x >= self.limits[:, 1])
+        return self._add_rows(new_x.reshape((1, self.ndim)))[0]
 
     def disable(self, ident):
-        if ident not in self.actives:
+        if ident not in self._rows or not self._active[self._rows[ident]]:
             raise ValueError(ident + ' not in actives')
-        self.actives.remove(ident)
+        self._active[self._rows[ident]] = False
+
+    def enable(self, ident):
+        self._active[self._rows[ident]] = True
 
     @property
     def fraction_evaluated(self):
-        ret = np.sum([1 for i in self.actives if i in self.evaluated])
-        return float(ret)/len(self.actives)
-
-    def active_no_evaluated(self):
-        ret = []
-        for i in self.actives:
-            if i not in self.evaluated:
-                ret.append(i)
-        return ret
+        nactives = np.sum(self._active[:len(self._ids)])
+        ret = np.sum((self._active & self._evaluated)[:len(self._ids)])
+        return float(ret)/nactives
 
     def value(self, imember):
-        return self.db[imember]['fx']
+        row = self._rows[imember]
+        if not self._evaluated[row]:
+            return None
+        return float(self._fx[row])
+
+    def values(self, selection):
+        """
+        :param selection: (list) Identifiers of members
+        :return: (numpy.ndarray) Values of the members, NaN for members not evaluated
+        """
+        rows = self.rows(selection)
+        return np.where(self._evaluated[rows], self._fx[rows], np.nan)
+
+    def get_values(self, selection):
+        return dict(zip(selection, [self.value(i) for i in selection]))
+
+    def ids_sorted(self, selection):
+        argsort = np.argsort(self.values(selection), kind='mergesort')
+        return np.array(selection)[argsort]
 
     def save(self):
         wf = open('population.dat', 'w')
         for i in sorted(self.members):
-            wf.write("%15s %12.3f %12.3f\n" % (i, self.db[i]['x'][0], self.db[i]['x'][1]))
+            x = self.coordinate(i)
+            wf.write("%15s %12.3f %12.3f\n" % (i, x[0], x[1]))
         wf.close()
         wf = open('members.dat', 'w')
         for i in sorted(self.members):
@@ -136,8 +276,9 @@ class EuclideanPopulation():
 
     def member_str(self, imember):
         ret = '('
+        x = self.coordinate(imember)
         for i in range(self.ndim):
-            ret += '%5.2f' % self.db[imember]['x'][i]
+            ret += '%5.2f' % x[i]
             if i < self.ndim-1:
                 ret += ', '
             else:
@@ -159,15 +300,63 @@ class EuclideanPopulation():
         :param in_place:
         :return:
         """
+        return self.move_many([imember], [jmember], in_place=in_place)[0]
+
+    def move_many(self, imembers, jmembers, in_place=False):
+        """
+        Moves each member of 'imembers' a distance 'delta' in the direction of
+        the corresponding member of 'jmembers'
 
-        x1 = self.db[imember]['x']
-        x2 = self.db[jmember]['x']
-        uvector = (x2-x1)/np.linalg.norm(x2 - x1)
+        :param imembers: (list) Identifiers of the members moved
+        :param jmembers: (list) Identifiers of the members giving the directions
+        :param in_place: (bool) If True the moved members are replaced, otherwise new members are created
+        :return: (list) Identifiers of the moved members
+        """
+        x1 = self.coordinates(imembers)
+        x2 = self.coordinates(jmembers)
+        norms = np.linalg.norm(x2 - x1, axis=1)
+        # Members on the same place as their targets are not moved
+        norms[norms == 0] = np.inf
+        uvectors = (x2 - x1) / norms[:, np.newaxis]
+        new_x = x1 + self.delta * uvectors
         if not in_place:
-            new_ident = self.new_identifier()
-            self.actives.append(new_ident)
-            self.members.append(new_ident)
-        else:
-            new_ident = imember
-        self.db[new_ident] = {'x': x1 + self.delta*uvector, 'fx': None}
-        return new_ident
+            return self._add_rows(new_x)
+        with self._lock:
+            rows = self.rows(imembers)
+            self._x[rows] = new_x
+            self._evaluated[rows] = False
+        return list(imembers)
+
+
+class ValueWatcher():
+    """
+    Waits for the values set on the active members of an EuclideanPopulation,
+    each call returns only the members evaluated since the previous one
+    """
+
+    def __init__(self, population):
+        self.population = population
+        self.last = population._revision
+
+    def poll(self):
+        """
+        :return: (list) Identifiers of the active members evaluated since the previous call
+        """
+        population = self.population
+        with population._lock:
+            size = len(population._ids)
+            rows = np.nonzero((population._stamp[:size] > self.last) & population._active[:size])[0]
+            self.last = population._revision
+            return [population._ids[i] for i in rows]
+
+    def wait(self, timeout=None):
+        """
+        Block until there are new values or 'timeout' seconds have passed
+
+        :param timeout: (float) Maximal time to wait in seconds, None to wait forever
+        :return: (list) Identifiers of the members evaluated, empty if the timeout was reached
+        """
+        with self.population._lock:
+            if self.population._revision == self.last:
+                self.population._changed.wait(timeout)
+            return self.poll()
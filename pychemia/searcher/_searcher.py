@@ -108,23 +108,40 @@ class Searcher():
         :return:
         """
         sleep_time = 30
+        # Wait for new properties on the active members instead of sleeping when possible
+        if hasattr(self.population, 'watch'):
+            watcher = self.population.watch(events=['properties'])
+        else:
+            watcher = None
 
         icycle = 0
         while True:
             print '\n GENERATION ', icycle
 
+            # Entries cached on the previous generation could be changed by the evaluators,
+            # new members are cached by 'run_one_cycle' before their properties are computed
+            if hasattr(self.population, 'clear_cache'):
+                self.population.clear_cache()
+
             log.debug('Enforcing the size of generation: %d' % self.generation_size)
             self.enforce_generation_size()
 
             while len(self.population.actives_evaluated) < self.fraction_evaluated * self.generation_size:
                 log.debug("Population still not evaluated ")
-                time.sleep(sleep_time)
+                if watcher is not None:
+                    watcher.wait(timeout=sleep_time)
+                else:
+                    time.sleep(sleep_time)
+
+            # The evaluators changed the properties while waiting
+            if hasattr(self.population, 'clear_cache'):
+                self.population.clear_cache()
 
             log.debug('Actives           : %10d' % len(self.population.actives))
             log.debug('Actives evaluated : %10d' % len(self.population.actives_evaluated))
 
             log.debug('Removing not evaluated...')
-            for entry_id in self.population.actves_no_evaluated:
+            for entry_id in self.population.actives_no_evaluated:
                 self.replacing(entry_id, reason='no_evaluated')
 
             log.debug('Removing duplicates...')
@@ -1,3 +1,3 @@
 __author__ = 'Guillermo Avendano Franco'
 
-from serializer import PyChemiaJsonable, generic_serializer
+from serializer import PyChemiaJsonable, generic_serializer, pack_array, unpack_array
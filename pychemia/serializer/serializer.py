@@ -1,6 +1,7 @@
 __author__ = 'Guillermo Avendano Franco'
 
 import json
+import zlib
 from abc import ABCMeta, abstractproperty
 import numpy as np
 
@@ -63,6 +64,8 @@ def generic_serializer(value):
             return list(value)
         elif value.shape[0] == 2:
             return [list(i) for i in value]
+        else:
+            return value.tolist()
     elif isinstance(value, basestring):
         return value
     elif isinstance(value, float):
@@ -71,3 +74,34 @@ def generic_serializer(value):
         return value
     else:
         raise ValueError("I do not know how to covert this: ", type(value), value)
+
+
+def pack_array(value, dtype=None, compress=True):
+    """
+    Pack a numpy array into a dictionary with its dtype, shape and raw bytes.
+    The packing is lossless for the given dtype, the bytes are optionally
+    compressed with zlib. Use unpack_array to recover the original array.
+
+    :param value: (numpy.ndarray, list) The array to pack
+    :param dtype: (str) Convert the array to this dtype before packing (Default: keep the dtype)
+    :param compress: (bool) If True the raw bytes are compressed with zlib
+    :return: (dict) Dictionary with keys 'dtype', 'shape', 'zlib' and 'data'
+    """
+    array = np.ascontiguousarray(value, dtype=dtype)
+    data = array.tobytes()
+    if compress:
+        data = zlib.compress(data)
+    return {'dtype': array.dtype.str, 'shape': list(array.shape), 'zlib': compress, 'data': data}
+
+
+def unpack_array(packed):
+    """
+    Recover a numpy array from the dictionary created by pack_array
+
+    :param packed: (dict) Dictionary with keys 'dtype', 'shape', 'zlib' and 'data'
+    :return: (numpy.ndarray)
+    """
+    data = bytes(packed['data'])
+    if packed['zlib']:
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=np.dtype(packed['dtype'])).reshape(packed['shape']).copy()
@@ -7,7 +7,8 @@ The routines and classes heavily rely on spglib
 
 try:
     import pyspglib._spglib as spg
-    from _spglib import StructureSymmetry, symmetrize
+    from _spglib import StructureSymmetry, symmetrize, get_symmetry, structure_hash
+    from _batch import analyze_structures, analyze_database, analyze_repository
     USE_SPGLIB = True
 except ImportError:
     print 'SPGLIB not found, symmetry module disabled'
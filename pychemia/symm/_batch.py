@@ -0,0 +1,203 @@
+__author__ = 'Guillermo Avendano-Franco'
+
+import os
+import json
+from multiprocessing import Pool
+
+from pychemia import Structure, log
+from pychemia.core.structure import load_structure_json
+from pychemia.utils.computing import unicode2string
+from _spglib import StructureSymmetry
+
+
+def _analyze(args):
+    """
+    Worker for the process pool, computes the symmetry information for one structure
+
+    :param args: (tuple) identifier, structure as dictionary, symprec and angle_tolerance
+    :return: (tuple) identifier, dictionary with the results (None if the analysis failed)
+             and the error message (None if the analysis succeed)
+    """
+    identifier, structure_dict, symprec, angle_tolerance = args
+    error = None
+    try:
+        structure = Structure.from_dict(structure_dict)
+        sym = StructureSymmetry(structure)
+        ret = {'symprec': symprec,
+               'angle_tolerance': angle_tolerance,
+               'number': sym.number(symprec=symprec, angle_tolerance=angle_tolerance),
+               'symbol': sym.symbol(symprec=symprec, angle_tolerance=angle_tolerance),
+               'primitive': sym.find_primitive(symprec=symprec, angle_tolerance=angle_tolerance).to_dict(),
+               'refined': sym.refine_cell(symprec=symprec, angle_tolerance=angle_tolerance).to_dict()}
+    except Exception as exc:
+        # Any failure is reported for this structure, the analysis of the others continues
+        ret = None
+        error = '%s: %s' % (type(exc).__name__, str(exc))
+    return identifier, ret, error
+
+
+def _is_analyzed(symmetry, symprec, angle_tolerance):
+    return symmetry is not None and symmetry.get('symprec') == symprec and \
+        symmetry.get('angle_tolerance') == angle_tolerance
+
+
+def analyze_structures(structures, symprec=1e-1, angle_tolerance=5, nparal=1, chunksize=16, errors=None):
+    """
+    Computes space group number and symbol, primitive cell and refined cell for many
+    structures using a pool of 'nparal' processes.
+
+    :param structures: (iterable) Pairs (identifier, structure), the structure could be a
+                       pychemia Structure or its dictionary
+    :param symprec: (float) Tolerance for distances
+    :param angle_tolerance: (float) Tolerance for angles in degrees
+    :param nparal: (int) Number of processes
+    :param chunksize: (int) Number of structures sent to each process at once
+    :param errors: (dict) If given, the error message of each failed structure is stored with its identifier
+    :return: (generator) Pairs (identifier, result), the result is a dictionary with keys 'symprec',
+             'angle_tolerance', 'number', 'symbol', 'primitive' and 'refined' or None if the analysis failed
+    """
+    def tasks():
+        for identifier, structure in structures:
+            if isinstance(structure, Structure):
+                structure = structure.to_dict()
+            yield identifier, structure, symprec, angle_tolerance
+
+    def report(identifier, ret, error):
+        if error is not None:
+            log.debug('Symmetry analysis failed for %s: %s' % (str(identifier), error))
+            if errors is not None:
+                errors[identifier] = error
+        return identifier, ret
+
+    if nparal == 1:
+        for task in tasks():
+            yield report(*_analyze(task))
+    else:
+        pool = Pool(nparal)
+        try:
+            for ret in pool.imap_unordered(_analyze, tasks(), chunksize):
+                yield report(*ret)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def analyze_database(db, symprec=1e-1, angle_tolerance=5, nparal=1, force=False, batch_size=1000):
+    """
+    Symmetry analysis of all the entries in a PyChemiaDB, the results are stored on
+    'properties.symmetry' for each entry with batched writes (PyChemiaDB.bulk_update, so the
+    entries receive new revisions and watchers are notified).
+    Entries already analyzed with the same tolerances are skipped unless 'force' is True
+
+    :param db: (PyChemiaDB) The database
+    :param symprec: (float) Tolerance for distances
+    :param angle_tolerance: (float) Tolerance for angles in degrees
+    :param nparal: (int) Number of processes
+    :param force: (bool) Analyze all the entries even if they were already analyzed
+    :param batch_size: (int) Number of results sent to the database on each batched write
+    :return: (dict) Lists of identifiers for 'succeed', 'failed' and 'skipped' entries and
+             the error message of each failed entry on 'errors'
+    """
+    report = {'succeed': [], 'failed': [], 'skipped': [], 'errors': {}}
+    # Entries without properties receive a new dictionary of properties
+    no_properties = set()
+
+    def structures():
+        for entry in db.entries.find({}, {'structure': 1, 'properties.symmetry.symprec': 1,
+                                          'properties.symmetry.angle_tolerance': 1}):
+            if entry.get('properties') is None:
+                no_properties.add(entry['_id'])
+                symmetry = None
+            else:
+                symmetry = entry['properties'].get('symmetry')
+            if not force and _is_analyzed(symmetry, symprec, angle_tolerance):
+                report['skipped'].append(entry['_id'])
+            else:
+                yield entry['_id'], entry['structure']
+
+    changes = []
+    for entry_id, result in analyze_structures(structures(), symprec, angle_tolerance, nparal,
+                                               errors=report['errors']):
+        if result is None:
+            report['failed'].append(entry_id)
+            continue
+        if entry_id in no_properties:
+            changes.append((entry_id, {'properties': {'symmetry': result, 'spacegroup': result['number']}}))
+        else:
+            changes.append((entry_id, {'properties.symmetry': result, 'properties.spacegroup': result['number']}))
+        report['succeed'].append(entry_id)
+        if len(changes) == batch_size:
+            db.bulk_update(changes, ordered=False)
+            changes = []
+    db.bulk_update(changes, ordered=False)
+    log.debug('Symmetry analysis on %s: %d succeed, %d failed, %d skipped' %
+              (db.name, len(report['succeed']), len(report['failed']), len(report['skipped'])))
+    return report
+
+
+def analyze_repository(repository, symprec=1e-1, angle_tolerance=5, nparal=1, force=False, batch_size=1000):
+    """
+    Symmetry analysis of all the entries in a StructureRepository, the results are stored
+    with the key 'symmetry' on the 'properties.json' file of each entry.
+    Entries already analyzed with the same tolerances are skipped unless 'force' is True
+
+    :param repository: (StructureRepository) The repository
+    :param symprec: (float) Tolerance for distances
+    :param angle_tolerance: (float) Tolerance for angles in degrees
+    :param nparal: (int) Number of processes
+    :param force: (bool) Analyze all the entries even if they were already analyzed
+    :param batch_size: (int) Number of results written on the index of the repository with each transaction
+    :return: (dict) Lists of identifiers for 'succeed', 'failed' and 'skipped' entries and
+             the error message of each failed entry on 'errors'
+    """
+    report = {'succeed': [], 'failed': [], 'skipped': [], 'errors': {}}
+    properties = {}
+    changes = []
+
+    def structures():
+        for ident in repository.get_all_entries:
+            path = repository.path + os.sep + ident
+            properties[ident] = _read_properties(path)
+            if not force and _is_analyzed(properties[ident].get('symmetry'), symprec, angle_tolerance):
+                report['skipped'].append(ident)
+                properties.pop(ident)
+            else:
+                yield ident, load_structure_json(path + os.sep + 'structure.json')
+
+    for ident, result in analyze_structures(structures(), symprec, angle_tolerance, nparal,
+                                            errors=report['errors']):
+        entry_properties = properties.pop(ident)
+        if result is None:
+            report['failed'].append(ident)
+            continue
+        entry_properties['symmetry'] = result
+        entry_properties['spacegroup'] = result['number']
+        # The file is replaced instead of modified, entries could be hard linked from other repository
+        filename = repository.path + os.sep + ident + os.sep + 'properties.json'
+        wf = open(filename + '.tmp', 'w')
+        json.dump(entry_properties, wf, sort_keys=True, indent=4, separators=(',', ': '))
+        wf.close()
+        os.rename(filename + '.tmp', filename)
+        changes.append((ident, entry_properties))
+        report['succeed'].append(ident)
+        if len(changes) == batch_size:
+            repository.index.set_many_properties(changes)
+            changes = []
+    repository.index.set_many_properties(changes)
+    return report
+
+
+def _read_properties(path):
+    filename = path + os.sep + 'properties.json'
+    if os.path.isfile(filename):
+        rf = open(filename, 'r')
+        try:
+            ret = unicode2string(json.load(rf))
+        except ValueError:
+            ret = {}
+        rf.close()
+        if ret is None:
+            ret = {}
+    else:
+        ret = {}
+    return ret
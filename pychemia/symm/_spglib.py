@@ -1,6 +1,8 @@
 __author__ = 'Guillermo Avendano-Franco'
 
+import hashlib
 import numpy as np
+from collections import OrderedDict
 from pychemia import Structure
 
 try:
@@ -42,6 +44,11 @@ class StructureSymmetry(object):
         # Indices starting in 1
         self._numbers = np.array([structure.species.index(x)+1 for x in structure.symbols], dtype='intc')
 
+        # Results from spglib for each (symprec, angle_tolerance)
+        self._spacegroups = {}
+        self._refined = {}
+        self._primitives = {}
+
     def spacegroup(self, symprec=1e-1, angle_tolerance=5):
         """
         Computes the space group for the structure with a given
@@ -55,9 +62,11 @@ class StructureSymmetry(object):
         :return: The space group with the symbol and number as a string
         :rtype : (str)
         """
-        return spg.spacegroup(
-            self._transposed_cell.copy(), self._reduced.copy(),
-            self._numbers, symprec, angle_tolerance)
+        key = (symprec, angle_tolerance)
+        if key not in self._spacegroups:
+            self._spacegroups[key] = spg.spacegroup(self._transposed_cell.copy(), self._reduced.copy(),
+                                                    self._numbers, symprec, angle_tolerance)
+        return self._spacegroups[key]
 
     def symbol(self, symprec=1e-1, angle_tolerance=5):
         """
@@ -101,6 +110,10 @@ class StructureSymmetry(object):
         :return: A new pychemia Structure in a Bravais lattice
         :rtype : (pychemia.Structure)
         """
+        key = (symprec, angle_tolerance)
+        if key in self._refined:
+            return self._refined[key].copy()
+
         natom = self._structure.natom
         cell = np.array(self._structure.cell.transpose(), dtype='double', order='C')
 
@@ -116,7 +129,8 @@ class StructureSymmetry(object):
 
         symbols = [self._structure.species[x] for x in (numbers[:natom_bravais]-1)]
 
-        return Structure(cell=cell, symbols=symbols, reduced=reduced)
+        self._refined[key] = Structure(cell=cell, symbols=symbols, reduced=reduced)
+        return self._refined[key].copy()
 
     def find_primitive(self, symprec=1e-1, angle_tolerance=5):
         """
@@ -131,6 +145,10 @@ class StructureSymmetry(object):
         :return: A new pychemia Structure in a Bravais lattice
         :rtype : (pychemia.Structure)
         """
+        key = (symprec, angle_tolerance)
+        if key in self._primitives:
+            return self._primitives[key].copy()
+
         # Create copies of the arguments
         cell = np.array(self._transposed_cell, dtype='double', order='C')
         reduced = np.array(self._reduced, dtype='double', order='C')
@@ -141,20 +159,89 @@ class StructureSymmetry(object):
         reduced = reduced[:natom_prim]
 
         if natom_prim > 0:
-            return Structure(cell=cell.T, reduced=reduced, symbols=symbols)
+            self._primitives[key] = Structure(cell=cell.T, reduced=reduced, symbols=symbols)
         else:
-            return self._structure.copy()
+            self._primitives[key] = self._structure.copy()
+        return self._primitives[key].copy()
+
+
+def structure_hash(structure):
+    """
+    Hash of the content of a structure relevant for the symmetry analysis:
+    cell, reduced coordinates and atomic symbols
+
+    :param structure: (pychemia.Structure)
+    :return: (str) Hexadecimal digest
+    """
+    digest = hashlib.sha1()
+    digest.update(np.array(structure.cell, dtype='double', order='C').tobytes())
+    digest.update(np.array(structure.reduced, dtype='double', order='C').tobytes())
+    digest.update(' '.join(structure.symbols).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Memoized StructureSymmetry objects, the oldest entries are discarded first
+_symmetry_cache = OrderedDict()
+_symmetry_cache_size = 128
+
+
+def get_symmetry(structure):
+    """
+    Return a StructureSymmetry object for the given structure.
+    Objects are memoized on the content of the structure, so repeated analysis
+    of the same structure reuses the results already computed by spglib
+
+    :param structure: (pychemia.Structure)
+    :return: (StructureSymmetry)
+    """
+    key = structure_hash(structure)
+    if key in _symmetry_cache:
+        sym = _symmetry_cache.pop(key)
+    else:
+        sym = StructureSymmetry(structure.copy())
+        if len(_symmetry_cache) >= _symmetry_cache_size:
+            _symmetry_cache.popitem(last=False)
+    _symmetry_cache[key] = sym
+    return sym
 
 
 def symmetrize(structure, initial_symprec=0.01, final_symprec=0.2, delta_symprec=0.01):
+    """
+    Search the lowest precision in the grid initial_symprec, initial_symprec+delta_symprec, ...
+    where the space group number increases with respect to the one found with initial_symprec.
+    The search uses bisection over the grid, assuming that the space group number
+    does not decrease with the precision. The structure is refined with that precision
+    and the primitive cell of the refined structure is returned
+
+    :param structure: (pychemia.Structure)
+    :param initial_symprec: (float) Initial tolerance in distances
+    :param final_symprec: (float) Maximal tolerance in distances
+    :param delta_symprec: (float) Step between consecutive tolerances
+    :return: (pychemia.Structure) The symmetrized primitive structure
+    """
+    sym = get_symmetry(structure)
+    initial_number = sym.number(symprec=initial_symprec)
+
+    # Number of values in the grid lower than final_symprec
+    ngrid = 0
+    while initial_symprec + ngrid * delta_symprec < final_symprec:
+        ngrid += 1
+
+    if ngrid == 0 or sym.number(symprec=initial_symprec + (ngrid - 1) * delta_symprec) <= initial_number:
+        # No jump found, use the first value beyond final_symprec
+        index = ngrid
+    else:
+        # Smallest index with a space group number higher than the initial one
+        low = 0
+        high = ngrid - 1
+        while high - low > 1:
+            middle = (low + high) // 2
+            if sym.number(symprec=initial_symprec + middle * delta_symprec) > initial_number:
+                high = middle
+            else:
+                low = middle
+        index = high
+    prec = initial_symprec + index * delta_symprec
 
-    sym = StructureSymmetry(structure)
-    prec = initial_symprec
-    while prec < final_symprec:
-        if sym.number(symprec=prec) > sym.number(symprec=initial_symprec):
-            break
-        else:
-            prec += delta_symprec
     new_bravais = sym.refine_cell(symprec=prec)
-    sym2 = StructureSymmetry(new_bravais)
-    return sym2.find_primitive()
+    return get_symmetry(new_bravais).find_primitive()
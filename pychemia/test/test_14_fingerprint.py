@@ -0,0 +1,43 @@
+__author__ = 'Guillermo Avendano-Franco'
+
+
+def test_compressed_fingerprint():
+    """
+    Tests for compressed fingerprints      :
+    """
+    import numpy as np
+    from pychemia.analysis import CompressedFingerprint
+
+    x = np.arange(0, 20, 0.01)
+    fp1 = {(0, 0): np.exp(-(x - 2.5) ** 2 / 0.02) - 1, (0, 1): np.exp(-(x - 3.1) ** 2 / 0.02) - 1}
+    fp2 = {(0, 0): np.exp(-(x - 2.6) ** 2 / 0.02) - 1, (0, 1): np.exp(-(x - 3.0) ** 2 / 0.02) - 1}
+    exact = np.mean([0.5 * (1 - np.dot(fp1[k], fp2[k]) / np.linalg.norm(fp1[k]) / np.linalg.norm(fp2[k]))
+                     for k in fp1])
+
+    cfp1 = CompressedFingerprint(fp1, factor=10)
+    cfp2 = CompressedFingerprint(fp2, factor=10)
+    assert len(cfp1.values[(0, 0)]) == 200
+    assert cfp1.values[(0, 0)].dtype == np.float32
+    assert abs(cfp1.distance(cfp2) - exact) <= cfp1.error_bound(cfp2)
+
+    # Distances to many fingerprints at once
+    many = cfp1.distances([cfp2, cfp1, cfp2])
+    assert np.allclose(many, [cfp1.distance(cfp2), 0.0, cfp1.distance(cfp2)])
+
+    # Null curves do not produce NaN
+    cfp0 = CompressedFingerprint({(0, 0): np.zeros(2000), (0, 1): np.zeros(2000)}, factor=10)
+    assert cfp0.distance(cfp0) == 0.0
+    assert cfp0.distance(cfp1) == 0.5
+    assert np.allclose(cfp1.distances([cfp0, cfp1]), [0.5, 0.0])
+
+    # Curves with residual 1 have the trivial bound
+    cfp4 = CompressedFingerprint({(0, 0): [1.0, -1.0], (0, 1): [1.0, -1.0]}, factor=2)
+    assert cfp4.residuals[(0, 0)] == 1.0
+    assert cfp4.error_bound(cfp4) == 1.0
+    assert cfp4.error_bound(cfp1) == 1.0
+
+    cfp3 = CompressedFingerprint.from_dict(cfp1.to_dict())
+    assert cfp3.distance(cfp2) == cfp1.distance(cfp2)
+
+    full = CompressedFingerprint.unpack_full(CompressedFingerprint.pack_full(fp1))
+    assert np.all(full[(0, 1)] == fp1[(0, 1)])
@@ -0,0 +1,243 @@
+__author__ = 'Guillermo Avendano-Franco'
+
+
+def test_sqlite_backend():
+    """
+    Tests for PyChemiaDB on SQLite          :
+    """
+    import os
+    import shutil
+    import tempfile
+    import numpy as np
+    import pychemia
+
+    if not pychemia.db.USE_MONGO:
+        return
+    from pychemia.db import get_database, PackedArray
+    from pychemia.population import StructurePopulation
+
+    tmpdir = tempfile.mkdtemp()
+    settings = {'name': 'test', 'backend': 'sqlite', 'path': tmpdir + os.sep + 'test.sqlite'}
+    db = get_database(settings)
+    nacl = pychemia.Structure(symbols=['Na', 'Cl'], cell=4.0, reduced=[[0, 0, 0], [0.5, 0.5, 0.5]])
+    nacl2 = pychemia.Structure(symbols=['Na', 'Cl', 'Cl'], cell=4.0,
+                               reduced=[[0, 0, 0], [0.5, 0.5, 0.5], [0.5, 0, 0]])
+    ids = db.insert_many([nacl, nacl, nacl2], statuses=[{'global': True}, {'global': False}, {'global': True}])
+    assert db.entries.count() == 3
+
+    db.update_fields(ids[0], {'properties.forces': [[0.0, 1E-4]], 'properties.stress': [1E-5]})
+    assert db.get_properties(ids[0])['max_force'] == 1E-4
+    assert db.get_properties(ids[0], ['forces'])['forces'].shape == (1, 2)
+    assert db.get_properties(ids[0], ['stress'])['stress'].tolist() == [1E-5]
+    assert db.find_evaluated(1E-3) == [ids[0]]
+    assert db.find_AnBm(specie_a='Na', n=1, m=2) == [ids[2]]
+    assert len(db.find_composition({'Na': 1, 'Cl': 1})) == 2
+
+    assert db.claim(ids[0], name='a')
+    assert not db.claim(ids[0], name='b')
+    assert db.claim_next(3, query={'status.global': True}, name='b') == [ids[2]]
+    assert db.unlock(ids[0], name='a') == 'a'
+    assert db.unlock_all() == 1
+
+    settings = dict(settings, name='population')
+    population = StructurePopulation('population', 'NaCl', db_settings=settings)
+    entry_id = population.new_entry(nacl)
+    assert population.actives == [entry_id]
+    assert population.actives_no_evaluated == [entry_id]
+    assert population.fraction_evaluated == 0.0
+    population.update(entry_id, properties={'forces': [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]], 'stress': [0.0] * 6})
+    assert population.actives_no_evaluated == []
+    assert population.fraction_evaluated == 1.0
+    population.disable(entry_id)
+    population.clear_cache()
+    assert population.actives == []
+    assert population.db.entries.count() == 1
+    assert db.entries.count() == 3
+
+    population.get_entry(entry_id)
+    population.update(entry_id, properties={'energy': -1.0, 'forces': [[0.1, 0.0, 0.0], [-0.1, 0.0, 0.0]]})
+    # Arrays are the same type from the cache and from the database
+    cached = population.get_entry(entry_id)['properties']['forces']
+    population.clear_cache()
+    stored = population.get_entry(entry_id)['properties']['forces']
+    assert isinstance(cached, PackedArray) and isinstance(stored, PackedArray)
+    assert np.all(np.array(cached) == np.array(stored))
+    assert population.export_entries(tmpdir + os.sep + 'export', batch_size=1) == 1
+    # Arrays on NPY files that can be memory mapped, the temporary files are removed
+    assert sorted([x for x in os.listdir(tmpdir) if x.startswith('export') or x.startswith('tmp')]) == \
+        ['export.arrays', 'export.jsonl']
+    forces = np.load(tmpdir + os.sep + 'export.arrays' + os.sep + 'properties.forces.npy', mmap_mode='r')
+    assert forces.shape == (6,)
+    other = StructurePopulation('other', 'NaCl', tag='other', db_settings=dict(settings, name='other'))
+    new_ids = other.import_entries(tmpdir + os.sep + 'export')
+    assert len(new_ids) == 1
+    entry = other.get_entry(new_ids[0])
+    assert entry['properties']['energy'] == -1.0
+    assert np.allclose(entry['properties']['forces'], [[0.1, 0.0, 0.0], [-0.1, 0.0, 0.0]])
+    assert np.allclose(other.get_structure(new_ids[0]).positions, nacl.positions)
+    assert entry['status']['other'] is False
+    shutil.rmtree(tmpdir)
+
+
+def test_sqlite_cursor():
+    """
+    Tests for the lazy SQLite cursors           :
+    """
+    import os
+    import shutil
+    import tempfile
+    import pychemia
+
+    if not pychemia.db.USE_MONGO:
+        return
+    from pychemia.db._sqlite import get_sqlite_client
+
+    tmpdir = tempfile.mkdtemp()
+    collection = get_sqlite_client(tmpdir + os.sep + 'test.sqlite')['test'].documents
+    collection.insert([{'n': i} for i in range(7)])
+    assert [x['n'] for x in collection._scan({'n': {'$gte': 1}}, chunk_size=2)] == range(1, 7)
+    assert [x['n'] for x in collection.find({'n': {'$gte': 1}}).skip(2).limit(3)] == [3, 4, 5]
+    assert collection.find({'n': {'$lt': 5}}).count() == 5
+    assert collection.find({'n': {'$lt': 5}}).limit(2).count(with_limit_and_skip=True) == 2
+    assert [x['n'] for x in collection.find().sort('n', -1).limit(2)] == [6, 5]
+
+    # Writes are allowed while a cursor is consumed
+    for doc in collection.find({}, {'n': 1}):
+        collection.update({'_id': doc['_id']}, {'$set': {'double': 2 * doc['n']}})
+    assert [x['double'] for x in collection.find()] == range(0, 14, 2)
+    assert collection.find_one({'double': 4})['n'] == 2
+
+    # Single document operations with the order of MongoDB: null, numbers, strings and booleans
+    collection.insert([{'n': None, 'x': 1}, {'n': 'a', 'x': 1}, {'n': True, 'x': 1}, {'x': 1}])
+    assert collection.find_and_modify({'x': 1}, {'$set': {'x': 2}}, sort=[('n', 1)])['n'] is None
+    assert collection.find_and_modify({'x': 1}, {'$set': {'x': 2}}, sort=[('n', -1)], new=True)['n'] is True
+    assert collection.find_and_modify({'x': 1}, {'$set': {'x': 2}}, sort=[('n', -1)])['n'] == 'a'
+    assert collection.find_and_modify({'n': {'$lt': 5}}, {'$set': {'x': 3}}, sort=[('n', -1)])['n'] == 4
+    assert collection.update({'x': 2}, {'$set': {'x': 4}})['n'] == 1
+    assert collection.remove({'x': 4}, multi=False)['n'] == 1
+    assert collection.find({'x': {'$gte': 2}}).count() == 3
+    # Arrays on the sort field are sorted in Python
+    collection.insert({'n': [-1, 10], 'x': 5})
+    assert collection.find_and_modify({'x': {'$in': [3, 5]}}, {'$set': {'y': 1}}, sort=[('n', -1)])['n'] == [-1, 10]
+    shutil.rmtree(tmpdir)
+
+
+def test_migrate():
+    """
+    Tests for the migration of old databases    :
+    """
+    import os
+    import shutil
+    import tempfile
+    import pychemia
+
+    if not pychemia.db.USE_MONGO:
+        return
+    from pychemia.db import get_database
+
+    tmpdir = tempfile.mkdtemp()
+    settings = {'name': 'test', 'backend': 'sqlite', 'path': tmpdir + os.sep + 'test.sqlite'}
+    db = get_database(settings)
+    nacl = pychemia.Structure(symbols=['Na', 'Cl'], cell=4.0, reduced=[[0, 0, 0], [0.5, 0.5, 0.5]])
+    ids = db.insert_many([nacl, nacl], properties=[{'forces': [[0.0, 1E-4]], 'stress': [1E-5]}, None])
+    assert db.migrate() == 0
+
+    # Entries stored by a version without composition and maximal forces
+    db.entries.update({}, {'$unset': {'composition': '', 'properties.max_force': '', 'properties.max_stress': ''}},
+                      multi=True)
+    db.entries.update({'_id': ids[1]}, {'$set': {'properties': None}})
+    db.db.counters.remove({'_id': 'pychemia_schema'})
+    assert db.find_composition({'Na': 1, 'Cl': 1}) == []
+
+    db = get_database(settings)
+    assert sorted(db.find_composition({'Na': 1, 'Cl': 1})) == sorted(ids)
+    assert db.find_evaluated(1E-3) == [ids[0]]
+    assert db.get_properties(ids[1]) == {'max_force': None, 'max_stress': None}
+    assert db.migrate() == 0
+    shutil.rmtree(tmpdir)
+
+
+def test_watcher():
+    """
+    Tests for the changes watcher on SQLite     :
+    """
+    import os
+    import shutil
+    import tempfile
+    import pychemia
+
+    if not pychemia.db.USE_MONGO:
+        return
+    from pychemia.db import get_database
+
+    tmpdir = tempfile.mkdtemp()
+    db = get_database({'name': 'test', 'backend': 'sqlite', 'path': tmpdir + os.sep + 'test.sqlite'})
+    nacl = pychemia.Structure(symbols=['Na', 'Cl'], cell=4.0, reduced=[[0, 0, 0], [0.5, 0.5, 0.5]])
+    watcher = db.watch()
+    entry_id = db.insert(nacl)
+    assert [(x['event'], x['entry_id']) for x in watcher.poll()] == [('insert', entry_id)]
+    assert watcher.poll() == []
+
+    # Two updates on different sections between polls give one event for each section
+    db.update_fields(entry_id, {'properties.energy': -1.0})
+    db.update_fields(entry_id, {'status.relaxation': 'succeed'})
+    db.update_fields(entry_id, {'status.relaxation': 'failed'})
+    events = watcher.poll()
+    assert sorted([x['event'] for x in events]) == ['properties', 'status']
+    assert watcher.poll() == []
+
+    # A write visible after a later one is recovered by the next polls
+    from pychemia.db._notify import revision_fields
+    other = db.insert(nacl)
+    watcher.poll()
+    late = db._reserve_revisions(1)
+    db.update_fields(other, {'properties.energy': -2.0})
+    assert [x['entry_id'] for x in watcher.poll()] == [other]
+    assert late in watcher._gaps
+    db.entries.update({'_id': entry_id}, {'$set': revision_fields(late, ['properties'])})
+    assert [(x['event'], x['entry_id'], x['revision']) for x in watcher.poll()] == [('properties', entry_id, late)]
+    assert late not in watcher._gaps
+    assert watcher.poll() == []
+
+    # Locks do not produce events, and the events are filtered by type
+    assert db.claim(entry_id, name='a')
+    watcher = db.watch(events=['properties'], start=0)
+    assert [x['event'] for x in watcher.poll()] == ['properties', 'properties']
+    db.bulk_update([(entry_id, {'status.relaxation': 'succeed'})])
+    assert watcher.wait(0) == []
+    shutil.rmtree(tmpdir)
+
+
+def test_indexes():
+    """
+    Tests for the declared indexes              :
+    """
+    import shutil
+    import tempfile
+    import pychemia
+
+    if not pychemia.db.USE_MONGO:
+        return
+    from pychemia.db._indexes import INDEXES, QUERIES
+
+    leading = set([index[0][0] for pattern in INDEXES for index in INDEXES[pattern]])
+    indexed = set([field for pattern in INDEXES for index in INDEXES[pattern] for field, direction in index])
+    # No index is declared without a query using it
+    assert 'status.target_forces' not in indexed
+
+    # Each clause of the query that claims pending entries can use an index
+    for clause in QUERIES['pending']['$or']:
+        assert clause.keys()[0] in leading
+    assert 'status.relaxation' in leading
+    assert 'status.lock' in leading and 'status.lease' in leading
+    assert 'composition.natom' in leading
+
+    if not pychemia.symm.USE_SPGLIB:
+        return
+    from pychemia.code.dftb import EvaluatorDaemon
+
+    # The daemon claims its entries with the same query
+    tmpdir = tempfile.mkdtemp()
+    daemon = EvaluatorDaemon({'name': 'test'}, tmpdir, 1E-3, 1, tmpdir)
+    assert daemon.evaluable_query() == QUERIES['pending']
+    shutil.rmtree(tmpdir)
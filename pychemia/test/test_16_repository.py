@@ -0,0 +1,164 @@
+__author__ = 'Guillermo Avendano-Franco'
+
+
+def test_structure_repository():
+    """
+    Tests for StructureRepository                :
+    """
+    import os
+    import shutil
+    import tempfile
+    import pychemia
+    from pychemia.db._repo import StructureRepository, StructureEntry
+
+    tmpdir = tempfile.mkdtemp()
+    path = tmpdir + os.sep + 'repo'
+    repo = StructureRepository(path)
+    nacl = pychemia.Structure(symbols=['Na', 'Cl'], cell=4.0, reduced=[[0, 0, 0], [0.5, 0.5, 0.5]])
+    mg = pychemia.Structure(symbols=['Mg'], cell=3.0, reduced=[[0, 0, 0]])
+    for structure in [nacl, nacl, mg]:
+        repo.add_entry(StructureEntry(structure=structure, tags='test'))
+    assert len(repo) == 3
+    assert sorted(repo.get_formulas().keys()) == ['ClNa', 'Mg']
+    assert len(repo.find(tag='binary')) == 2
+    ident = repo.find(formula='Mg', tag='test')[0]
+    assert repo.index.get(ident)['natom'] == 1
+
+    repo.del_entry(repo.structure_entry(ident))
+    assert len(repo) == 2
+
+    # The index is regenerated from disk
+    repo.index.close()
+    os.remove(path + os.sep + 'index.sqlite')
+    repo = StructureRepository(path)
+    assert len(repo) == 2
+    assert repo.find(formula='Mg') == []
+
+    with repo.batch():
+        for i in range(5):
+            repo.add_entry(StructureEntry(structure=nacl, tags='batch'))
+        assert repo.index.count() == 2
+    assert len(repo) == 7
+    assert not os.path.exists(path + os.sep + 'tags.journal')
+    repo.add_entry(StructureEntry(structure=mg))
+    assert os.path.isfile(path + os.sep + 'tags.journal')
+    repo = StructureRepository(path)
+    assert len(repo.tags['batch']) == 5
+    assert len(repo.tags['pure']) == 1
+
+    # All the NaCl entries are duplicates, the report is written on the repository
+    report = repo.refine()
+    assert len(report['groups']) == 1 and len(report['groups'][0]['merged']) == 6
+    assert len(repo) == 2
+    assert os.path.isfile(path + os.sep + 'refine.json')
+    assert sorted(repo.structure_entry(report['groups'][0]['kept']).tags) == ['batch', 'binary', 'test']
+
+    # Identical original files are stored once
+    cif = tmpdir + os.sep + 'NaCl.cif'
+    wf = open(cif, 'w')
+    wf.write('data_NaCl\n')
+    wf.close()
+    for i in range(2):
+        repo.add_entry(StructureEntry(structure=nacl, original_file=cif))
+    assert repo.index.blob_counts().values() == [2]
+    assert len(repo.blobs.hashes()) == 1
+
+    # Conversion to a packed archive and back
+    from pychemia.db import RepositoryArchive, pack_repository, unpack_archive
+    archive_file = tmpdir + os.sep + 'repo.pcm'
+    assert pack_repository(repo, archive_file) == len(repo)
+    archive = RepositoryArchive(archive_file)
+    ident = archive.find(formula='Mg')[0]
+    assert archive.get_structure(ident) == mg
+    assert archive.get_arrays(ident)[1].shape == (1, 3)
+    archive.close()
+    repo2 = unpack_archive(archive_file, tmpdir + os.sep + 'repo2')
+    assert sorted(repo2.get_all_entries) == sorted(repo.get_all_entries)
+    assert repo2.index.blob_counts() == repo.index.blob_counts()
+
+    # Merge by content hashes, entries on both repositories are identical
+    repo3 = StructureRepository(tmpdir + os.sep + 'repo3')
+    repo3.add_entry(StructureEntry(structure=mg, tags='other'))
+    report = repo3.merge(repo2, dry_run=True)
+    assert len(report['added']) == len(repo2) and not report['merged']
+    assert len(repo3) == 1
+    assert repo3.merge(repo2)['merged']
+    assert len(repo3) == len(repo2) + 1
+    report = repo3.merge(repo2)
+    assert len(report['identical']) == len(repo2) and report['added'] == []
+    shutil.rmtree(tmpdir)
+
+
+def test_add_many_entries():
+    """
+    Tests for StructureRepository.add_many_entries :
+    """
+    import os
+    import shutil
+    import tempfile
+    import pychemia
+    from pychemia.db import _repo
+    from pychemia.db._repo import StructureRepository
+
+    tmpdir = tempfile.mkdtemp()
+    repo = StructureRepository(tmpdir + os.sep + 'repo')
+    cifs = [tmpdir + os.sep + 'missing%d.cif' % i for i in range(3)]
+    # The files are processed by the call itself and the old argument name is accepted
+    report = repo.add_many_entries(cifs, 'icsd', number_threads=1)
+    assert sorted([x['filename'] for x in report]) == cifs
+    assert not any([x['succeed'] for x in report])
+    assert all([x['error'] is not None for x in report])
+    assert len(repo) == 0
+
+    # Reader of CIF files replaced to run without pymatgen, each file is a structure of NaCl
+    nacl = pychemia.Structure(symbols=['Na', 'Cl'], cell=4.0, reduced=[[0, 0, 0], [0.5, 0.5, 0.5]])
+
+    def read_cif(args):
+        if not os.path.isfile(args[0]):
+            return args[0], None, 'IOError: missing file'
+        return args[0], nacl.to_dict(), None
+
+    for i in range(2):
+        wf = open(tmpdir + os.sep + 'NaCl%d.cif' % i, 'w')
+        wf.write('data_NaCl%d\n' % i)
+        wf.close()
+    cifs = [tmpdir + os.sep + 'NaCl0.cif', tmpdir + os.sep + 'missing.cif', tmpdir + os.sep + 'NaCl1.cif']
+    original = _repo._read_cif
+    _repo._read_cif = read_cif
+    try:
+        # Each report is yielded when its entry is written
+        reports = repo.iter_add_many_entries(cifs, 'icsd')
+        first = next(reports)
+        assert first['succeed'] and first['filename'] == cifs[0]
+        assert os.path.isfile(repo.path + os.sep + first['identifier'] + os.sep + 'structure.json')
+        rest = list(reports)
+    finally:
+        _repo._read_cif = original
+    assert [x['succeed'] for x in rest] == [False, True]
+    repo = StructureRepository(tmpdir + os.sep + 'repo')
+    assert len(repo) == 2
+    assert sorted(repo.tags['icsd']) == sorted([first['identifier'], rest[1]['identifier']])
+    assert repo.structure_entry(first['identifier']).structure.formula == 'ClNa'
+    shutil.rmtree(tmpdir)
+
+
+def test_refine_chain():
+    """
+    Tests for refine with chained duplicates       :
+    """
+    import os
+    import shutil
+    import tempfile
+    import pychemia
+    from pychemia.db._repo import StructureRepository, StructureEntry
+
+    tmpdir = tempfile.mkdtemp()
+    repo = StructureRepository(tmpdir + os.sep + 'repo')
+    # The first and the last structures are not duplicates, each one is close to the second
+    for a in [3.0, 3.0007, 3.0014]:
+        repo.add_entry(StructureEntry(structure=pychemia.Structure(symbols=['Mg'], cell=a, reduced=[[0, 0, 0]])))
+    report = repo.refine(tolerance=1E-3)
+    assert len(report['groups']) == 1 and len(report['groups'][0]['merged']) == 1
+    assert len(repo) == 2
+    assert repo.structure_entry(report['groups'][0]['kept']).structure.cell[0, 0] == 3.0
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,66 @@
+__author__ = 'Guillermo Avendano-Franco'
+
+
+def test_euclidean_population():
+    """
+    Tests for EuclideanPopulation                :
+    """
+    import numpy as np
+    from pychemia.population import EuclideanPopulation
+
+    population = EuclideanPopulation(lambda x: float(np.sum(x ** 2)), 2, [-1, 1], capacity=4)
+    ids = population.random_population(10)
+    assert len(population) == 10
+    assert population.actives == ids
+    assert population.evaluated == []
+
+    population.set_values(ids[:5], [population.function(x) for x in population.coordinates(ids[:5])])
+    assert population.fraction_evaluated == 0.5
+    assert population.actives_no_evaluated == ids[5:]
+    assert list(population.ids_sorted(ids[:5])) == sorted(ids[:5], key=population.value)
+
+    new_id = population.add_modified(ids[0])
+    assert np.all(np.abs(population.coordinate(new_id)) < 1)
+    new_id = population.move(ids[0], ids[1])
+    assert abs(population.distance(new_id, ids[0]) - population.delta) < 1E-10
+    assert population.distance_matrix(ids[:3]).shape == (3, 3)
+
+    # A member on the same place with a larger value is a duplicate
+    copy_id = population.move_many([ids[0]], [ids[1]], in_place=False)[0]
+    population.move(copy_id, ids[0], in_place=True)
+    population.set_value(copy_id, population.value(ids[0]) + 1E-3)
+    assert population.distance(copy_id, ids[0]) < 1E-2
+    assert population.check_duplicates() == [copy_id]
+
+    population.disable(ids[0])
+    assert ids[0] not in population.actives
+    population.enable(ids[0])
+    assert ids[0] in population.actives
+
+
+def test_function_evaluator():
+    """
+    Tests for FunctionEvaluator on batch mode    :
+    """
+    import numpy as np
+    from pychemia.population import EuclideanPopulation
+    from pychemia.evaluator import FunctionEvaluator
+
+    population = EuclideanPopulation(lambda x: np.sum(x ** 2, axis=1), 3, [-1, 1])
+    ids = population.random_population(100)
+    watcher = population.watch()
+    evaluator = FunctionEvaluator(vectorized=True)
+    evaluator.initialize(population)
+    assert evaluator.evaluate_batch() == 100
+    assert evaluator.evaluate_batch() == 0
+    assert population.fraction_evaluated == 1.0
+    assert abs(population.value(ids[0]) - np.sum(population.coordinate(ids[0]) ** 2)) < 1E-10
+    assert sorted(watcher.wait(0)) == sorted(ids)
+    assert watcher.wait(0) == []
+
+    population.function = lambda x: float(np.sum(x ** 2))
+    new_id = population.add_random()
+    evaluator = FunctionEvaluator()
+    evaluator.initialize(population)
+    assert evaluator.evaluate_batch() == 1
+    assert watcher.poll() == [new_id]
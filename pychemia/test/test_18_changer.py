@@ -0,0 +1,29 @@
+__author__ = 'Guillermo Avendano-Franco'
+
+
+def test_random_changes():
+    """
+    Tests for StructureChanger.random_changes    :
+    """
+    import numpy as np
+    import pychemia
+    from pychemia.analysis import StructureChanger
+
+    np.random.seed(0)
+    structure = pychemia.Structure(symbols=['Na', 'Cl'], cell=4.0, reduced=[[0, 0, 0], [0.5, 0.5, 0.5]])
+    changer = StructureChanger(structure)
+    candidates = changer.random_changes(20, epsilon=0.1)
+    assert 0 < len(candidates) <= 20
+    for candidate in candidates:
+        assert sorted(candidate.symbols) == ['Cl', 'Na']
+        assert np.all(candidate.reduced >= 0) and np.all(candidate.reduced < 1)
+        assert np.max(np.abs(candidate.cell - structure.cell)) < 4.0 * 0.1 * 3
+
+    # Two atoms at the same place overlap, also through the boundary of the cell
+    cells = np.tile(structure.cell, (3, 1, 1))
+    reduced = np.array([[[0, 0, 0], [0.5, 0.5, 0.5]],
+                        [[0, 0, 0], [0.01, 0, 0]],
+                        [[0.001, 0, 0], [0.999, 0, 0]]])
+    symbols = np.zeros((3, 2), dtype=int)
+    assert list(changer._overlaps(cells, reduced, symbols, 0.5)) == [False, True, True]
+    assert list(changer._overlaps(cells, reduced, symbols, 0.5, chunk_size=1)) == [False, True, True]
@@ -0,0 +1,102 @@
+__author__ = 'Guillermo Avendano-Franco'
+
+
+def _rocksalt(displacement=0.0):
+    import numpy as np
+    import pychemia
+
+    fcc = np.array([[0, 0, 0], [0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]])
+    reduced = np.concatenate((fcc, fcc + [0.5, 0, 0])) % 1.0
+    reduced[0, 0] += displacement
+    return pychemia.Structure(symbols=4 * ['Na'] + 4 * ['Cl'], cell=5.6, reduced=reduced)
+
+
+def test_symmetrize():
+    """
+    Tests for symmetrize with bisection over symprec :
+    """
+    import pychemia
+
+    if not pychemia.symm.USE_SPGLIB:
+        return
+    from pychemia.symm import StructureSymmetry, symmetrize
+
+    # One atom displaced 0.028 Angstrom, Fm-3m is recovered with symprec larger than the displacement
+    distorted = _rocksalt(0.005)
+    sym = StructureSymmetry(distorted)
+    assert sym.number(symprec=0.01) < 225
+    assert sym.number(symprec=0.05) == 225
+
+    # The bisection finds the same precision as a linear scan of the grid
+    grid = [0.01 + 0.01 * i for i in range(19)]
+    first = [x for x in grid if sym.number(symprec=x) > sym.number(symprec=0.01)][0]
+    expected = StructureSymmetry(sym.refine_cell(symprec=first)).find_primitive()
+    result = symmetrize(distorted, initial_symprec=0.01, final_symprec=0.2, delta_symprec=0.01)
+    assert result.natom == expected.natom == 2
+    assert StructureSymmetry(result).number() == 225
+
+    # Without a jump in the grid the structure keeps its space group
+    assert StructureSymmetry(symmetrize(_rocksalt(), final_symprec=0.05)).number() == 225
+
+
+def test_symmetry_cache():
+    """
+    Tests for the memoized get_symmetry          :
+    """
+    import pychemia
+
+    if not pychemia.symm.USE_SPGLIB:
+        return
+    from pychemia.symm import get_symmetry
+
+    structure = _rocksalt()
+    sym = get_symmetry(structure)
+    assert get_symmetry(structure) is sym
+    assert get_symmetry(structure.copy()) is sym
+    assert sym.number() == 225
+
+    # Changing the structure gives a new analysis
+    reduced = structure.reduced.copy()
+    reduced[0, 0] += 0.1
+    structure.set_reduced(reduced)
+    new_sym = get_symmetry(structure)
+    assert new_sym is not sym
+    assert new_sym.number() < 225
+    assert sym.number() == 225
+
+
+def test_analyze_database():
+    """
+    Tests for the batch symmetry analysis        :
+    """
+    import os
+    import shutil
+    import tempfile
+    import pychemia
+
+    if not pychemia.symm.USE_SPGLIB or not pychemia.db.USE_MONGO:
+        return
+    from pychemia.db import get_database
+    from pychemia.symm import analyze_database
+
+    tmpdir = tempfile.mkdtemp()
+    db = get_database({'name': 'test', 'backend': 'sqlite', 'path': tmpdir + os.sep + 'test.sqlite'})
+    good, bad = db.insert_many([_rocksalt(), _rocksalt()], properties=[{}, {'energy': -1.0}])
+    db.update_fields(good, {'properties': None})
+    # A broken structure makes the analysis fail with an error not raised by spglib
+    db.update_fields(bad, unset=['structure.vector_info'])
+
+    watcher = db.watch(events=['properties'])
+    report = analyze_database(db)
+    assert report['succeed'] == [good]
+    assert report['failed'] == [bad]
+    assert report['errors'][bad].startswith('KeyError')
+    assert db.get_properties(good)['spacegroup'] == 225
+    assert db.get_properties(bad) == {'energy': -1.0}
+    # The results are written through PyChemiaDB and produce change events
+    assert [x['entry_id'] for x in watcher.poll()] == [good]
+
+    report = analyze_database(db)
+    assert report['skipped'] == [good]
+    assert report['failed'] == [bad]
+    shutil.rmtree(tmpdir)